@@ -27,6 +27,7 @@ import pwem.emlib.metadata as md
 import pyworkflow.protocol.params as params
 from pyworkflow.utils.path import makePath, copyFile
 from os.path import basename
+from .utilities.metadata_index import LocationIndex, reconcile_metadata
 from pwem.utils import runProgram
 
 
@@ -97,26 +98,7 @@ class FlexProtApplyVolSetAlignment(ProtAnalysis3D):
         # in case of metadata from an external file, it has to be updated with the proper filenames from 'input.xmd'
         inputSet = self.inputVolumes.get()
 
-        for objId in mdImgs:
-            imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-            index, fn = xmipp3.convert.xmippToLocation(imgPath)
-            if (index):  # case the input is a stack
-                # Conside the index is the id in the input set
-                particle = inputSet[index]
-            else:  # input is not a stack
-                # convert the inputSet to metadata:
-                mdtemp = md.MetaData(self._getExtraPath('input.xmd'))
-                # Loop and find the index based on the basename:
-                bn_retrieved = basename(imgPath)
-                for searched_index in mdtemp:
-                    imgPath_temp = mdtemp.getValue(md.MDL_IMAGE, searched_index)
-                    bn_searched = basename(imgPath_temp)
-                    if bn_searched == bn_retrieved:
-                        index = searched_index
-                        particle = inputSet[index]
-                        break
-            mdImgs.setValue(md.MDL_IMAGE, xmipp3.convert.getImageLocation(particle), objId)
-            mdImgs.setValue(md.MDL_ITEM_ID, int(particle.getObjId()), objId)
+        reconcile_metadata(mdImgs, LocationIndex.from_set(inputSet))
         mdImgs.write(self.imgsFn)
 
 
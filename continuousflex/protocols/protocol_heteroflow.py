@@ -27,18 +27,16 @@ import pwem.emlib.metadata as md
 import pyworkflow.protocol.params as params
 from pyworkflow.utils.path import makePath, createLink
 from sh_alignment.tompy.transform import fft, ifft, fftshift, ifftshift
-from .utilities.spider_files3 import save_volume #, open_volume
 import numpy as np
-import farneback3d
 from .utilities.spider_files3 import *
+from .utilities.optflow_engine import calculate_optical_flows, read_volume, BACKEND_GPU
+from .utilities.flow_gram import flow_gram_matrix, update_flow_gram_matrix
+from .utilities.flow_store import ENCODING_FULL, open_flow_store, flow_hashes, spherical_mask
+from .utilities.flow_warp import warp_and_score
+from .utilities.flow_sketch import open_sketches, sketch_store, approximate_gram
 import time
 import os
 from os.path import isfile
-from joblib import Parallel, delayed
-import continuousflex
-from subprocess import check_call
-from pwem.utils import runProgram
-from pwem.emlib.image import ImageHandler
 
 REFERENCE_EXT = 0
 REFERENCE_STA = 1
@@ -46,6 +44,11 @@ REFERENCE_STA = 1
 IMPORT_FLOWS = 0
 FIND_FLOWS = 1
 
+MATRIX_EXACT = 0
+MATRIX_SKETCH = 1
+
+SKETCH_SEED = 0
+
 class FlexProtHeteroFlow(ProtAnalysis3D):
     """ Protocol for HeteroFlow. """
     _label = 'tomoflow protocol'
@@ -90,16 +93,67 @@ class FlexProtHeteroFlow(ProtAnalysis3D):
         group.addParam('WarpAndEstimate', params.BooleanParam,
                       expertLevel=params.LEVEL_ADVANCED,
                       default=True,
-                      label='Save a warped version of the reference for each input volume?',
+                      label='Warp the reference by each optical flow and compare it to the input volume?',
                       help='This will create a set of volumes, representing the fitted version of the input volumes, '
                            'using the calculated optical flows, and calculate the cross correlation, mean square '
                            'distance and the mean absolute distance between the input volumes and estimated volumes')
+        group.addParam('saveWarped', params.BooleanParam,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      default=True, condition='WarpAndEstimate',
+                      label='Keep the warped volumes?',
+                      help='If not, the warped volumes are only used to calculate the cross correlation, mean square '
+                           'distance and mean absolute distance, and they are not written to the disk (no output set '
+                           'of volumes is created).')
+        form.addParam('matrixMode', params.EnumParam,
+                      choices=['Exact: inner products between all the optical flows',
+                               'Approximate: randomized sketch of each optical flow'],
+                      default=MATRIX_EXACT,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Analyzed matrix', display=params.EnumParam.DISPLAY_COMBO,
+                      help='The exact matrix has N x N inner products between the N optical flows, its cost grows '
+                           'quadratically with the number of volumes. For very large sets, each optical flow can '
+                           'instead be projected on a fixed random basis of a chosen size (a sketch). The N sketches '
+                           'are analyzed in place of the matrix, and their inner products approximate the exact ones. '
+                           'The larger the sketch, the better the approximation.')
+        form.addParam('sketchSize', params.IntParam, default=256,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      condition='matrixMode==%d' % MATRIX_SKETCH,
+                      label='Size of the sketch of each optical flow')
+        form.addParam('gramMemory', params.IntParam, default=2048,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Memory for the correlation matrix (MB)',
+                      help='The correlation matrix between the optical flows is calculated by tiles, each tile is a '
+                           'product between two blocks of flows. The blocks are chosen as large as possible to fit '
+                           'in this memory. Finished tiles are saved on the disk, so that a stopped run continues '
+                           'with the missing tiles only.')
+        form.addParam('incrementalMatrix', params.BooleanParam, default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Reuse the correlation matrix of a previous execution?',
+                      help='When the protocol is continued after adding volumes to the input set, only the rows and '
+                           'columns of the new (or changed) optical flows are calculated, the rest of the matrix is '
+                           'copied from the previous execution.')
         form.addSection(label='3D OpticalFLow parameters')
         group = form.addGroup('Optical flows', condition='copy_opflows==%d' % FIND_FLOWS)
+        group.addParam('flowBackend', params.EnumParam, default=BACKEND_GPU,
+                              choices=['GPU (farneback3d)', 'CPU (NumPy/SciPy)'],
+                              display=params.EnumParam.DISPLAY_HLIST,
+                              label='Compute the optical flows on',
+                              help='The CPU version runs the same algorithm with the same parameters on nodes without '
+                                   'a CUDA GPU (the cores of the node are shared by the parallel processes).')
         group.addParam('N_GPU', params.IntParam, default=3, important=True, allowsNull=True,
-                              label = 'Parallel processes on GPU',
+                              label = 'Parallel processes',
                               help='This parameter indicates the number of volumes that will be processed in parallel'
-                                   ' (independently). The more powerful your GPU, the higher the number you can choose.')
+                                   ' (independently). The more powerful your GPU, the higher the number you can choose.'
+                                   ' On the CPU, a few processes each using several cores is usually the fastest.')
+        group.addParam('flowEncoding', params.EnumParam, default=ENCODING_FULL,
+                              expertLevel=params.LEVEL_ADVANCED,
+                              choices=['Full volumes (float32)', 'Inside the mask (float32, lossless)',
+                                       'Inside the mask (float16)', 'Inside the mask (8 bits per value)'],
+                              label='Storage of the optical flows',
+                              help='The optical flows are zero outside the spherical mask, so keeping only the voxels '
+                                   'inside it makes them about 2 times smaller without any loss. Storing these voxels '
+                                   'as float16, or as 8-bit values quantized by blocks, makes them about 4 or 8 times '
+                                   'smaller than full volumes, with a small error that is printed for each flow.')
         group.addParam('pyr_scale', params.FloatParam, default=0.5,
                       label='pyr_scale', allowsNull=True,
                        help='parameter specifying the image scale to build pyramids for each image (pyr_scale < 1). '
@@ -147,17 +201,21 @@ class FlexProtHeteroFlow(ProtAnalysis3D):
 
         if(self.copy_opflows.get()==FIND_FLOWS):
             makePath(self._getExtraPath() + '/optical_flows')
-            self._insertFunctionStep('convertInputStep')
+            # the size is passed so that continuing the protocol after appending volumes reruns from this step
+            self._insertFunctionStep('convertInputStep', self.inputVolumes.get().getSize())
             self._insertFunctionStep('doAlignmentStep')
         else:
             self._insertFunctionStep('copyOpticalFlows')
-        self._insertFunctionStep('findCorrelationMatrix')
+        if self.matrixMode.get() == MATRIX_SKETCH:
+            self._insertFunctionStep('sketchOpticalFlows')
+        else:
+            self._insertFunctionStep('findCorrelationMatrix')
         if (self.WarpAndEstimate.get()):
             self._insertFunctionStep('warpByFlow')
         self._insertFunctionStep('createOutputStep')
 
     # --------------------------- STEPS functions --------------------------------------------
-    def convertInputStep(self):
+    def convertInputStep(self, size=None):
         # Write a metadata with the volumes
         xmipp3.convert.writeSetOfVolumes(self.inputVolumes.get(), self.imgsFn)
 
@@ -191,60 +249,59 @@ class FlexProtHeteroFlow(ProtAnalysis3D):
         mdImgs = md.MetaData(imgFn)
         of_root = self._getExtraPath() + '/optical_flows/'
 
-        # This is a spherical mask with maximum radius
+        # The reference is loaded once by each worker, the volumes are read directly (stacks or mrc files), and
+        # the flows are masked by a spherical mask with maximum radius before being saved in the flow store
         mask_size = int(self.getVolumeDimesion()//2)
-        # Parallel processing (finding multiple optical flows at the same time)
-        global segment
-        def segment(objId):
+        ids = [objId for objId in mdImgs]
+        store = open_flow_store(of_root, ids, np.shape(read_volume(path_vol0)), self.flowEncoding.get())
+        jobs = []
+        for objId in mdImgs:
+            slot = store.slot(objId)
+            if store.is_done(slot):
+                continue
             imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-            # getting a copy converted to spider format to solve the problem with stacks or mrc files
-            tmp = self._getTmpPath('tmp_' + str(objId) + '.spi')
-            runProgram('xmipp_image_convert', '-i ' + imgPath + ' -o ' + tmp + ' --type vol')
-
-            print('processing optical flow for volume ', objId)
-            path_flowx = of_root + str(objId).zfill(6) + '_opflowx.spi'
-            path_flowy = of_root + str(objId).zfill(6) + '_opflowy.spi'
-            path_flowz = of_root + str(objId).zfill(6) + '_opflowz.spi'
-            path_vol_i = tmp
-            if (isfile(path_flowx)):
-                return
-            else:
-                args = " %s %s %f %d %d %d %d %f %d %d %s %s %s" % (path_vol0, path_vol_i, pyr_scale, levels, winsize,
-                                                                   iterations, poly_n, poly_sigma, factor1, factor2,
-                                                                   path_flowx, path_flowy, path_flowz)
-                script_path = continuousflex.__path__[0] + '/protocols/utilities/optflow_run.py'
-                command = "python " + script_path + args
-                check_call(command, shell=True, stdout=sys.stdout, stderr=sys.stderr,
-                           env=None, cwd=None)
-
-                arg_x = "-i %s  --mask circular -%d --substitute 0  -o %s" % (path_flowx, mask_size, path_flowx)
-                arg_y = "-i %s  --mask circular -%d --substitute 0  -o %s" % (path_flowy, mask_size, path_flowy)
-                arg_z = "-i %s  --mask circular -%d --substitute 0  -o %s" % (path_flowz, mask_size, path_flowz)
-                runProgram('xmipp_transform_mask', arg_x)
-                runProgram('xmipp_transform_mask', arg_y)
-                runProgram('xmipp_transform_mask', arg_z)
-
-        # Running the multiple processing:
-        ps = [objId for objId in mdImgs]
-        Parallel(n_jobs=self.N_GPU.get(), backend="multiprocessing")(delayed(segment)(p) for p in ps)
+            jobs.append((objId, slot, imgPath))
+        sketch = None
+        if self.matrixMode.get() == MATRIX_SKETCH:
+            # the flows are sketched by the workers as soon as they are calculated
+            open_sketches(self.getSketchFile(), store.ids, self.sketchSize.get())
+            sketch = (self.getSketchFile(), self.sketchSize.get(), SKETCH_SEED)
+        calculate_optical_flows(path_vol0, store.path, jobs, pyr_scale, levels, winsize, iterations, poly_n,
+                                poly_sigma, factor1, factor2, mask_radius=mask_size, n_jobs=self.N_GPU.get(),
+                                sketch=sketch, backend=self.flowBackend.get(), cache_dir=self._getTmpPath())
+        print(store.report())
 
     def findCorrelationMatrix(self):
-        imgFn = self.imgsFn
-        mdImgs = md.MetaData(imgFn)
-        N = 0
-        for objId in mdImgs:
-            N += 1
-        metric_mat = np.zeros([N, N])
-        for i in range(1, N + 1):
-            print('finding the correlation matrix row ', i)
-            flowi = self.read_optical_flow_by_number(i)
-            for j in range(i, N + 1):
-                print('        column', j)
-                flowj = self.read_optical_flow_by_number(j)
-                metric_mat[i - 1, j - 1] = metric_mat[j - 1, i - 1] =  self.metric_opflow_vols(flowi, flowj)
-
+        store = self.get_flow_store()
+        # the flows are zero outside the spherical mask, only the voxels inside it are used
+        mask = spherical_mask(store.shape)
+        # each row of the matrix is identified by the volume id and the content of its optical flow
+        keys = list(zip([int(objId) for objId in store.ids], flow_hashes(store)))
         correlation_matrix = self._getExtraPath('data.csv')
+        keys_fn = self._getExtraPath('data_keys.txt')
+        if self.incrementalMatrix.get() and isfile(correlation_matrix) and isfile(keys_fn):
+            old_keys = self.read_keys(keys_fn)
+            old_matrix = np.reshape(np.loadtxt(correlation_matrix, delimiter=','), [len(old_keys), len(old_keys)])
+            metric_mat = update_flow_gram_matrix(store, old_matrix, old_keys, keys, mask,
+                                                 memory_mb=self.gramMemory.get())
+        else:
+            metric_mat = flow_gram_matrix(store, mask, memory_mb=self.gramMemory.get(),
+                                          checkpoint=self._getExtraPath('data_tiles'))
         np.savetxt(correlation_matrix, metric_mat, delimiter=',')
+        with open(keys_fn, 'w') as f:
+            for objId, flow_hash in keys:
+                print(objId, flow_hash, file=f)
+
+    def sketchOpticalFlows(self):
+        store = self.get_flow_store()
+        sketches = open_sketches(self.getSketchFile(), store.ids, self.sketchSize.get())
+        # only the flows that were not sketched while being calculated (e.g., imported flows), or re-encoded since
+        sketch_store(store, sketches, spherical_mask(store.shape), self.getSketchFile(), SKETCH_SEED)
+        # the sketches are analyzed in place of the matrix (one row per volume)
+        np.savetxt(self._getExtraPath('data.csv'), sketches, delimiter=',')
+        keys_fn = self._getExtraPath('data_keys.txt')
+        if isfile(keys_fn):
+            os.remove(keys_fn)
 
     def copyOpticalFlows(self):
         # In this case we get from the refinment protocol the optical flows and the reference
@@ -256,54 +313,28 @@ class FlexProtHeteroFlow(ProtAnalysis3D):
                    self._getExtraPath('reference.spi'))
 
     def warpByFlow(self):
-        makePath(self._getExtraPath() + '/estimated_volumes')
         estVol_root = self._getExtraPath() + '/estimated_volumes/'
+        if self.saveWarped.get():
+            makePath(estVol_root)
         reference_fn = self._getExtraPath('reference.spi')
-        # reference = open_volume(reference_fn)
-        reference = ImageHandler().read(reference_fn).getData()
-
         stat_mat_fn = self._getExtraPath('cc_msd_mad.txt')
-        # recount the number of volumes:
-        imgFn = self.imgsFn
-        mdImgs = md.MetaData(imgFn)
+        store = self.get_flow_store()
 
-        N = 0
-        for objId in mdImgs:
-            N += 1
-
-        for i in range(1, N + 1):
-            print('Warping a copy of the reference volume by the optical flow ', i)
-            flow_i = self.read_optical_flow_by_number(i)
-            warped_i = farneback3d.warp_by_flow(reference, np.float32(flow_i))
-            warped_path_i = estVol_root + str(i).zfill(6) + '.spi'
-            save_volume(warped_i, warped_path_i)
+        # one job per volume, the flow number i (from 1) is the one of the i-th volume of the metadata
+        jobs = []
+        mdImgs = md.MetaData(self.imgsFn)
+        for i, objId in enumerate(mdImgs):
+            imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
+            warped_path_i = estVol_root + str(i + 1).zfill(6) + '.spi' if self.saveWarped.get() else None
+            jobs.append((i, imgPath, warped_path_i))
 
         # Find a matrix of metrics (normalized cross correlation, mean square distance, mean absolute distance)
-        stat_mat = np.zeros([N, 3])
-        mdImgs = md.MetaData(imgFn)
-        i = 0
-        for objId in mdImgs:
-            print('Finding the cross corrlation, mean square distance and mean absolute distance for volume ', i + 1)
-            imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-            # getting a copy converted to spider format to solve the problem with stacks or mrc files
-            tmp = self._getTmpPath('tmp.spi')
-            self.runJob('xmipp_image_convert', '-i ' + imgPath + ' -o ' + tmp + ' --type vol')
-            # vol_i = open_volume(tmp)
-            vol_i = ImageHandler().read(tmp).getData()
-
-            warped_path_i = estVol_root + str(i + 1).zfill(6) + '.spi'
-            warped_i = ImageHandler().read(warped_path_i).getData()
-            # TODO: replace all the open_volume and save_volume by the ImageHandler() read and write
-            # warped_i = open_volume(warped_path_i)
-            stat_mat[i, 0] = self.ncc(warped_i,vol_i)
-            stat_mat[i, 1] = self.vmsq(warped_i,vol_i)
-            stat_mat[i, 2] = self.vmab(warped_i,vol_i)
-            i += 1
+        stat_mat = warp_and_score(reference_fn, store.path, jobs, n_jobs=self.N_GPU.get() or 1,
+                                  backend=self.getFlowBackend())
         np.savetxt(stat_mat_fn, stat_mat)
-        pass
 
     def createOutputStep(self):
-        if (self.WarpAndEstimate.get()):
+        if (self.WarpAndEstimate.get() and self.saveWarped.get()):
             # first making a metadata for the wrapped volumes:
             out_mdfn = self._getExtraPath('volumes_out.xmd')
             pattern = '"' + self._getExtraPath() + '/estimated_volumes/*.spi"'
@@ -332,36 +363,37 @@ class FlexProtHeteroFlow(ProtAnalysis3D):
         pass
 
     # --------------------------- UTILS functions --------------------------------------------
-    def read_optical_flow(self, path_flowx, path_flowy, path_flowz):
-        # x = open_volume(path_flowx)
-        x = ImageHandler().read(path_flowx).getData()
-        # y = open_volume(path_flowy)
-        y = ImageHandler().read(path_flowy).getData()
-        # z = open_volume(path_flowz)
-        z = ImageHandler().read(path_flowz).getData()
-
-        l = np.shape(x)
-        # print(l)
-        flow = np.zeros([3, l[0], l[1], l[2]])
-        flow[0, :, :, :] = x
-        flow[1, :, :, :] = y
-        flow[2, :, :, :] = z
-        return flow
-
-    def read_optical_flow_by_number(self, num):
-        op_path = self._getExtraPath() + '/optical_flows/'
-        path_flowx = op_path + str(num).zfill(6) + '_opflowx.spi'
-        path_flowy = op_path + str(num).zfill(6) + '_opflowy.spi'
-        path_flowz = op_path + str(num).zfill(6) + '_opflowz.spi'
-        flow = self.read_optical_flow(path_flowx, path_flowy, path_flowz)
-        return flow
-
-    def metric_opflow_vols(self, flow1, flow2):
-        # print(np.shape(flow1))
-        reshaped_flow1 = np.reshape(flow1, [3, np.shape(flow1)[1] * np.shape(flow1)[2] * np.shape(flow1)[3]])
-        reshaped_flow2 = np.reshape(flow2, [3, np.shape(flow2)[1] * np.shape(flow2)[2] * np.shape(flow2)[3]])
-        metric = np.sum(np.multiply(reshaped_flow1, reshaped_flow2))
-        return metric
+    def get_flow_store(self):
+        return open_flow_store(self._getExtraPath() + '/optical_flows/')
+
+    def read_optical_flow_by_number(self, num, store=None):
+        """ Flow of the volume number num (starting from 1) as a float32 memory-mapped view. """
+        if store is None:
+            store = self.get_flow_store()
+        return store[num - 1]
+
+    def getFlowBackend(self):
+        """ Backend of the optical flows (the one of the refinement protocol when its flows are imported). """
+        if self.copy_opflows.get() == IMPORT_FLOWS:
+            return self.refinementProt.get().flowBackend.get()
+        return self.flowBackend.get()
+
+    def getSketchFile(self):
+        return self._getExtraPath('sketches.npy')
+
+    def getGramMatrix(self, rows=None, cols=None):
+        """ Inner products between the optical flows of the given rows and columns (all if None), read from the
+        matrix, or approximated from the sketches when only the sketches were calculated. """
+        if self.matrixMode.get() == MATRIX_SKETCH:
+            return approximate_gram(open_sketches(self.getSketchFile()), rows, cols)
+        gram = np.loadtxt(self._getExtraPath('data.csv'), delimiter=',', ndmin=2)
+        gram = gram if rows is None else gram[rows]
+        return gram if cols is None else gram[:, cols]
+
+    def read_keys(self, keys_fn):
+        """ Keys (volume id, flow hash) of the rows of a saved correlation matrix. """
+        with open(keys_fn) as f:
+            return [(int(line.split()[0]), line.split()[1]) for line in f if line.strip()]
 
     def _printWarnings(self, *lines):
         """ Print some warning lines to 'warnings.xmd',
@@ -371,51 +403,5 @@ class FlexProtHeteroFlow(ProtAnalysis3D):
             print >> fWarn, l
         fWarn.close()
 
-    def normalize(self, v):
-        """Normalize the data.
-        @param v: input volume.
-        @return: Normalized volume.
-        """
-        m = np.mean(v)
-        v = v - m
-        s = np.std(v)
-        v = v / s
-        return v
-
-    def ncc(self, v1, v2):
-        """Compute the Normalized Cross Correlation between the two volumes.
-        @param v1: volume 1.
-        @param v2: volume 2.
-        @return: NCC.
-        """
-        vv1 = self.normalize(v1)
-        vv2 = self.normalize(v2)
-        score = np.sum(vv1 * vv2) / vv1.size
-        return score
-
-    def vmsq(self, v1, v2):
-        """Compute the normalized mean square distance between the two volumes
-        :param v1: volume1
-        :param v2: volume2
-        :return: score for mean square diff
-        """
-        from sklearn.metrics import mean_squared_error
-        score = mean_squared_error(np.ndarray.flatten(v1), np.ndarray.flatten(v2)) / mean_squared_error(
-            np.ndarray.flatten(v1),
-            np.zeros([np.size(np.ndarray.flatten(v1))]))
-        return score
-
-    def vmab(self, v1, v2):
-        """Compute the normalized mean absolute distance between the two volumes
-        :param v1: volume1
-        :param v2: volume2
-        :return: score for mean square diff
-        """
-        from sklearn.metrics import mean_absolute_error
-        score = mean_absolute_error(np.ndarray.flatten(v1), np.ndarray.flatten(v2)) / mean_absolute_error(
-            np.ndarray.flatten(v1),
-            np.zeros([np.size(np.ndarray.flatten(v1))]))
-        return score
-
     def getVolumeDimesion(self):
         return self.inputVolumes.get().getDimensions()[0]
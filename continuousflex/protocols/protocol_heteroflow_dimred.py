@@ -136,8 +136,9 @@ class FlexProtDimredHeteroFlow(ProtAnalysis3D):
         extraParams = self.extraParams.get('')
         deformationsFile = self.getDeformationFile()
 
+        # the number of rows is passed so that the steps are executed again when the matrix grows
         self._insertFunctionStep('convertInputStep',
-                                 deformationsFile)
+                                 deformationsFile, rows)
         self._insertFunctionStep('performDimredStep',
                                  deformationsFile, method, extraParams,
                                  rows, reducedDim)
@@ -145,7 +146,7 @@ class FlexProtDimredHeteroFlow(ProtAnalysis3D):
 
     # --------------------------- STEPS functions --------------------------------------------
 
-    def convertInputStep(self, deformationFile):
+    def convertInputStep(self, deformationFile, rows=None):
         """ Copy the data.csv file that will serve as
         input for dimensionality reduction.
         """
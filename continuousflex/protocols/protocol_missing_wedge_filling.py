@@ -29,6 +29,7 @@ from pyworkflow.utils.path import makePath, copyFile
 from os.path import basename, isfile
 from sh_alignment.tompy.transform import fft, ifft, fftshift, ifftshift
 from .utilities.spider_files3 import save_volume, open_volume
+from .utilities.missing_wedge import wedge_mask
 from pyworkflow.utils import replaceBaseExt
 import numpy as np
 from continuousflex.protocols.utilities.mwr_wrapper import mwr
@@ -114,26 +115,11 @@ class FlexProtMissingWedgeRestoration(ProtAnalysis3D):
         tiltLow = self.tiltLow.get()
         tiltHigh = self.tiltHigh.get()
 
-        # creating a missing-wedge mask:
-        start_ang = tiltLow
-        end_ang = tiltHigh
+        # creating a missing-wedge mask (see utilities/missing_wedge.py):
+        # the dimensions are (X, Y, Z), the mask is (Z, Y, X)
         size = self.inputVolumes.get().getDim()
-        MW_mask = np.ones(size)
-        x, z = np.mgrid[0.:size[0], 0.:size[2]]
-        x -= size[0] / 2
-        ind = np.where(x)
-        z -= size[2] / 2
-        angles = np.zeros(z.shape)
-        angles[ind] = np.arctan(z[ind] / x[ind]) * 180 / np.pi
-        angles = np.reshape(angles, (size[0], 1, size[2]))
-        angles = np.repeat(angles, size[1], axis=1)
-        MW_mask[angles > -start_ang] = 0
-        MW_mask[angles < -end_ang] = 0
-        MW_mask[size[0] // 2, :, :] = 0
-        MW_mask[size[0] // 2, :, size[2] // 2] = 1
         fnmask = self._getExtraPath('Mask.spi')
-        save_volume(np.float32(MW_mask), fnmask)
-        runProgram('xmipp_transform_geometry', '-i ' + fnmask + ' --rotate_volume euler 0 90 0')
+        save_volume(np.float32(wedge_mask(size[::-1], (tiltLow, tiltHigh))), fnmask)
         # done creating the missing wedge mask, getting the paremeters from the form:
         sigma_noise = self.sigma_noise.get()
         T = self.T.get()
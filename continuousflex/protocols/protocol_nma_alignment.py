@@ -44,10 +44,10 @@ import pwem as em
 import pwem.emlib.metadata as md
 
 from xmipp3.base import XmippMdRow
-from xmipp3.convert import (writeSetOfParticles, xmippToLocation,
-                            getImageLocation, createItemMatrix,
+from xmipp3.convert import (writeSetOfParticles, createItemMatrix,
                             setXmippAttributes)
 from .convert import modeToRow
+from .utilities.metadata_index import LocationIndex, reconcile_metadata
 from pwem.utils import runProgram
 from pwem import Domain
 
@@ -176,26 +176,7 @@ class FlexProtAlignmentNMA(ProtAnalysis3D):
         # project), and we need to set the item_id for each image
         inputSet = self.inputParticles.get()
         mdImgs = md.MetaData(self.imgsFn)
-        for objId in mdImgs:
-            imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-            index, fn = xmippToLocation(imgPath)
-            if(index): # case the input is a stack
-                # Conside the index is the id in the input set
-                particle = inputSet[index]
-            else: # input is not a stack
-                # convert the inputSet to metadata:
-                mdtemp = md.MetaData(self.imgsFn_backup)
-                # Loop and find the index based on the basename:
-                bn_retrieved = basename(imgPath)
-                for searched_index in mdtemp:
-                    imgPath_temp = mdtemp.getValue(md.MDL_IMAGE,searched_index)
-                    bn_searched = basename(imgPath_temp)
-                    if bn_searched == bn_retrieved:
-                        index = searched_index
-                        particle = inputSet[index]
-                        break
-            mdImgs.setValue(md.MDL_IMAGE, getImageLocation(particle), objId)
-            mdImgs.setValue(md.MDL_ITEM_ID, int(particle.getObjId()), objId)
+        reconcile_metadata(mdImgs, LocationIndex.from_set(inputSet))
         mdImgs.write(self.imgsFn)
 
     def performNmaStep(self, atomsFn, modesFn):
@@ -223,26 +204,7 @@ class FlexProtAlignmentNMA(ProtAnalysis3D):
 
         inputSet = self.inputParticles.get()
         mdImgs = md.MetaData(self.imgsFn)
-        for objId in mdImgs:
-            imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-            index, fn = xmippToLocation(imgPath)
-            if(index): # case the input is a stack
-                # Conside the index is the id in the input set
-                particle = inputSet[index]
-            else: # input is not a stack
-                # convert the inputSet to metadata:
-                mdtemp = md.MetaData(self.imgsFn_backup)
-                # Loop and find the index based on the basename:
-                bn_retrieved = basename(imgPath)
-                for searched_index in mdtemp:
-                    imgPath_temp = mdtemp.getValue(md.MDL_IMAGE,searched_index)
-                    bn_searched = basename(imgPath_temp)
-                    if bn_searched == bn_retrieved:
-                        index = searched_index
-                        particle = inputSet[index]
-                        break
-            mdImgs.setValue(md.MDL_IMAGE, getImageLocation(particle), objId)
-            mdImgs.setValue(md.MDL_ITEM_ID, int(particle.getObjId()), objId)
+        reconcile_metadata(mdImgs, LocationIndex.from_set(inputSet))
         mdImgs.write(self.imgsFn)
 
     def createOutputStep(self):
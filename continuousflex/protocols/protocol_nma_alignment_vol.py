@@ -27,8 +27,8 @@ from os.path import basename
 import os
 from pyworkflow.utils import getListFromRangeString
 from pwem.protocols import ProtAnalysis3D
-from xmipp3.convert import (writeSetOfVolumes, xmippToLocation, createItemMatrix,
-                            setXmippAttributes, setOfParticlesToMd, getImageLocation)
+from xmipp3.convert import (writeSetOfVolumes, createItemMatrix,
+                            setXmippAttributes, setOfParticlesToMd)
 
 import pwem as em
 import pwem.emlib.metadata as md
@@ -37,6 +37,7 @@ from pyworkflow.utils.path import copyFile, cleanPath
 import pyworkflow.protocol.params as params
 from pyworkflow.protocol.params import NumericRangeParam
 from .convert import modeToRow
+from .utilities.metadata_index import LocationIndex, reconcile_metadata
 from pwem.convert.atom_struct import cifToPdb
 from pyworkflow.utils import replaceBaseExt
 from pwem.utils import runProgram
@@ -203,26 +204,7 @@ class FlexProtAlignmentNMAVol(ProtAnalysis3D):
         # project), and we need to set the item_id for each volume
         inputSet = self.inputVolumes.get()
         mdImgs = md.MetaData(self.imgsFn)
-        for objId in mdImgs:
-            imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-            index, fn = xmippToLocation(imgPath)
-            if(index): # case the input is a stack
-                # Conside the index is the id in the input set
-                particle = inputSet[index]
-            else: # input is not a stack
-                # convert the inputSet to metadata:
-                mdtemp = md.MetaData(self.imgsFn_backup)
-                # Loop and find the index based on the basename:
-                bn_retrieved = basename(imgPath)
-                for searched_index in mdtemp:
-                    imgPath_temp = mdtemp.getValue(md.MDL_IMAGE,searched_index)
-                    bn_searched = basename(imgPath_temp)
-                    if bn_searched == bn_retrieved:
-                        index = searched_index
-                        particle = inputSet[index]
-                        break
-            mdImgs.setValue(md.MDL_IMAGE, getImageLocation(particle), objId)
-            mdImgs.setValue(md.MDL_ITEM_ID, int(particle.getObjId()), objId)
+        reconcile_metadata(mdImgs, LocationIndex.from_set(inputSet))
         mdImgs.sort(md.MDL_ITEM_ID)
         mdImgs.write(self.imgsFn)
 
@@ -269,26 +251,7 @@ class FlexProtAlignmentNMAVol(ProtAnalysis3D):
         inputSet = self.inputVolumes.get()
         mdImgs = md.MetaData(self.imgsFn)
 
-        for objId in mdImgs:
-            imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-            index, fn = xmippToLocation(imgPath)
-            if(index): # case the input is a stack
-                # Conside the index is the id in the input set
-                particle = inputSet[index]
-            else: # input is not a stack
-                # convert the inputSet to metadata:
-                mdtemp = md.MetaData(self.imgsFn_backup)
-                # Loop and find the index based on the basename:
-                bn_retrieved = basename(imgPath)
-                for searched_index in mdtemp:
-                    imgPath_temp = mdtemp.getValue(md.MDL_IMAGE,searched_index)
-                    bn_searched = basename(imgPath_temp)
-                    if bn_searched == bn_retrieved:
-                        index = searched_index
-                        particle = inputSet[index]
-                        break
-            mdImgs.setValue(md.MDL_IMAGE, getImageLocation(particle), objId)
-            mdImgs.setValue(md.MDL_ITEM_ID, int(particle.getObjId()), objId)
+        reconcile_metadata(mdImgs, LocationIndex.from_set(inputSet))
         mdImgs.sort(md.MDL_ITEM_ID)
         mdImgs.write(self.imgsFn)
 
@@ -25,13 +25,16 @@
 
 import os
 from pwem.protocols import ProtAnalysis3D
-from xmipp3.convert import writeSetOfVolumes, xmippToLocation, createItemMatrix, setXmippAttributes
+from xmipp3.convert import writeSetOfVolumes, createItemMatrix, setXmippAttributes
 import pwem as em
 from pwem.objects import Volume
 import pwem.emlib.metadata as md
 import pyworkflow.protocol.params as params
 from pwem.utils import runProgram
-from pwem import Domain
+from continuousflex.protocols.utilities.volume_average import alignment_matrix, volume_statistics, \
+    subsets_by_id, partial_sums, merge_partials, write_volume, PARTIAL_SUBSET
+from continuousflex.protocols.utilities.metadata_index import LocationIndex, reconcile_metadata
+from continuousflex.protocols.utilities.align_shards import add_shard_params, run_volumeset_align
 
 WEDGE_MASK_NONE = 0
 WEDGE_MASK_THRE = 1
@@ -150,6 +153,8 @@ class FlexProtSubtomogramAveraging(ProtAnalysis3D):
         line.addParam('frm_maxshift', params.IntParam, default=10,
                       label='Maximum shift search (in pixels)',
                       help='')
+        add_shard_params(form)
+
         form.addParallelSection(threads=0, mpi=5)
 
     # --------------------------- INSERT steps functions --------------------------------------------
@@ -200,31 +205,22 @@ class FlexProtSubtomogramAveraging(ProtAnalysis3D):
         # if the reference is None, then we got to make an initial reference:
         if reference is None:
             initialref = self._getExtraPath('initialref.mrc')
+            # mean (and per-voxel variance) of the input subtomograms, streamed in parallel chunks
             mdImgs = md.MetaData(imgFn)
-            counter = 0
-            first = True
-            tempVol = self._getExtraPath('temp.mrc')
-            for objId in mdImgs:
-                counter = counter + 1
-                imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-                if counter == 1:
-                    args = '-i %(imgPath)s -o %(tempVol)s --type vol' % locals()
-                    runProgram('xmipp_image_convert',args)
-                else:
-                    params = '-i %(imgPath)s --plus %(tempVol)s -o %(tempVol)s ' % locals()
-                    runProgram('xmipp_image_operate', params)
-            params = '-i %(tempVol)s --divide %(counter)s -o %(initialref)s ' % locals()
-            runProgram('xmipp_image_operate', params)
-            os.system("rm -f %(tempVol)s" % locals())
+            jobs = [(mdImgs.getValue(md.MDL_IMAGE, objId), None) for objId in mdImgs]
+            count, mean, variance = volume_statistics(jobs, n_jobs=self.numberOfMpi.get())[None]
+            write_volume(mean, initialref)
+            write_volume(variance, self._getExtraPath('initialref_variance.mrc'))
             reference = initialref
 
+        # item ids of the subtomograms, by path (they are lost by xmipp_volumeset_align)
+        inputIndex = LocationIndex.from_metadata(imgFn)
         for i in range(1, max_itr + 1):
             arg = 'params_itr_' + str(i) + '.xmd'
             md_itr = self._getExtraPath(arg)
             arg = 'average_itr_' + str(i) + '.mrc'
             avr_itr = self._getExtraPath(arg)
-            args = "-i %(imgFn)s -o %(md_itr)s --odir %(tempdir)s --resume --ref %(reference)s" \
-                   " --frm_parameters %(frm_freq)f %(frm_maxshift)d "
+            args = "--ref %(reference)s --frm_parameters %(frm_freq)f %(frm_maxshift)d "
 
             if self.WedgeMode == WEDGE_MASK_THRE:
                 tilt0 = self.tiltLow.get()
@@ -235,60 +231,35 @@ class FlexProtSubtomogramAveraging(ProtAnalysis3D):
             if self.applyMask.get():
                 args += "--mask " + self.Mask.get().getFileName()
 
-            self.runJob("xmipp_volumeset_align", args % locals(),
-                        env = Domain.importFromPlugin('xmipp3').Plugin.getEnviron())
+            run_volumeset_align(self, imgFn, md_itr, tempdir, args % locals(), self._getExtraPath('shards_itr_%d' % i))
 
-            # By now, the alignment is done, the averaging should take place
+            # By now, the alignment is done, the averaging should take place: each alignment (and the rotation
+            # about Y when the missing wedge is compensated) is one affine transform applied in memory
             mdImgs = md.MetaData(md_itr)
-            counter = 0
-            first = True
-
+            jobs = []
+            ids = []
             for objId in mdImgs:
-                counter = counter + 1
-
-                imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-                rot = mdImgs.getValue(md.MDL_ANGLE_ROT, objId)
-                tilt = mdImgs.getValue(md.MDL_ANGLE_TILT, objId)
-                psi = mdImgs.getValue(md.MDL_ANGLE_PSI, objId)
-
-                x_shift = mdImgs.getValue(md.MDL_SHIFT_X, objId)
-                y_shift = mdImgs.getValue(md.MDL_SHIFT_Y, objId)
-                z_shift = mdImgs.getValue(md.MDL_SHIFT_Z, objId)
-
                 flip = mdImgs.getValue(md.MDL_ANGLE_Y, objId)
-                tempVol = self._getExtraPath('temp.mrc')
-                extra = self._getExtraPath()
-
-                if flip == 0:
-                    if first:
-                        print("THERE IS NO COMPENSATION FOR THE MISSING WEDGE")
-                        first = False
-
-                    params = '-i %(imgPath)s -o %(tempVol)s --inverse --rotate_volume euler %(rot)s %(tilt)s %(psi)s' \
-                             ' --shift %(x_shift)s %(y_shift)s %(z_shift)s -v 0' % locals()
-
-                else:
-                    if first:
-                        print("THERE IS A COMPENSATION FOR THE MISSING WEDGE")
-                        first = False
-                    # First got to rotate each volume 90 degrees about the y axis, align it, then rotate back and sum it
-                    params = '-i %(imgPath)s -o %(tempVol)s --rotate_volume euler 0 90 0' % locals()
-                    runProgram('xmipp_transform_geometry', params)
-                    params = '-i %(tempVol)s -o %(tempVol)s --rotate_volume euler %(rot)s %(tilt)s %(psi)s' \
-                             ' --shift %(x_shift)s %(y_shift)s %(z_shift)s ' % locals()
-
-                runProgram('xmipp_transform_geometry', params)
-
-                if counter == 1:
-                    os.system("cp %(tempVol)s %(avr_itr)s" % locals())
-
-                else:
-                    params = '-i %(tempVol)s --plus %(avr_itr)s -o %(avr_itr)s ' % locals()
-                    runProgram('xmipp_image_operate', params)
-
-            params = '-i %(avr_itr)s --divide %(counter)s -o %(avr_itr)s ' % locals()
-            runProgram('xmipp_image_operate', params)
-            os.system("rm -f %(tempVol)s" % locals())
+                P = alignment_matrix(mdImgs.getValue(md.MDL_ANGLE_ROT, objId),
+                                     mdImgs.getValue(md.MDL_ANGLE_TILT, objId),
+                                     mdImgs.getValue(md.MDL_ANGLE_PSI, objId),
+                                     mdImgs.getValue(md.MDL_SHIFT_X, objId),
+                                     mdImgs.getValue(md.MDL_SHIFT_Y, objId),
+                                     mdImgs.getValue(md.MDL_SHIFT_Z, objId), flip)
+                jobs.append((mdImgs.getValue(md.MDL_IMAGE, objId), P))
+                item = inputIndex.lookup(jobs[-1][0])
+                if item is None:
+                    # the subsets of the partial sums are made of item ids, an objId would be put in another subset
+                    raise Exception('%s does not match any item of the input' % jobs[-1][0])
+                ids.append(item[1])
+            if flip == 0:
+                print("THERE IS NO COMPENSATION FOR THE MISSING WEDGE")
+            else:
+                print("THERE IS A COMPENSATION FOR THE MISSING WEDGE")
+            # partial sums by subsets of item ids, merged into the average
+            partials = partial_sums(subsets_by_id(jobs, ids, PARTIAL_SUBSET), self._getExtraPath('partial_sums'),
+                                    n_jobs=self.numberOfMpi.get())
+            write_volume(merge_partials(partials), avr_itr)
             # Updating the reference then realigning:
             reference = avr_itr
 
@@ -303,18 +274,8 @@ class FlexProtSubtomogramAveraging(ProtAnalysis3D):
         inputSet = md.MetaData(self.imgsFn)
         mdImgs = md.MetaData(self.outputMD)
 
-        # setting item_id (lost due to mpi usually)
-        for objId in mdImgs:
-            imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-            index, fn = xmippToLocation(imgPath)
-            # Conside the index is the id in the input set
-            for objId2 in inputSet:
-                NewImgPath = inputSet.getValue(md.MDL_IMAGE, objId2)
-                if (NewImgPath == imgPath):
-                    target_ID = inputSet.getValue(md.MDL_ITEM_ID, objId2)
-                    break
-
-            mdImgs.setValue(md.MDL_ITEM_ID, target_ID, objId)
+        # setting item_id (lost due to mpi) from the paths of the input
+        reconcile_metadata(mdImgs, LocationIndex.from_metadata(inputSet), update_paths=False)
 
         mdImgs.write(self.outputMD)
 
@@ -24,25 +24,33 @@ from pwem.protocols import ProtAnalysis3D
 import xmipp3.convert
 import pwem.emlib.metadata as md
 import pyworkflow.protocol.params as params
-from pyworkflow.utils.path import makePath, copyFile, cleanPath
+from pyworkflow.utils.path import makePath, copyFile
 from os.path import basename
 from sh_alignment.tompy.transform import fft, ifft, fftshift, ifftshift
 from .utilities.spider_files3 import save_volume #, open_volume
 from pyworkflow.utils import replaceBaseExt
 import numpy as np
-import farneback3d
 from .utilities.spider_files3 import *
+from .utilities.optflow_engine import calculate_optical_flows, read_volume, farneback_backend, BACKEND_GPU, \
+    BACKEND_CPU
+from .utilities.flow_store import ENCODING_FULL, open_flow_store, flow_store_path
+from .utilities.metadata_index import LocationIndex, reconcile_metadata
+from .utilities.euler_transforms import read_alignments, write_alignments, compose, invert
+from .utilities.checkpoint import CheckpointJournal, file_checksum
+from .utilities.missing_wedge import wedge_mask
+from .utilities.volume_average import alignment_matrix, subsets_by_id, partial_sums, merge_partials, \
+    PARTIAL_SUBSET
+from .utilities.retention import RetentionManager, KEEP_NEEDED, KEEP_LAST, KEEP_FLOWS, KEEP_SAMPLE, KEEP_ALL, \
+    KIND_FLOWS
+from .utilities.align_shards import add_shard_params, run_volumeset_align
 import time
+import hashlib
 import os
+from glob import glob
 from os.path import basename, isfile
 from pwem.utils import runProgram
-from pwem import Domain
 from pwem.objects import Volume
-from joblib import Parallel, delayed
-import continuousflex
-from subprocess import check_call
 from pwem.emlib.image import ImageHandler
-import math
 
 REFERENCE_EXT = 0
 REFERENCE_STA = 1
@@ -76,14 +84,47 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
                        condition='Alignment_refine',
                        label='Refinment iterations', help='How many times you want to iterate to perform'
                                                          ' subtomogram alignment refinement.')
-        group.addParam('KeepFiles', params.BooleanParam, default=False,
+        group.addParam('fusedIteration', params.BooleanParam, default=False,
                        expertLevel=params.LEVEL_ADVANCED,
-                       label='Keep the intermediate files on the disk (CAREFUL!)?',
+                       label='Process each volume in one pass per iteration?',
                        condition='Alignment_refine',
-                       help='This will keep all the itermediate files on the disk (useful for debugging). Be very careful'
-                            ' that it requires 6 times the size of the input subtomograms per iteration.'
-                            ' For example, if you are using 1GB size input subtomogams, and you are refining for 4 iterations,'
-                            ' then this requires 24GB on the disk; where setting this to no, we require 6GB.')
+                       help='If yes, each volume is filled, aligned, compared with the reference (optical flow) and '
+                            'the reference is warped by its flow in memory by the parallel processes, and only the '
+                            'flows and the warped references are written. Otherwise, each of these steps processes '
+                            'all the volumes and writes them on the disk before the next one.')
+        group.addParam('retentionPolicy', params.EnumParam, default=KEEP_NEEDED,
+                       expertLevel=params.LEVEL_ADVANCED,
+                       condition='Alignment_refine',
+                       choices=['Only what the next steps need', 'The last iterations', 'Only the optical flows',
+                                'Everything for a subset of the volumes', 'Everything (CAREFUL!)'],
+                       label='Intermediate files kept on the disk',
+                       help='The intermediate files of each iteration (missing wedge filled, aligned and warped '
+                            'volumes, optical flows) are handled as soon as the next steps do not need them. Keeping '
+                            'everything (useful for debugging) requires about 6 times the size of the input '
+                            'subtomograms per iteration. The bytes written and kept by each iteration are reported '
+                            'in the log.')
+        group.addParam('retainLast', params.IntParam, default=1,
+                       expertLevel=params.LEVEL_ADVANCED,
+                       condition='Alignment_refine and retentionPolicy==%d' % KEEP_LAST,
+                       label='Number of iterations kept')
+        group.addParam('retainSample', params.IntParam, default=10,
+                       expertLevel=params.LEVEL_ADVANCED,
+                       condition='Alignment_refine and retentionPolicy==%d' % KEEP_SAMPLE,
+                       label='Number of volumes kept',
+                       help='The intermediate files of this number of volumes (evenly spaced in the set) are kept.')
+        group.addParam('retentionCompress', params.BooleanParam, default=False,
+                       expertLevel=params.LEVEL_ADVANCED,
+                       condition='Alignment_refine and retentionPolicy in [%d, %d, %d]' % (KEEP_LAST, KEEP_FLOWS,
+                                                                                           KEEP_ALL),
+                       label='Compress the kept files?',
+                       help='Volumes are packed in float16 .npz files (one per folder) and optical flows are stored '
+                            'as float16 values inside the sphere.')
+        group.addParam('retentionBudget', params.FloatParam, default=0,
+                       expertLevel=params.LEVEL_ADVANCED,
+                       condition='Alignment_refine',
+                       label='Disk budget for the kept files (GB)',
+                       help='If the kept intermediate files exceed this size, those of the oldest iterations are '
+                            'removed (0 for no budget).')
         group.addParam('ApplyAlignment', params.EnumParam,
                        label='Apply volume/subtomogam alignment?',
                        choices=['Yes'],
@@ -140,10 +181,26 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
 
         form.addSection(label='combined rigid-body & elastic alignment')
         group = form.addGroup('Optical flow parameters', condition='Alignment_refine')
+        group.addParam('flowBackend', params.EnumParam, default=BACKEND_GPU,
+                              choices=['GPU (farneback3d)', 'CPU (NumPy/SciPy)'],
+                              display=params.EnumParam.DISPLAY_HLIST,
+                              label='Compute the optical flows on',
+                              help='The CPU version runs the same algorithm with the same parameters on nodes without '
+                                   'a CUDA GPU (the cores of the node are shared by the parallel processes).')
         group.addParam('N_GPU', params.IntParam, default=3, important=True, allowsNull=True,
-                              label = 'Parallel processes on GPU',
+                              label = 'Parallel processes',
                               help='This parameter indicates the number of volumes that will be processed in parallel'
-                                   ' (independently). The more powerful your GPU, the higher the number you can choose.')
+                                   ' (independently). The more powerful your GPU, the higher the number you can choose.'
+                                   ' On the CPU, a few processes each using several cores is usually the fastest.')
+        group.addParam('flowEncoding', params.EnumParam, default=ENCODING_FULL,
+                              expertLevel=params.LEVEL_ADVANCED,
+                              choices=['Full volumes (float32)', 'Inside the mask (float32, lossless)',
+                                       'Inside the mask (float16)', 'Inside the mask (8 bits per value)'],
+                              label='Storage of the optical flows',
+                              help='The optical flows are zero outside the spherical mask, so keeping only the voxels '
+                                   'inside it makes them about 2 times smaller without any loss. Storing these voxels '
+                                   'as float16, or as 8-bit values quantized by blocks, makes them about 4 or 8 times '
+                                   'smaller than full volumes, with a small error that is printed for each flow.')
         group.addParam('pyr_scale', params.FloatParam, default=0.5,
                       label='pyr_scale', allowsNull=True,
                        help='parameter specifying the image scale to build pyramids for each image (pyr_scale < 1). '
@@ -171,6 +228,22 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
                       help='Standard deviation of the Gaussian that is used to smooth derivatives used as '
                            'a basis for the polynomial expansion; for poly_n = 5, you can set poly_sigma = 1.2,'
                            ' for poly_n = 7, a good value would be poly_sigma = 1.5.')
+        group.addParam('warmStart', params.BooleanParam, default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      condition='flowBackend==%d' % BACKEND_CPU,
+                      label='Start from the optical flows of the previous iteration?',
+                      help='From the second iteration, the optical flow of each volume starts from its flow in the '
+                           'previous iteration, moved by the refinement of its alignment. As the flows change little '
+                           'between iterations, fewer pyramid levels and iterations are then needed (only with the '
+                           'CPU optical flow).')
+        group.addParam('warmLevels', params.IntParam, default=1,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      condition='flowBackend==%d and warmStart' % BACKEND_CPU,
+                      label='levels (when starting from the previous flows)')
+        group.addParam('warmIterations', params.IntParam, default=3,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      condition='flowBackend==%d and warmStart' % BACKEND_CPU,
+                      label='iterations (when starting from the previous flows)')
         # This flag can be added later (when the Optical flow library is updated to include it)
         group.addHidden('flags', params.IntParam, default=0,
                       expertLevel=params.LEVEL_ADVANCED,
@@ -194,6 +267,7 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
                       label='Maximum shift for rigid body refinement (in pixels)',
                       help='The maximum shift is a number between 1 and half the size of your volume. '
                            'It represents the maximum distance searched in x,y and z directions.')
+        add_shard_params(form, condition='Alignment_refine')
 
         form.addParallelSection(threads=0, mpi=5)
 
@@ -211,11 +285,14 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
             N = self.NumOfIters.get()
             for i in range(1, N+1):
                 makePath(self._getExtraPath() + '/optical_flows_' + str(i))
-                if(self.FillWedge.get()):
-                    self._insertFunctionStep('fillMissingWedge', i)
-                self._insertFunctionStep('applyAlignment',i)
-                self._insertFunctionStep('calculateOpticalFlows',i)
-                self._insertFunctionStep('warpByFlow',i)
+                if self.fusedIteration.get():
+                    self._insertFunctionStep('fusedFlowStep', i)
+                else:
+                    if(self.FillWedge.get()):
+                        self._insertFunctionStep('fillMissingWedge', i)
+                    self._insertFunctionStep('applyAlignment',i)
+                    self._insertFunctionStep('calculateOpticalFlows',i)
+                    self._insertFunctionStep('warpByFlow',i)
                 self._insertFunctionStep('refineAlignment',i)
                 self._insertFunctionStep('combineRefinedAlignment',i)
                 self._insertFunctionStep('calculateNewAverage',i)
@@ -245,26 +322,7 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
         mdImgs = md.MetaData(imgFn)
         # in case of metadata from an external file, it has to be updated with the proper filenames from 'input.xmd'
         inputSet = self.inputVolumes.get()
-        for objId in mdImgs:
-            imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-            index, fn = xmipp3.convert.xmippToLocation(imgPath)
-            if (index):  # case the input is a stack
-                # Conside the index is the id in the input set
-                particle = inputSet[index]
-            else:  # input is not a stack
-                # convert the inputSet to metadata:
-                mdtemp = md.MetaData(self._getExtraPath('input.xmd'))
-                # Loop and find the index based on the basename:
-                bn_retrieved = basename(imgPath)
-                for searched_index in mdtemp:
-                    imgPath_temp = mdtemp.getValue(md.MDL_IMAGE, searched_index)
-                    bn_searched = basename(imgPath_temp)
-                    if bn_searched == bn_retrieved:
-                        index = searched_index
-                        particle = inputSet[index]
-                        break
-            mdImgs.setValue(md.MDL_IMAGE, xmipp3.convert.getImageLocation(particle), objId)
-            mdImgs.setValue(md.MDL_ITEM_ID, int(particle.getObjId()), objId)
+        reconcile_metadata(mdImgs, LocationIndex.from_set(inputSet))
         # Sorting here To avoid future problems
         mdImgs.sort()
         mdImgs.write(self.imgsFn)
@@ -296,46 +354,20 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
         else:
             imgFn = self._getExtraPath('combined_'+str(num-1)+'.xmd')
             STAVolume = self._getExtraPath('reference' + str(num) + '.spi')
-            # If this is not the first itration, remove the missing wedge filled data
-            print('keep files options is ',self.KeepFiles.get())
-            if(not(self.KeepFiles.get())):
-                cleanPath(self._getExtraPath() + '/mw_filled_' + str(num-1))
-
-
-        tiltLow = self.tiltLow.get()
-        tiltHigh = self.tiltHigh.get()
-
-        # creating a missing-wedge mask:
-        start_ang = tiltLow
-        end_ang = tiltHigh
-        size = self.inputVolumes.get().getDim()
-        MW_mask = np.ones(size)
-        x, z = np.mgrid[0.:size[0], 0.:size[2]]
-        x -= size[0] / 2
-        ind = np.where(x)
-        z -= size[2] / 2
-
-        angles = np.zeros(z.shape)
-        angles[ind] = np.arctan(z[ind] / x[ind]) * 180 / np.pi
 
-        angles = np.reshape(angles, (size[0], 1, size[2]))
-        angles = np.repeat(angles, size[1], axis=1)
 
-        MW_mask[angles > -start_ang] = 0
-        MW_mask[angles < -end_ang] = 0
-
-        MW_mask[size[0] // 2, :, :] = 0
-        MW_mask[size[0] // 2, :, size[2] // 2] = 1
-        fnmask = self._getExtraPath('Mask.spi')
-        save_volume(np.float32(MW_mask), fnmask)
-        runProgram('xmipp_transform_geometry', '-i ' + fnmask + ' --rotate_volume euler 0 90 0')
-        # Up to here, the missing wedge is created (this can be checked on the disk
-        # to see if the missing wedge corresponds or not to the data)
+        fnmask = self.createMissingWedgeMask()
 
         mdImgs = md.MetaData(imgFn)
         new_imgPath = self._getExtraPath() + '/mw_filled_' + str(num) + '/'
         makePath(new_imgPath)
-        # Missing wedge filling now
+        # Missing wedge filling now (the volumes completed before an interruption are skipped, unless the reference,
+        # the missing wedge or the volume changed)
+        journal = self.getJournal('mw_filled', num)
+        checksums = {}
+        common = ' '.join([self.contentKey(STAVolume, checksums), str(self.tiltLow.get()), str(self.tiltHigh.get()),
+                           str(self.getAngleY())])
+        print(journal.report(mdImgs.size()))
         for objId in mdImgs:
             imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
             index, fname = xmipp3.convert.xmippToLocation(imgPath)
@@ -344,10 +376,6 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
                 new_imgPath += str(index).zfill(6) + '.spi'
             else:
                 new_imgPath += basename(replaceBaseExt(basename(imgPath), 'spi'))
-            # Get a copy of the volume converted to spider format
-            params = '-i ' + imgPath + ' -o ' + new_imgPath + ' --type vol'
-            runProgram('xmipp_image_convert', params)
-            # print('xmipp_image_convert',params)
             # update the name in the metadata file
             mdImgs.setValue(md.MDL_IMAGE, new_imgPath, objId)
             # Align the reference with the subtomogram:
@@ -357,6 +385,14 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
             shiftx = str(mdImgs.getValue(md.MDL_SHIFT_X, objId))
             shifty = str(mdImgs.getValue(md.MDL_SHIFT_Y, objId))
             shiftz = str(mdImgs.getValue(md.MDL_SHIFT_Z, objId))
+            key = ' '.join([imgPath, self.contentKey(imgPath, checksums), common, rot, tilt, psi, shiftx, shifty,
+                            shiftz])
+            if journal.is_done(objId, new_imgPath, key):
+                continue
+            # Get a copy of the volume converted to spider format
+            params = '-i ' + imgPath + ' -o ' + new_imgPath + ' --type vol'
+            runProgram('xmipp_image_convert', params)
+            # print('xmipp_image_convert',params)
             # print(imgPath,rot,tilt,psi,shiftx,shifty,shiftz)
             params = '-i ' + STAVolume + ' -o ' + tempdir + '/temp.vol '
             params += '--rotate_volume euler ' + rot + ' ' + tilt + ' ' + psi + ' '
@@ -391,6 +427,7 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
             v_result = np.float32(ifft(I))
             #
             save_volume(v_result, new_imgPath)
+            journal.record(objId, new_imgPath, key)
 
             # for debugging, save everything that was aligned in the first iteration
             if objId == 1:
@@ -414,12 +451,14 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
             else:
                 mdImgs = md.MetaData(self._getExtraPath('combined_' + str(num - 1) + '.xmd'))
 
-        if(num != 1):
-            # If this is not the first itration, remove the previously aligned data
-            if (not (self.KeepFiles.get())):
-                cleanPath(self._getExtraPath() + '/aligned_' + str(num - 1))
-
 
+        # the volumes completed before an interruption are skipped, unless the volume, its alignment or the mask changed
+        journal = self.getJournal('aligned', num)
+        print(journal.report(mdImgs.size()))
+        checksums = {}
+        common = str(self.getAngleY())
+        if self.applyMask.get():
+            common += ' ' + self.contentKey(self.Mask.get().getFileName(), checksums)
         for objId in mdImgs:
             imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
             new_imgPath = self._getExtraPath() + '/aligned_'+str(num) + '/' + basename(imgPath)
@@ -430,6 +469,10 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
             shiftx = str(mdImgs.getValue(md.MDL_SHIFT_X, objId))
             shifty = str(mdImgs.getValue(md.MDL_SHIFT_Y, objId))
             shiftz = str(mdImgs.getValue(md.MDL_SHIFT_Z, objId))
+            key = ' '.join([imgPath, self.contentKey(imgPath, checksums), common, rot, tilt, psi, shiftx, shifty,
+                            shiftz])
+            if journal.is_done(objId, new_imgPath, key):
+                continue
 
             params = '-i ' + imgPath + ' -o ' + tempdir + '/temp.vol '
             # When we compensate for the missing wedge our software (FRM) doesn't have the same convention as XMIPP
@@ -453,16 +496,30 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
                 maskfn = self.Mask.get().getFileName()
                 params = '-i ' + new_imgPath + ' -o ' + new_imgPath + ' --mult ' + maskfn
                 runProgram('xmipp_image_operate', params)
+            journal.record(objId, new_imgPath, key)
 
         self.fnaligned = self._getExtraPath('volumes_aligned_'+str(num)+'.xmd')
         mdImgs.write(self.fnaligned)
+        # the missing wedge filled volumes are not needed anymore
+        if self.FillWedge.get():
+            self.getRetention().release(num, 'filled', self._getExtraPath() + '/mw_filled_' + str(num),
+                                        self.getItemNames(self._getExtraPath('MWFilled_' + str(num) + '.xmd')))
+
+
+    def fusedFlowStep(self, num):
+        # Fill the missing wedge, align, find the optical flow and warp the reference for each volume in one pass
+        self.calculateOpticalFlows(num, fused=True)
 
 
-    def calculateOpticalFlows(self, num):
+    def calculateOpticalFlows(self, num, fused=False):
         tempdir = self._getTmpPath()
         imgFn = self._getExtraPath('volumes_aligned_'+str(num)+'.xmd')
+        if fused:
+            # the volumes are aligned (and filled) by the workers, from the alignment of the previous iteration
+            imgFn = self.imgsFn if num == 1 else self._getExtraPath('combined_' + str(num - 1) + '.xmd')
 
         # in case it is the first iteration we only need the reference volume (metadata has to be for aligned volumes)
+        STAVolume = self._getExtraPath('reference' + str(num) + '.spi')
         if num == 1:
             StartingReference = self.StartingReference.get()
             ReferenceVolume = self.ReferenceVolume.get()
@@ -484,9 +541,6 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
 
         else:
             path_vol0 = self._getExtraPath('reference' + str(num) + '.spi')
-            # If this is not the first itration, remove the previous optical flows
-            if(not(self.KeepFiles.get())):
-                cleanPath(self._getExtraPath() + '/optical_flows_' + str(num - 1))
 
         pyr_scale = self.pyr_scale.get()
         levels = self.levels.get()
@@ -504,67 +558,97 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
         mdImgs = md.MetaData(imgFn)
         of_root = self._getExtraPath() + '/optical_flows_' + str(num) + '/'
 
-        # This is a spherical mask with maximum radius
+        # The reference is loaded once by each worker, the volumes are read directly (stacks or mrc files), and
+        # the flows are masked by a spherical mask with maximum radius before being saved in the flow store
         mask_size = int(self.getVolumeDimesion()//2)
-        # Parallel processing (finding multiple optical flows at the same time)
-        global segment
-        def segment(objId):
+        ids = [objId for objId in mdImgs]
+        store = open_flow_store(of_root, ids, np.shape(read_volume(path_vol0)), self.flowEncoding.get())
+        estVol_root = self._getExtraPath() + '/estimated_volumes_' + str(num) + '/'
+        if fused:
+            makePath(estVol_root)
+            flag = self.getAngleY() == 90
+        jobs = []
+        for objId in mdImgs:
+            slot = store.slot(objId)
+            warped_path = estVol_root + str(slot + 1).zfill(6) + '.spi'
+            if store.is_done(slot) and (not fused or isfile(warped_path)):
+                continue
             imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-            # getting a copy converted to spider format to solve the problem with stacks or mrc files
-            tmp = self._getTmpPath('tmp_' + str(objId) + '.spi')
-            runProgram('xmipp_image_convert', '-i ' + imgPath + ' -o ' + tmp + ' --type vol')
-
-            print('processing optical flow for volume ', objId)
-            path_flowx = of_root + str(objId).zfill(6) + '_opflowx.spi'
-            path_flowy = of_root + str(objId).zfill(6) + '_opflowy.spi'
-            path_flowz = of_root + str(objId).zfill(6) + '_opflowz.spi'
-            path_vol_i = tmp
-            if (isfile(path_flowx)):
-                return
+            if fused:
+                P = alignment_matrix(mdImgs.getValue(md.MDL_ANGLE_ROT, objId),
+                                     mdImgs.getValue(md.MDL_ANGLE_TILT, objId),
+                                     mdImgs.getValue(md.MDL_ANGLE_PSI, objId),
+                                     mdImgs.getValue(md.MDL_SHIFT_X, objId),
+                                     mdImgs.getValue(md.MDL_SHIFT_Y, objId),
+                                     mdImgs.getValue(md.MDL_SHIFT_Z, objId), flag)
+                jobs.append((objId, slot, imgPath, None, (P, warped_path)))
             else:
-                args = " %s %s %f %d %d %d %d %f %d %d %s %s %s" % (path_vol0, path_vol_i, pyr_scale, levels, winsize,
-                                                                   iterations, poly_n, poly_sigma, factor1, factor2,
-                                                                   path_flowx, path_flowy, path_flowz)
-                script_path = continuousflex.__path__[0] + '/protocols/utilities/optflow_run.py'
-                command = "python " + script_path + args
-                check_call(command, shell=True, stdout=sys.stdout, stderr=sys.stderr,
-                           env=None, cwd=None)
-
-                arg_x = "-i %s  --mask circular -%d --substitute 0  -o %s" % (path_flowx, mask_size, path_flowx)
-                arg_y = "-i %s  --mask circular -%d --substitute 0  -o %s" % (path_flowy, mask_size, path_flowy)
-                arg_z = "-i %s  --mask circular -%d --substitute 0  -o %s" % (path_flowz, mask_size, path_flowz)
-                runProgram('xmipp_transform_mask', arg_x)
-                runProgram('xmipp_transform_mask', arg_y)
-                runProgram('xmipp_transform_mask', arg_z)
-
-        # Running the multiple processing:
-        ps = [objId for objId in mdImgs]
-        Parallel(n_jobs=self.N_GPU.get(), backend="multiprocessing")(delayed(segment)(p) for p in ps)
+                jobs.append((objId, slot, imgPath))
+
+        # From the second iteration, start from the previous flows moved by the refined alignments: the volume
+        # aligned in this iteration is the previous one moved by the refinement matrix
+        warm_start = None
+        prev_root = self._getExtraPath() + '/optical_flows_' + str(num - 1) + '/'
+        if num != 1 and self.flowBackend.get() == BACKEND_CPU and self.warmStart.get() and \
+                isfile(flow_store_path(prev_root)):
+            prev_store = open_flow_store(prev_root)
+            mdRefined = md.MetaData(self._getExtraPath('refinement_' + str(num - 1) + '.xmd'))
+            T_r = read_alignments(mdRefined, [job[0] for job in jobs])
+            for i, job in enumerate(jobs):
+                jobs[i] = job[:3] + ((prev_store.slot(job[0]), T_r[i]),) + job[4:]
+            warm_start = (prev_store.path, self.warmLevels.get(), self.warmIterations.get())
+        steps = None
+        if fused:
+            steps = (STAVolume if self.FillWedge.get() else None,
+                     self.createMissingWedgeMask() if self.FillWedge.get() else None,
+                     self.Mask.get().getFileName() if self.applyMask.get() else None)
+        calculate_optical_flows(path_vol0, store.path, jobs, pyr_scale, levels, winsize, iterations, poly_n,
+                                poly_sigma, factor1, factor2, mask_radius=mask_size, n_jobs=self.N_GPU.get(),
+                                backend=self.flowBackend.get(), warm_start=warm_start, fused=steps,
+                                cache_dir=self._getTmpPath())
+        print(store.report())
+
+        if fused:
+            # the warped references are aligned by the refinement step
+            mdWarped = md.MetaData()
+            for i in range(1, len(store) + 1):
+                mdWarped.setValue(md.MDL_IMAGE, estVol_root + str(i).zfill(6) + '.spi', mdWarped.addObject())
+                mdWarped.setValue(md.MDL_ITEM_ID, i, i)
+            mdWarped.write(self._getExtraPath('warped_volumes_' + str(num) + '.xmd'))
+
+        # the aligned volumes of this iteration and the previous optical flows are not needed anymore
+        retention = self.getRetention()
+        if not fused:
+            retention.release(num, 'aligned', self._getExtraPath() + '/aligned_' + str(num), self.getItemNames(imgFn))
+        if num != 1 and os.path.exists(flow_store_path(prev_root)):
+            retention.release(num - 1, KIND_FLOWS, prev_root, self.getItemSlots(num - 1))
+        # nor the cached expansions of the reference of this iteration (CPU backend)
+        for fn in glob(self._getTmpPath('reference' + str(num) + '_pyramid_*.npz')):
+            os.remove(fn)
 
 
     def warpByFlow(self, num):
         makePath(self._getExtraPath() + '/estimated_volumes_' + str(num))
-        if num != 1:
-            if(not(self.KeepFiles.get())):
-                cleanPath(self._getExtraPath() + '/estimated_volumes_' + str(num-1))
         estVol_root = self._getExtraPath() + '/estimated_volumes_' + str(num) + '/'
         # reference = open_volume(self._getExtraPath('reference' + str(num) + '.spi'))
         reference = ImageHandler().read(self._getExtraPath('reference' + str(num) + '.spi')).getData()
-        # recount the number of volumes:
-        imgFn = self.imgsFn
-        mdImgs = md.MetaData(imgFn)
-
-        N = 0
-        for objId in mdImgs:
-            N += 1
+        store = open_flow_store(self._getExtraPath() + '/optical_flows_' + str(num) + '/')
+        N = len(store)
 
+        # the volumes completed before an interruption are skipped, unless their flow or the reference changed
+        journal = self.getJournal('warped', num)
+        print(journal.report(N))
+        reference_key = self.contentKey(self._getExtraPath('reference' + str(num) + '.spi'), {})
         mdWarped = md.MetaData()
         for i in range(1, N + 1):
-            print('Warping a copy of the reference volume by the optical flow ', i)
-            flow_i = self.read_optical_flow_by_number(i, op_path=self._getExtraPath() + '/optical_flows_' + str(num) + '/')
-            warped_i = farneback3d.warp_by_flow(reference, np.float32(flow_i))
+            flow_i = np.array(self.read_optical_flow_by_number(i, store))
             warped_path_i = estVol_root + str(i).zfill(6) + '.spi'
-            save_volume(warped_i, warped_path_i)
+            key = hashlib.blake2b(flow_i.tobytes(), digest_size=16).hexdigest() + ' ' + reference_key
+            if not journal.is_done(i, warped_path_i, key):
+                print('Warping a copy of the reference volume by the optical flow ', i)
+                warped_i = farneback_backend(self.flowBackend.get()).warp_by_flow(reference, flow_i)
+                save_volume(warped_i, warped_path_i)
+                journal.record(i, warped_path_i, key)
             mdWarped.setValue(md.MDL_IMAGE, warped_path_i, mdWarped.addObject())
             mdWarped.setValue(md.MDL_ITEM_ID, i, i)
         warpedVolFn = self._getExtraPath('warped_volumes_' + str(num) + '.xmd')
@@ -578,26 +662,22 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
         result = self._getExtraPath('refinement_'+str(num)+'.xmd')
         reference = self._getExtraPath('reference' + str(num) + '.spi')
         tempdir = self._getTmpPath()
-        args = "-i %(imgFn)s -o %(result)s --odir %(tempdir)s --resume --ref %(reference)s" \
-               " --frm_parameters %(frm_freq)f %(frm_maxshift)d "
-
-        self.runJob("xmipp_volumeset_align", args % locals(),
-                    env=Domain.importFromPlugin('xmipp3').Plugin.getEnviron())
+        args = "--ref %(reference)s --frm_parameters %(frm_freq)f %(frm_maxshift)d "
+        run_volumeset_align(self, imgFn, result, tempdir, args % locals(),
+                            self._getExtraPath('shards_refinement_' + str(num)))
 
         mdImgs = md.MetaData(result)
         inputSet = md.MetaData(imgFn)
-        # setting item_id (lost due to mpi) then sorting
-        for objId in mdImgs:
-            imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
-            # Conside the index is the id in the input set
-            for objId2 in inputSet:
-                NewImgPath = inputSet.getValue(md.MDL_IMAGE, objId2)
-                if (NewImgPath == imgPath):
-                    target_ID = inputSet.getValue(md.MDL_ITEM_ID, objId2)
-                    break
-            mdImgs.setValue(md.MDL_ITEM_ID, target_ID, objId)
+        # setting item_id (lost due to mpi) from the paths of the input
+        reconcile_metadata(mdImgs, LocationIndex.from_metadata(inputSet), update_paths=False)
         mdImgs.sort()
         mdImgs.write(result)
+        # the warped volumes (and the shards of the alignment) are not needed anymore
+        retention = self.getRetention()
+        retention.release(num, 'warped', self._getExtraPath() + '/estimated_volumes_' + str(num),
+                          {item: str(slot + 1).zfill(6) + '.spi' for item, slot in self.getItemSlots(num).items()})
+        retention.release(num, 'shards', self._getExtraPath('shards_refinement_' + str(num)))
+        print(retention.report())
 
 
     def combineRefinedAlignment(self, num):
@@ -608,55 +688,26 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
             MD_original = md.MetaData(self._getExtraPath('combined_'+str(num-1)+'.xmd'))
 
         MD_refined = md.MetaData(self._getExtraPath('refinement_'+str(num)+'.xmd'))
-        # This metadata will be populated and saved
+        # 2- find the transformation matrices of all the volumes at once
+        ids = [objId for objId in MD_original]
+        T_o = read_alignments(MD_original, ids)
+        T_r = read_alignments(MD_refined, ids)
+        # 3- multiply the matrices
+        if self.getAngleY() == 90:
+            # In this case the refinement matrix should be inverted (because the refined alignment does not have
+            # missing wedge correction)
+            T = compose(invert(T_r), T_o)
+        else:
+            # In this case the refinement matrix should be used as it is (as for both the previous and refined do not
+            # have missing wedge correction)
+            T = compose(T_o, T_r)
+        # Populate the metadata
         MD_combined = md.MetaData()
-        # Iteratively:
-        # 2- find the transformation matrices
-        for objId in MD_original:
-            rot_o = MD_original.getValue(md.MDL_ANGLE_ROT, objId)
-            tilt_o = MD_original.getValue(md.MDL_ANGLE_TILT, objId)
-            psi_o = MD_original.getValue(md.MDL_ANGLE_PSI, objId)
-            shiftx_o = MD_original.getValue(md.MDL_SHIFT_X, objId)
-            shifty_o = MD_original.getValue(md.MDL_SHIFT_Y, objId)
-            shiftz_o = MD_original.getValue(md.MDL_SHIFT_Z, objId)
-
-            rot_r = MD_refined.getValue(md.MDL_ANGLE_ROT, objId)
-            tilt_r = MD_refined.getValue(md.MDL_ANGLE_TILT, objId)
-            psi_r = MD_refined.getValue(md.MDL_ANGLE_PSI, objId)
-            shiftx_r = MD_refined.getValue(md.MDL_SHIFT_X, objId)
-            shifty_r = MD_refined.getValue(md.MDL_SHIFT_Y, objId)
-            shiftz_r = MD_refined.getValue(md.MDL_SHIFT_Z, objId)
-
-            T_o = self.eulerAngles2matrix(rot_o, tilt_o, psi_o, shiftx_o, shifty_o, shiftz_o)
-            T_r = self.eulerAngles2matrix(rot_r, tilt_r, psi_r, shiftx_r, shifty_r, shiftz_r)
-
-            # 3- multiply the matrices
-            if self.getAngleY() == 90:
-                # In this case the refinement matrix should be inverted (because the refined alignment does not have
-                # missing wedge correction)
-                T_r_inv = np.linalg.inv(T_r)
-                T = np.matmul(T_r_inv,T_o)
-            else:
-                # In this case the refinement matrix should be used as it is (as for both the previous and refined do not
-                # have missing wedge correction)
-                T = np.matmul(T_o, T_r)
-
-            rot_i, tilt_i, psi_i, x_i, y_i, z_i = self.matrix2eulerAngles(T)
-
-            # Populate the metadata
-            name_i = MD_original.getValue(md.MDL_IMAGE, objId)
-            MD_combined.setValue(md.MDL_IMAGE, name_i, MD_combined.addObject())
-            MD_combined.setValue(md.MDL_ANGLE_ROT, rot_i, objId)
-            MD_combined.setValue(md.MDL_ANGLE_TILT, tilt_i, objId)
-            MD_combined.setValue(md.MDL_ANGLE_PSI, psi_i, objId)
-            MD_combined.setValue(md.MDL_SHIFT_X, float(x_i), objId)
-            MD_combined.setValue(md.MDL_SHIFT_Y, float(y_i), objId)
-            MD_combined.setValue(md.MDL_SHIFT_Z, float(z_i), objId)
-            if self.getAngleY() == 90:
-                MD_combined.setValue(md.MDL_ANGLE_Y, 90.0, objId)
-            else:
-                MD_combined.setValue(md.MDL_ANGLE_Y, 0.0, objId)
-            MD_combined.setValue(md.MDL_ITEM_ID, objId, objId)
+        for objId in ids:
+            MD_combined.setValue(md.MDL_IMAGE, MD_original.getValue(md.MDL_IMAGE, objId), MD_combined.addObject())
+        write_alignments(MD_combined, T)
+        MD_combined.setColumnValues(md.MDL_ANGLE_Y, [90.0 if self.getAngleY() == 90 else 0.0] * len(ids))
+        MD_combined.setColumnValues(md.MDL_ITEM_ID, ids)
         # Save the metadata
         MD_combined.write(self._getExtraPath('combined_'+str(num)+'.xmd'))
 
@@ -668,53 +719,25 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
         volumesMd = self._getExtraPath('combined_'+str(num)+'.xmd')
         mdVols = md.MetaData(volumesMd)
 
-        counter = 0 # this is used to find the sum/number_of_volumes
-        first = True
+        # partial sums of the aligned volumes by subsets of item ids (only the subsets that changed are summed again)
+        jobs = []
+        ids = []
         for objId in mdVols:
-            counter = counter + 1
-            imgPath = mdVols.getValue(md.MDL_IMAGE, objId)
-            rot = mdVols.getValue(md.MDL_ANGLE_ROT, objId)
-            tilt = mdVols.getValue(md.MDL_ANGLE_TILT, objId)
-            psi = mdVols.getValue(md.MDL_ANGLE_PSI, objId)
-            x_shift = mdVols.getValue(md.MDL_SHIFT_X, objId)
-            y_shift = mdVols.getValue(md.MDL_SHIFT_Y, objId)
-            z_shift = mdVols.getValue(md.MDL_SHIFT_Z, objId)
-
-            # The new reference is for the next iteration
-            outputVol = self._getExtraPath('reference' + str(num+1) + '.spi')
-            tempVol = self._getExtraPath('temp.vol')
-            extra = self._getExtraPath()
-
-            if flag == 0 :
-                params = '-i %(imgPath)s -o %(tempVol)s --inverse --rotate_volume euler %(rot)s %(tilt)s %(psi)s' \
-                         ' --shift %(x_shift)s %(y_shift)s %(z_shift)s -v 0' % locals()
-
-            else:
-                # First got to rotate each volume 90 degrees about the y axis, align it, then sum it
-                params = '-i %(imgPath)s -o %(tempVol)s --rotate_volume euler 0 90 0' % locals()
-                runProgram('xmipp_transform_geometry', params)
-                params = '-i %(tempVol)s -o %(tempVol)s --rotate_volume euler %(rot)s %(tilt)s %(psi)s' \
-                         ' --shift %(x_shift)s %(y_shift)s %(z_shift)s ' % locals()
-
-            runProgram('xmipp_transform_geometry', params)
-
-            if counter == 1 :
-                os.system("mv %(tempVol)s %(outputVol)s" % locals())
-
-            else:
-                params = '-i %(tempVol)s --plus %(outputVol)s -o %(outputVol)s ' % locals()
-                runProgram('xmipp_image_operate', params)
-
-        params = '-i %(outputVol)s --divide %(counter)s -o %(outputVol)s ' % locals()
-        runProgram('xmipp_image_operate', params)
-
-        # if there is a mask, then apply it:
-        if (self.applyMask.get()):
-            maskfn = self.Mask.get().getFileName()
-            params = '-i ' + outputVol + ' -o ' + outputVol + ' --mult ' + maskfn
-            runProgram('xmipp_image_operate', params)
-
-        os.system("rm -f %(tempVol)s" % locals())
+            P = alignment_matrix(mdVols.getValue(md.MDL_ANGLE_ROT, objId),
+                                 mdVols.getValue(md.MDL_ANGLE_TILT, objId),
+                                 mdVols.getValue(md.MDL_ANGLE_PSI, objId),
+                                 mdVols.getValue(md.MDL_SHIFT_X, objId),
+                                 mdVols.getValue(md.MDL_SHIFT_Y, objId),
+                                 mdVols.getValue(md.MDL_SHIFT_Z, objId), flag)
+            jobs.append((mdVols.getValue(md.MDL_IMAGE, objId), P))
+            ids.append(mdVols.getValue(md.MDL_ITEM_ID, objId))
+        partials = partial_sums(subsets_by_id(jobs, ids, PARTIAL_SUBSET), self._getExtraPath('partial_sums'),
+                                n_jobs=self.numberOfMpi.get())
+
+        # The new reference is for the next iteration, if there is a mask, then it is applied
+        mask = read_volume(self.Mask.get().getFileName()) if self.applyMask.get() else None
+        outputVol = self._getExtraPath('reference' + str(num+1) + '.spi')
+        save_volume(merge_partials(partials, mask), outputVol)
 
 
     def createOutputStep(self, num =0):
@@ -743,30 +766,11 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
         pass
 
     # --------------------------- UTILS functions --------------------------------------------
-    def read_optical_flow(self, path_flowx, path_flowy, path_flowz):
-        # x = open_volume(path_flowx)
-        x = ImageHandler().read(path_flowx).getData()
-        # y = open_volume(path_flowy)
-        y = ImageHandler().read(path_flowy).getData()
-        # z = open_volume(path_flowz)
-        z = ImageHandler().read(path_flowz).getData()
-
-        l = np.shape(x)
-        # print(l)
-        flow = np.zeros([3, l[0], l[1], l[2]])
-        flow[0, :, :, :] = x
-        flow[1, :, :, :] = y
-        flow[2, :, :, :] = z
-        return flow
-
-    def read_optical_flow_by_number(self, num, op_path = None):
-        if op_path is None:
-            op_path = self._getExtraPath() + '/optical_flows/'
-        path_flowx = op_path + str(num).zfill(6) + '_opflowx.spi'
-        path_flowy = op_path + str(num).zfill(6) + '_opflowy.spi'
-        path_flowz = op_path + str(num).zfill(6) + '_opflowz.spi'
-        flow = self.read_optical_flow(path_flowx, path_flowy, path_flowz)
-        return flow
+    def read_optical_flow_by_number(self, num, store=None):
+        """ Flow of the volume number num (starting from 1) as a float32 memory-mapped view. """
+        if store is None:
+            store = open_flow_store(self._getExtraPath() + '/optical_flows/')
+        return store[num - 1]
 
     def _printWarnings(self, *lines):
         """ Print some warning lines to 'warnings.xmd',
@@ -776,6 +780,53 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
             print >> fWarn, l
         fWarn.close()
 
+    def getJournal(self, stage, num):
+        return CheckpointJournal(self._getExtraPath('checkpoints', '%s_%d.journal' % (stage, num)))
+
+    def contentKey(self, path, checksums):
+        """ Checksum of the file of a volume (of the whole stack for 'index@stack'), cached in checksums """
+        fn = xmipp3.convert.xmippToLocation(path)[1]
+        if fn not in checksums:
+            checksums[fn] = file_checksum(fn)
+        return checksums[fn]
+
+    def getItemNames(self, fnMd):
+        """ File name of the volume of each item id of a metadata (to keep the same sampled volumes) """
+        mdImgs = md.MetaData(fnMd)
+        return {mdImgs.getValue(md.MDL_ITEM_ID, objId): basename(mdImgs.getValue(md.MDL_IMAGE, objId))
+                for objId in mdImgs}
+
+    def getItemSlots(self, num):
+        """ Slot of the optical flow (and of the warped reference) of each item id in the iteration num """
+        if self.fusedIteration.get():
+            imgFn = self.imgsFn if num == 1 else self._getExtraPath('combined_' + str(num - 1) + '.xmd')
+        else:
+            imgFn = self._getExtraPath('volumes_aligned_' + str(num) + '.xmd')
+        mdImgs = md.MetaData(imgFn)
+        store = open_flow_store(self._getExtraPath() + '/optical_flows_' + str(num) + '/')
+        return {mdImgs.getValue(md.MDL_ITEM_ID, objId): store.slot(objId) for objId in mdImgs}
+
+    def getRetention(self):
+        """ Manager of the intermediate files of the iterations (see utilities/retention.py) """
+        return RetentionManager(self._getExtraPath('retention.json'), self.retentionPolicy.get(),
+                                last=self.retainLast.get(), sample=self.retainSample.get(),
+                                budget=int(self.retentionBudget.get() * 1024 ** 3),
+                                compress=self.retentionCompress.get())
+
+    def createMissingWedgeMask(self):
+        """ Missing wedge mask (1 where the Fourier coefficients are measured, centered) written in Mask.spi """
+        tiltLow = self.tiltLow.get()
+        tiltHigh = self.tiltHigh.get()
+
+        # creating a missing-wedge mask (see utilities/missing_wedge.py):
+        # the dimensions are (X, Y, Z), the mask is (Z, Y, X)
+        size = self.inputVolumes.get().getDim()
+        fnmask = self._getExtraPath('Mask.spi')
+        save_volume(np.float32(wedge_mask(size[::-1], (tiltLow, tiltHigh))), fnmask)
+        # Up to here, the missing wedge is created (this can be checked on the disk
+        # to see if the missing wedge corresponds or not to the data)
+        return fnmask
+
     def getAngleY(self):
         AlignmentParameters = self.AlignmentParameters.get()
         MetaDataFile = self.MetaDataFile.get()
@@ -793,63 +844,3 @@ class FlexProtRefineSubtomoAlign(ProtAnalysis3D):
 
     def getVolumeDimesion(self):
         return self.inputVolumes.get().getDimensions()[0]
-
-    def matrix2eulerAngles(self, A):
-        abs_sb = np.sqrt(A[0, 2] * A[0, 2] + A[1, 2] * A[1, 2])
-        if (abs_sb > 16 * np.exp(-5)):
-            gamma = math.atan2(A[1, 2], -A[0, 2])
-            alpha = math.atan2(A[2, 1], A[2, 0])
-            if (abs(np.sin(gamma)) < np.exp(-5)):
-                sign_sb = np.sign(-A[0, 2] / np.cos(gamma))
-            else:
-                if np.sin(gamma) > 0:
-                    sign_sb = np.sign(A[1, 2])
-                else:
-                    sign_sb = -np.sign(A[1, 2])
-            beta = math.atan2(sign_sb * abs_sb, A[2, 2])
-        else:
-            if (np.sign(A[2, 2]) > 0):
-                alpha = 0
-                beta = 0
-                gamma = math.atan2(-A[1, 0], A[0, 0])
-            else:
-                alpha = 0
-                beta = np.pi
-                gamma = math.atan2(A[1, 0], -A[0, 0])
-        gamma = np.rad2deg(gamma)
-        beta = np.rad2deg(beta)
-        alpha = np.rad2deg(alpha)
-        return alpha, beta, gamma, A[0, 3], A[1, 3], A[2, 3]
-
-
-    def eulerAngles2matrix(self, alpha, beta, gamma, shiftx, shifty, shiftz):
-        A = np.empty([4, 4])
-        A.fill(2)
-        A[3, 3] = 1
-        A[3, 0:3] = 0
-        A[0, 3] = float(shiftx)
-        A[1, 3] = float(shifty)
-        A[2, 3] = float(shiftz)
-        alpha = float(alpha)
-        beta = float(beta)
-        gamma = float(gamma)
-        sa = np.sin(np.deg2rad(alpha))
-        ca = np.cos(np.deg2rad(alpha))
-        sb = np.sin(np.deg2rad(beta))
-        cb = np.cos(np.deg2rad(beta))
-        sg = np.sin(np.deg2rad(gamma))
-        cg = np.cos(np.deg2rad(gamma))
-        cc = cb * ca
-        cs = cb * sa
-        sc = sb * ca
-        ss = sb * sa
-        A[0, 0] = cg * cc - sg * sa
-        A[0, 1] = cg * cs + sg * ca
-        A[0, 2] = -cg * sb
-        A[1, 0] = -sg * cc - cg * sa
-        A[1, 1] = -sg * cs + cg * ca
-        A[1, 2] = sg * sb
-        A[2, 0] = sc
-        A[2, 1] = ss
-        A[2, 2] = cb
-        return A
\ No newline at end of file
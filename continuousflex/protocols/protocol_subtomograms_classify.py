@@ -24,23 +24,27 @@ from pyworkflow.object import String
 from pyworkflow.protocol.params import (PointerParam, EnumParam, IntParam)
 from pwem.protocols import ProtAnalysis3D
 from pwem.convert import cifToPdb
-from pyworkflow.utils.path import makePath, copyFile, removeBaseExt
+from pyworkflow.utils.path import makePath, copyFile
 from pyworkflow.protocol import params
 
 from .protocol_subtomogram_averaging import FlexProtSubtomogramAveraging
-from sklearn.cluster import AgglomerativeClustering, KMeans
-import time
+from sklearn.cluster import AgglomerativeClustering, KMeans, MiniBatchKMeans
+from sklearn.neighbors import kneighbors_graph
 import os
-from sh_alignment.tompy.transform import fft, ifft, fftshift, ifftshift
 import pwem.emlib.metadata as md
-from continuousflex.protocols.utilities.spider_files3 import save_volume, open_volume
+from continuousflex.protocols.utilities.spider_files3 import save_volume
+from continuousflex.protocols.utilities.volume_average import volume_statistics, pooled_statistics, alignment_matrix
+from continuousflex.protocols.utilities.missing_wedge import wedge_mask, RotatedWedge
+from continuousflex.protocols.utilities.spectral_cc import SpectrumStore, correlation_matrix, \
+    neighbor_correlation_matrix
+from continuousflex.protocols.utilities.block_svd import BlockTruncatedSVD
 import xmipp3
 
 from pwem.objects import Volume
 import numpy as np
 import glob
 from sklearn import decomposition
-from joblib import dump, load
+from joblib import dump
 from pwem.utils import runProgram
 
 
@@ -65,6 +69,25 @@ class FlexProtSubtomoClassify(ProtAnalysis3D):
                       pointerClass='FlexProtSubtomogramAveraging',
                       label="StA protocol",
                       help='Choose a subtomogram averaging previous run')
+        form.addParam('correlationMode', EnumParam, default=0,
+                      label='Correlated pairs',
+                      choices=['All pairs', 'Nearest neighbors'],
+                      help='All pairs: the constrained cross correlation of every pair of subtomograms (N x N). '
+                           'Nearest neighbors: for large sets, the correlation is computed only between each '
+                           'subtomogram and its nearest candidates (found by comparing the low frequencies), which '
+                           'gives a sparse matrix. The classes are then found from a spectral embedding of this '
+                           'sparse matrix (the dimensionality reduction method is not used), and the hierarchical '
+                           'clustering only merges clusters linked in the graph of neighbors.')
+        form.addParam('nCandidates', IntParam, default=30,
+                      condition='correlationMode == 1',
+                      label='Number of candidate neighbors',
+                      help='Number of candidates of each subtomogram whose correlation is computed')
+        form.addParam('signatureRadius', IntParam, default=8,
+                      condition='correlationMode == 1',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Frequency of the signatures (voxels)',
+                      help='The candidate neighbors are found by comparing the Fourier coefficients of the '
+                           'subtomograms up to this frequency (in Fourier voxels)')
         form.addParam('classifyTechnique', EnumParam, default=0,
                       label='Classification techinque',
                       choices=['Hierarchical clustering', 'Dimentionality reduction then Clustering'],
@@ -72,12 +95,36 @@ class FlexProtSubtomoClassify(ProtAnalysis3D):
         form.addParam('ClusteringLinkage', EnumParam, default=0,
                       label='Linkage',
                       condition='classifyTechnique == 0',
-                      choices=['ward'])
+                      choices=['ward', 'ward with kNN connectivity'],
+                      help='ward: Ward clustering of the rows of the matrix (it needs the whole matrix in memory). '
+                           'ward with kNN connectivity: the rows are first reduced in dimension, and only the '
+                           'clusters linked in the graph of the nearest neighbors are merged (for large sets).')
+        form.addParam('nNeighbors', IntParam, default=15,
+                      condition='classifyTechnique == 0 and ClusteringLinkage == 1',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Number of neighbors',
+                      help='Number of nearest neighbors of each subtomogram in the connectivity graph')
         form.addParam('dimredMethod', EnumParam, default=0,
-                      condition='classifyTechnique == 1',
-                      choices=['Scikit-Learn PCA'],
+                      condition='classifyTechnique == 1 or (classifyTechnique == 0 and ClusteringLinkage == 1)',
+                      choices=['Scikit-Learn PCA', 'Incremental PCA', 'Randomized SVD'],
                       label='Dimensionality reduction method',
-                      help='This method will be used to reduce the dimensions of the covariance matrix')
+                      help='This method will be used to reduce the dimensions of the covariance matrix. '
+                           'Scikit-Learn PCA loads the whole matrix in memory. '
+                           'Incremental PCA and randomized SVD read the matrix by blocks of rows from the disk, '
+                           'without loading it in memory (for large sets), they are needed by the ward with kNN '
+                           'connectivity and by the mini-batch KMeans.')
+        form.addParam('clusteringMethod', EnumParam, default=0,
+                      condition='classifyTechnique == 1',
+                      choices=['KMeans', 'Mini-batch KMeans'],
+                      label='Clustering method',
+                      help='Mini-batch KMeans updates the clusters with random batches of subtomograms (for large '
+                           'sets).')
+        form.addParam('batchSize', IntParam, default=1024,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      condition='classifyTechnique == 1 or (classifyTechnique == 0 and ClusteringLinkage == 1)',
+                      label='Batch size',
+                      help='Number of rows of the matrix read at once by Incremental PCA, and number of '
+                           'subtomograms in each batch of Mini-batch KMeans')
         form.addParam('applyMask', params.BooleanParam, label='Use a mask?', default=False,
                        help='This mask will be applied on the aligned particles before finding the cross correlation'
                             ', a proper mask is a mask derived from the subtomogram average (tight), that can be '
@@ -87,11 +134,12 @@ class FlexProtSubtomoClassify(ProtAnalysis3D):
                        pointerClass='Volume', allowsNull=True,
                        label="Select mask")
         form.addParam('reducedDim', IntParam, default=2,
-                      condition='classifyTechnique == 1',
+                      condition='classifyTechnique == 1 or (classifyTechnique == 0 and (ClusteringLinkage == 1 or '
+                                'correlationMode == 1))',
                       label='Reduced dimension')
         form.addParam('numOfClasses', IntParam, default=2,
                       label='Number of classes')
-        # form.addParallelSection(threads=0, mpi=8)
+        form.addParallelSection(threads=0, mpi=8)
 
         # --------------------------- INSERT steps functions --------------------------------------------
     def _insertAllSteps(self):
@@ -108,34 +156,12 @@ class FlexProtSubtomoClassify(ProtAnalysis3D):
 
     # --------------------------- STEPS functions --------------------------------------------
     def subtomo_wedge_align(self,mdSubtomo):
-        # we align the subtomograms but we align also a missing wedge mask for each one
-        tilt = self.getTiltRange()
-        # Creating a missing wedge mask:
-        start_ang = tilt[0]
-        end_ang = tilt[1]
-        leg = self.getVolumeSize()
-        size = (leg, leg, leg)
-        MW_mask = np.ones(size)
-        x, z = np.mgrid[0.:size[0], 0.:size[2]]
-        x -= size[0] / 2
-        ind = np.where(x)
-        z -= size[2] / 2
-        angles = np.zeros(z.shape)
-        angles[ind] = np.arctan(z[ind] / x[ind]) * 180 / np.pi
-        angles = np.reshape(angles, (size[0], 1, size[2]))
-        angles = np.repeat(angles, size[1], axis=1)
-        MW_mask[angles > -start_ang] = 0
-        MW_mask[angles < -end_ang] = 0
-        MW_mask[size[0] // 2, :, :] = 0
-        MW_mask[size[0] // 2, :, size[2] // 2] = 1
+        # we align the subtomograms, the missing wedge mask of each one is computed when it is needed from the
+        # tilt range and its alignment (see utilities/missing_wedge.py), only the unaligned mask is written
         fnmask = self._getExtraPath('missing_wedge.spi')
-        save_volume(np.float32(MW_mask), fnmask)
-        args = ' -i ' + fnmask + ' --rotate_volume euler 0 90 0'
-        runProgram('xmipp_transform_geometry',args)
-        # Now aligning each subtomogram and its missing wedge version
-        mw_path = self._getExtraPath('mw_masks/')
+        save_volume(np.float32(wedge_mask(self.getVolumeSize(), self.getTiltRange())), fnmask)
+        # Now aligning each subtomogram
         subtom_aligned_path = self._getExtraPath('aligned_subtomograms/')
-        makePath(mw_path)
         makePath(subtom_aligned_path)
         subtomogramMD = md.MetaData(mdSubtomo)
         subtomogaligneMD = md.MetaData()
@@ -143,11 +169,8 @@ class FlexProtSubtomoClassify(ProtAnalysis3D):
         for i in subtomogramMD:
             fnsubtomo = subtomogramMD.getValue(md.MDL_IMAGE, i)
             bnsubtomo = os.path.basename(fnsubtomo)
-            bnwedge = removeBaseExt(bnsubtomo)+'_wedge.spi'
             fnalignedsubtomo = self._getExtraPath('aligned_subtomograms/'+bnsubtomo)
-            fnalignedmask = self._getExtraPath('mw_masks/'+bnwedge)
             # print(fnalignedsubtomo)
-            # print(fnalignedmask)
             rot = str(subtomogramMD.getValue(md.MDL_ANGLE_ROT, i))
             tilt = str(subtomogramMD.getValue(md.MDL_ANGLE_TILT, i))
             psi = str(subtomogramMD.getValue(md.MDL_ANGLE_PSI, i))
@@ -170,26 +193,18 @@ class FlexProtSubtomoClassify(ProtAnalysis3D):
 
             runProgram('xmipp_transform_geometry', params)
 
-            # align the mask (no shift should be applied only angles)
-            if self.getAngleY() == 90:
-                args = '-i ' + fnmask + ' -o ' + fnalignedmask + ' --rotate_volume euler 0 90 0'
-                runProgram('xmipp_transform_geometry', args)
-                params = '-i ' + fnalignedmask + ' -o ' + fnalignedmask + ' '
-            else:
-                params = '-i ' + fnmask + ' -o ' + fnalignedmask + ' '
-                params += ' --inverse '
-
-            params += '--rotate_volume euler ' + rot + ' ' + tilt + ' ' + psi + ' '
-
-            runProgram('xmipp_transform_geometry', params)
-
             if (self.applyMask):
                 maskfn = self.Mask.get().getFileName()
                 params = '-i ' + fnalignedsubtomo + ' -o ' + fnalignedsubtomo + ' --mult ' + maskfn
                 runProgram('xmipp_image_operate', params)
 
             subtomogaligneMD.setValue(md.MDL_IMAGE, fnalignedsubtomo, subtomogaligneMD.addObject())
-            mwalignedMD.setValue(md.MDL_IMAGE, fnalignedmask, mwalignedMD.addObject())
+            # the alignment of the missing wedge mask (no shift should be applied only angles)
+            objId = mwalignedMD.addObject()
+            mwalignedMD.setValue(md.MDL_ANGLE_ROT, float(rot), objId)
+            mwalignedMD.setValue(md.MDL_ANGLE_TILT, float(tilt), objId)
+            mwalignedMD.setValue(md.MDL_ANGLE_PSI, float(psi), objId)
+            mwalignedMD.setValue(md.MDL_ANGLE_Y, float(self.getAngleY()), objId)
         subtomogaligneMD.write(self._getExtraPath('aligned_subtomograms.xmd'))
         mwalignedMD.write(self._getExtraPath('aligned_masks.xmd'))
 
@@ -197,97 +212,65 @@ class FlexProtSubtomoClassify(ProtAnalysis3D):
 
 
     def find_covariance_matrix(self):
-        # if the covariance matrix exists, we should not re-evaluate it (it takes long time)
-        fn_covarmat = self._getExtraPath('covar_mat.pkl')
-        if os.path.exists(fn_covarmat):
-            pass
+        # the matrix is computed by tiles, and the tiles completed by a previous run are not computed again
         subtomogaligneMD= md.MetaData(self._getExtraPath('aligned_subtomograms.xmd'))
         mwalignedMD= md.MetaData(self._getExtraPath('aligned_masks.xmd'))
         N = subtomogaligneMD.size()
-        X = np.zeros([N, N])
         print(N)
-        A = time.time()
-        for i in subtomogaligneMD:
-            if i == 2:
-                B = time.time()-A
-                print('estimated time to finish is ', B*N/2)
-            name_i = subtomogaligneMD.getValue(md.MDL_IMAGE, i)
-            wedge_i = mwalignedMD.getValue(md.MDL_IMAGE, i)
-            Vi = open_volume(name_i)
-            Wi = open_volume(wedge_i)
-            print('line is', str(i),' out of ',str(N))
-            for j in range(i,N+1):
-                name_j = subtomogaligneMD.getValue(md.MDL_IMAGE, j)
-                wedge_j = mwalignedMD.getValue(md.MDL_IMAGE, j)
-                Vj = open_volume(name_j)
-                Wj = open_volume(wedge_j)
-                Omega = Wi * Wj
-                FVi = fft(Vi)
-                FVi = fftshift(FVi) * Omega
-                FVi = ifftshift(FVi)
-                Vi_p = ifft(FVi)
-                FVj = fft(Vj)
-                FVj = fftshift(FVj) * Omega
-                FVj = ifftshift(FVj)
-                Vj_p = ifft(FVj)
-                Vi_p = np.array(Vi_p, dtype=np.float32)
-                Vj_p = np.array(Vj_p, dtype=np.float32)
-                X[i-1, j-1] = self.cc(Vi_p, Vj_p)
-                X[j-1, i-1] = self.cc(Vj_p, Vi_p)
-        # save the covariance matrix:
-        dump(X, fn_covarmat)
+        # the spectra of the subtomograms and of their masks are computed once, then each pair is correlated in
+        # Fourier space (see spectral_cc.py)
+        folder = self._getExtraPath('spectra')
+        size = self.getVolumeSize()
+        tilt = self.getTiltRange()
+        wedges = [RotatedWedge(size, tilt, alignment_matrix(mwalignedMD.getValue(md.MDL_ANGLE_ROT, i),
+                                                            mwalignedMD.getValue(md.MDL_ANGLE_TILT, i),
+                                                            mwalignedMD.getValue(md.MDL_ANGLE_PSI, i), 0, 0, 0,
+                                                            mwalignedMD.getValue(md.MDL_ANGLE_Y, i) == 90))
+                  for i in mwalignedMD]
+        # the nearest neighbors mode keeps no spectra on the disk, they are computed for the pairs of neighbors
+        SpectrumStore.create(folder, [subtomogaligneMD.getValue(md.MDL_IMAGE, i) for i in subtomogaligneMD], wedges,
+                             spectra=self.correlationMode.get() == 0)
+        if self.correlationMode.get() == 1:
+            # sparse matrix of the pairs of neighbors, kept in the folder of the spectra
+            neighbor_correlation_matrix(folder, self.nCandidates.get(), self.signatureRadius.get(),
+                                        n_jobs=self.numberOfMpi.get())
+            return
+        # the matrix stays on the disk (spectra/covar_mat.npy), see getCorrelationMatrix
+        correlation_matrix(folder, n_jobs=self.numberOfMpi.get())
 
     def performHierarchicalClustering(self):
-        fn_covarmat = self._getExtraPath('covar_mat.pkl')
-        data = load(fn_covarmat)
-        # 1 - CCCij (to keep with the literature)
-        data = np.ones_like(data) - data
-        clustering = AgglomerativeClustering(n_clusters=self.numOfClasses.get(), linkage='ward')
+        if self.correlationMode.get() == 1:
+            # Ward on the spectral embedding, merging only the clusters linked in the graph of neighbors
+            data = self.reduceDimensions()
+            clustering = AgglomerativeClustering(n_clusters=self.numOfClasses.get(), linkage='ward',
+                                                 connectivity=self.getNeighborMatrix())
+        elif self.ClusteringLinkage.get() == 0:
+            # 1 - CCCij (to keep with the literature), ward needs the whole matrix in memory
+            data = 1 - self.getCorrelationMatrix()
+            clustering = AgglomerativeClustering(n_clusters=self.numOfClasses.get(), linkage='ward')
+        else:
+            # Ward on the reduced rows, merging only the clusters linked in the kNN graph
+            data = self.reduceDimensions()
+            connectivity = kneighbors_graph(data, n_neighbors=min(self.nNeighbors.get(), len(data) - 1),
+                                            include_self=False)
+            clustering = AgglomerativeClustering(n_clusters=self.numOfClasses.get(), linkage='ward',
+                                                 connectivity=connectivity)
         clustering_class = clustering.fit_predict(data)
         labels = clustering.labels_
         # for l in np.unique(label):
         #     print(len(data[label == l]))
         dump(labels, filename=self._getExtraPath('hierarchical_clustering_labels.pkl'))
         print(clustering_class)
-        # creating a metadate of subtomograms for each class and an average
-        N = self.getVolumeSize()
-        Averages = np.zeros([N, N, N, self.numOfClasses.get()])
-        subtomogaligneMD = md.MetaData(self._getExtraPath('aligned_subtomograms.xmd'))
-        # creating a metadata for each class
-        classesMD = [md.MetaData() for i in range(self.numOfClasses.get())]
-        for i in subtomogaligneMD:
-            name = subtomogaligneMD.getValue(md.MDL_IMAGE, i)
-            # the metadata index start from 1, we should subtract one to match the matrix
-            label = labels[i-1]
-            vol = open_volume(name)
-            Averages[:, :, :, label] += vol
-            classesMD[label].setValue(md.MDL_IMAGE, name, classesMD[label].addObject())
-        for i in range(self.numOfClasses.get()):
-            name = self._getExtraPath('class_'+str(i).zfill(2)+'.xmd')
-            classesMD[i].write(name)
-        # creating a metadata for all class averages:
-        md_averages = md.MetaData()
-        makePath(self._getExtraPath('class_averages/'))
-        for j in range(self.numOfClasses.get()):
-            num = len(labels[labels == j])
-            print('Number of subtomograms in class #', j, 'is ', num)
-            name = self._getExtraPath('class_averages/') + 'cluster' + str(j).zfill(2) + '.spi'
-            ave = np.array(Averages[:, :, :, j] / num, dtype=np.float32)
-            save_volume(ave, name)
-            md_averages.setValue(md.MDL_IMAGE,name,md_averages.addObject())
-        md_averages.write(self._getExtraPath('averages.xmd'))
+        self.classAverages(labels)
 
 
     def performKmeansClustering(self):
-        X = load(self._getExtraPath('covar_mat.pkl'))
-        pca = decomposition.PCA(n_components=self.reducedDim.get())
-        pca.fit(X)
-        data = pca.transform(X)
-        pca_pickled = self._getExtraPath('pca_pickled.pkl')
-        np.savetxt(self._getExtraPath('dimred_mat.txt'),data)
-        dump(pca,pca_pickled)
+        data = self.reduceDimensions()
         # clustering now
-        clustering = KMeans(n_clusters=self.numOfClasses.get()).fit(data)
+        if self.clusteringMethod.get() == 0:
+            clustering = KMeans(n_clusters=self.numOfClasses.get())
+        else:
+            clustering = MiniBatchKMeans(n_clusters=self.numOfClasses.get(), batch_size=self.batchSize.get())
         clustering_class = clustering.fit_predict(data)
         labels = clustering.labels_
         # for l in np.unique(label):
@@ -295,48 +278,100 @@ class FlexProtSubtomoClassify(ProtAnalysis3D):
         dump(clustering, filename=self._getExtraPath('kmeans_algo.pkl'))
         dump(labels, filename=self._getExtraPath('kmeans_clustering_labels.pkl'))
         print(clustering_class)
-        # creating a metadate of subtomograms for each class and an average
-        N = self.getVolumeSize()
-        Averages = np.zeros([N, N, N, self.numOfClasses.get()])
+        self.classAverages(labels)
+
+    def reduceDimensions(self):
+        """Reduce the rows of the matrix to reducedDim components, the model is kept in pca_pickled.pkl."""
+        n_components = self.reducedDim.get()
+        method = self.dimredMethod.get()
+        if self.correlationMode.get() == 1:
+            # spectral embedding: the leading singular vectors of the normalized affinity D^-1/2 A D^-1/2 of the
+            # sparse matrix (negative correlations are not affinities), with rows of unit length
+            A = self.getNeighborMatrix().maximum(0)
+            d = 1 / np.sqrt(np.maximum(np.asarray(A.sum(axis=1)).ravel(), 1e-30))
+            A = A.multiply(d[:, None]).multiply(d[None, :]).tocsr()
+            pca = decomposition.TruncatedSVD(n_components=n_components, algorithm='randomized')
+            data = pca.fit_transform(A)
+            data /= np.maximum(np.linalg.norm(data, axis=1, keepdims=True), 1e-30)
+        elif method == 0:
+            X = np.array(self.getCorrelationMatrix())
+            pca = decomposition.PCA(n_components=n_components)
+            data = pca.fit_transform(X)
+        else:
+            # the matrix is read by blocks of rows from the memory-mapped file
+            X = self.getCorrelationMatrix()
+            batch = max(self.batchSize.get(), n_components)
+            blocks = [slice(start, start + batch) for start in range(0, len(X), batch)]
+            if method == 1:
+                pca = decomposition.IncrementalPCA(n_components=n_components, batch_size=batch)
+                # each block has at least n_components rows (a smaller last block is merged with the previous one)
+                starts = [block.start for block in blocks]
+                if len(starts) > 1 and len(X) - starts[-1] < n_components:
+                    starts.pop()
+                for start, stop in zip(starts, starts[1:] + [len(X)]):
+                    pca.partial_fit(X[start:stop])
+            else:
+                pca = BlockTruncatedSVD(n_components=n_components, batch_size=batch)
+                pca.fit(X)
+            data = np.concatenate([pca.transform(X[block]) for block in blocks])
+        np.savetxt(self._getExtraPath('dimred_mat.txt'), data)
+        dump(pca, self._getExtraPath('pca_pickled.pkl'))
+        return data
+
+    def getCorrelationMatrix(self):
+        """Matrix of the correlations of all the pairs (correlationMode 0), memory-mapped read-only."""
+        return np.load(self._getExtraPath('spectra', 'covar_mat.npy'), mmap_mode='r')
+
+    def getNeighborMatrix(self):
+        """Sparse matrix of the correlations of the pairs of neighbors (correlationMode 1)."""
+        return neighbor_correlation_matrix(self._getExtraPath('spectra'), self.nCandidates.get(),
+                                           self.signatureRadius.get())
+
+    def findTotalAverage(self):
+        # the global average is written with the class averages (from the same pass over the subtomograms)
+        if os.path.exists(self._getExtraPath('global_average.spi')):
+            return
         subtomogaligneMD = md.MetaData(self._getExtraPath('aligned_subtomograms.xmd'))
+        jobs = [(subtomogaligneMD.getValue(md.MDL_IMAGE, i), None) for i in subtomogaligneMD]
+        count, mean, variance = volume_statistics(jobs, n_jobs=self.numberOfMpi.get())[None]
+        save_volume(mean, self._getExtraPath('global_average.spi'))
+        save_volume(variance, self._getExtraPath('global_variance.spi'))
+
+    def classAverages(self, labels):
+        """Write the subtomograms of each class (class_XX.xmd), the average and variance of each class (averages.xmd)
+        and the global average and variance, reading each subtomogram once.
+        @param labels: class of each subtomogram, in the order of the metadata.
+        """
+        K = self.numOfClasses.get()
+        subtomogaligneMD = md.MetaData(self._getExtraPath('aligned_subtomograms.xmd'))
+        names = [subtomogaligneMD.getValue(md.MDL_IMAGE, i) for i in subtomogaligneMD]
         # creating a metadata for each class
-        classesMD = [md.MetaData() for i in range(self.numOfClasses.get())]
-        for i in subtomogaligneMD:
-            name = subtomogaligneMD.getValue(md.MDL_IMAGE, i)
-            # the metadata index start from 1, we should subtract one to match the matrix
-            label = labels[i - 1]
-            vol = open_volume(name)
-            Averages[:, :, :, label] += vol
+        classesMD = [md.MetaData() for i in range(K)]
+        for name, label in zip(names, labels):
             classesMD[label].setValue(md.MDL_IMAGE, name, classesMD[label].addObject())
-        for i in range(self.numOfClasses.get()):
-            name = self._getExtraPath('class_' + str(i).zfill(2) + '.xmd')
-            classesMD[i].write(name)
+        for i in range(K):
+            classesMD[i].write(self._getExtraPath('class_' + str(i).zfill(2) + '.xmd'))
+        # mean and variance of each class in one streaming pass (float32 running statistics)
+        stats = volume_statistics([(name, None, int(label)) for name, label in zip(names, labels)],
+                                  n_jobs=self.numberOfMpi.get(), dtype=np.float32)
         # creating a metadata for all class averages:
         md_averages = md.MetaData()
         makePath(self._getExtraPath('class_averages/'))
-        for j in range(self.numOfClasses.get()):
-            num = len(labels[labels == j])
-            print('Number of subtomograms in class #', j, 'is ', num)
+        for j in range(K):
+            if j not in stats:
+                # an empty class has no average, it is left out of averages.xmd
+                print('Warning: class #', j, 'is empty, no average is written for it')
+                continue
+            print('Number of subtomograms in class #', j, 'is ', stats[j][0])
             name = self._getExtraPath('class_averages/') + 'cluster' + str(j).zfill(2) + '.spi'
-            ave = np.array(Averages[:, :, :, j] / num, dtype=np.float32)
-            save_volume(ave, name)
+            save_volume(stats[j][1], name)
+            save_volume(stats[j][2], self._getExtraPath('class_averages/') + 'cluster' + str(j).zfill(2) + '_var.spi')
             md_averages.setValue(md.MDL_IMAGE, name, md_averages.addObject())
         md_averages.write(self._getExtraPath('averages.xmd'))
-        pass
-
-    def findTotalAverage(self):
-        N = self.getVolumeSize()
-        Average = np.zeros([N, N, N])
-        subtomogaligneMD = md.MetaData(self._getExtraPath('aligned_subtomograms.xmd'))
-        count = 0
-        for i in subtomogaligneMD:
-            name = subtomogaligneMD.getValue(md.MDL_IMAGE, i)
-            vol = open_volume(name)
-            Average[:, :, :] += vol
-            count+=1
-        name = self._getExtraPath('global_average.spi')
-        save_volume(np.array(Average[:, :, :] / count, dtype=np.float32), name)
-        pass
+        # the global average is the pooled statistics of the classes
+        count, mean, variance = pooled_statistics(stats)
+        save_volume(mean, self._getExtraPath('global_average.spi'))
+        save_volume(variance, self._getExtraPath('global_variance.spi'))
 
     def createOutputStep(self):
         out_mdfn = self._getExtraPath('averages.xmd')
@@ -356,6 +391,11 @@ class FlexProtSubtomoClassify(ProtAnalysis3D):
 
     def _validate(self):
         errors = []
+        scalable = (self.classifyTechnique.get() == 0 and self.ClusteringLinkage.get() == 1) or \
+                   (self.classifyTechnique.get() == 1 and self.clusteringMethod.get() == 1)
+        if self.correlationMode.get() == 0 and scalable and self.dimredMethod.get() == 0:
+            errors.append('The ward with kNN connectivity and the mini-batch KMeans read the matrix by blocks, '
+                          'choose Incremental PCA or Randomized SVD as dimensionality reduction method')
         return errors
 
     def _citations(self):
@@ -411,25 +451,3 @@ class FlexProtSubtomoClassify(ProtAnalysis3D):
 
     def getDeformationFile(self):
         return self._getExtraPath('pdbs_mat.txt')
-
-    def normalize(self,v):
-        """Normalize a volume.
-        @param v: input volume.
-        @return: Normalized volume.
-        """
-        m = np.mean(v)
-        v = v - m
-        s = np.std(v)
-        v = v / s
-        return v
-
-    def cc(self, v1, v2):
-        """Compute the Normalized Cross Correlation between the two volumes.
-        @param v1: volume 1.
-        @param v2: volume 2.
-        @return: NCC.
-        """
-        vv1 = self.normalize(v1)
-        vv2 = self.normalize(v2)
-        score = np.sum(vv1 * vv2) / vv1.size
-        return score
@@ -0,0 +1,331 @@
+# Sharded and resumable runs of an alignment program over a metadata (e.g., xmipp_volumeset_align).
+# The input metadata is split into K shards by item id (contiguous ranges of the sorted ids), each shard is aligned by
+# an independent job in its own folder, and the outputs are merged in the order of the shards, which gives the same
+# merged metadata whatever the order in which the shards finished.
+# A shard is complete when its 'done' marker exists (written only after the job succeeded) and holds the key of the
+# shard: a hash of its input rows, of the arguments, and of the contents of the files named in the arguments (e.g.,
+# the reference). A new run (or a retry) only launches the shards that are not complete, and a shard whose input,
+# reference or parameters changed since it was aligned (e.g., the protocol continued with a new reference) is
+# aligned again instead of merging its stale output.
+# The jobs are started by a launcher: LocalLauncher runs the shards one after the other in the current allocation
+# (e.g., through Protocol.runJob with MPI), QueueLauncher writes a script per shard and submits it with a command of
+# the queue system (e.g., sbatch), then waits for the markers, so that each shard can run in a separate allocation.
+# A queued job that dies before writing its marker (killed by the scheduler, out of memory, node lost) is detected by
+# querying the queue system for its job id, or after a timeout, and the shard is marked as failed. A job that timed
+# out is cancelled, and its shard is not submitted again while the queue system still lists the job, since both jobs
+# would write in the same folder and markers.
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import time
+import pyworkflow.protocol.params as params
+from pwem import Domain
+import pwem.emlib.metadata as md
+
+# Launchers
+LAUNCHER_LOCAL = 0
+LAUNCHER_QUEUE = 1
+
+
+def shard_files(folder, k):
+    """Files of the shard k: input and output metadata, folder of the job, markers, script and log."""
+    name = 'shard_%03d' % k
+    path = os.path.join(folder, name)
+    return {'name': name,
+            'input': path + '.xmd',
+            'output': path + '_aligned.xmd',
+            'odir': path,
+            'done': path + '.done',
+            'failed': path + '.failed',
+            'script': path + '.sh',
+            'log': path + '.log'}
+
+
+def _copy_row(mdIn, objId, mdOut):
+    row = md.Row()
+    row.readFromMd(mdIn, objId)
+    row.writeToMd(mdOut, mdOut.addObject())
+
+
+def _file_checksum(path, block=1 << 20):
+    checksum = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def shard_key(fnShard, args):
+    """Key of a shard: hash of its input metadata, of the arguments and of the files named in the arguments."""
+    key = hashlib.blake2b(digest_size=16)
+    key.update(_file_checksum(fnShard).encode())
+    key.update(args.encode())
+    for word in args.split():
+        if os.path.isfile(word):
+            key.update(_file_checksum(word).encode())
+    return key.hexdigest()
+
+
+def split_metadata(fnMd, n_shards, folder, args=''):
+    """Split a metadata into shards by item id, the shards that are already complete (for the same input rows and
+    arguments) are kept as they are, the others are reset.
+    @param args: arguments of the jobs (see shard_key).
+    @return: list of shard_files, with the key of each shard.
+    """
+    mdIn = md.MetaData(fnMd)
+    rows = sorted(mdIn, key=lambda objId: mdIn.getValue(md.MDL_ITEM_ID, objId))
+    n_shards = max(1, min(int(n_shards), len(rows)))
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    shards = []
+    for k in range(n_shards):
+        shard = shard_files(folder, k)
+        mdShard = md.MetaData()
+        for objId in rows[k * len(rows) // n_shards:(k + 1) * len(rows) // n_shards]:
+            _copy_row(mdIn, objId, mdShard)
+        mdShard.write(shard['input'] + '.tmp.xmd')
+        shard['key'] = shard_key(shard['input'] + '.tmp.xmd', args)
+        if is_done(shard):
+            os.remove(shard['input'] + '.tmp.xmd')
+        else:
+            # a new shard, or one aligned with other rows or arguments: its previous results are not resumed
+            for path in (shard['done'], shard['failed'], shard['output']):
+                if os.path.exists(path):
+                    os.remove(path)
+            if os.path.exists(shard['odir']):
+                shutil.rmtree(shard['odir'])
+            os.replace(shard['input'] + '.tmp.xmd', shard['input'])
+        if not os.path.exists(shard['odir']):
+            os.makedirs(shard['odir'])
+        shards.append(shard)
+    return shards
+
+
+def is_done(shard):
+    """Whether the shard was aligned with its current key (see split_metadata)."""
+    if not os.path.exists(shard['done']) or not os.path.exists(shard['output']):
+        return False
+    with open(shard['done']) as f:
+        return f.read().strip() == shard['key']
+
+
+def shard_args(shard, args):
+    """Arguments of the job of a shard: its input, output and folder, then the common arguments."""
+    return '-i %s -o %s --odir %s --resume %s' % (shard['input'], shard['output'], shard['odir'], args)
+
+
+def _mark(path, text=None):
+    with open(path, 'w') as f:
+        f.write((text or time.strftime('%Y-%m-%d %H:%M:%S')) + '\n')
+
+
+class LocalLauncher(object):
+    """Run the shards one after the other with a function run(program, args), e.g., Protocol.runJob."""
+
+    def __init__(self, run):
+        self.run = run
+
+    def launch(self, program, args, shards):
+        for shard in shards:
+            if os.path.exists(shard['failed']):
+                os.remove(shard['failed'])
+            try:
+                self.run(program, shard_args(shard, args))
+                _mark(shard['done'], shard['key'])
+            except Exception as e:
+                print('shard %s failed: %s' % (shard['name'], e))
+                _mark(shard['failed'])
+
+
+class QueueLauncher(object):
+    """Submit one script per shard with a command of the queue system, then wait until all the shards finished.
+    @param submit: submission command, with the keys %(script)s, %(name)s and %(log)s (e.g.,
+                   'sbatch --job-name=%(name)s --output=%(log)s %(script)s'), it should return once submitted.
+    @param env: environment of the submission (and of the jobs if the queue system exports it).
+    @param poll: seconds between checks of the markers.
+    @param status: command listing a job while it is queued or running, with the key %(jobid)s (e.g.,
+                   'squeue -h -j %(jobid)s'), the job id is the last number printed by the submission command. A
+                   shard whose job is not listed anymore and has no marker is failed. None to not query the queue.
+    @param timeout: seconds after which a shard without marker is failed (0 for no timeout).
+    @param cancel: command cancelling a job, with the key %(jobid)s (e.g., 'scancel %(jobid)s'), run for the jobs
+                   that timed out. None to not cancel them.
+    """
+
+    def __init__(self, submit, env=None, poll=30, status=None, timeout=0, cancel=None):
+        self.submit = submit
+        self.env = env
+        self.poll = poll
+        self.status = status
+        self.timeout = timeout
+        self.cancel = cancel
+        # job ids of the shards that timed out, by shard name (they may still be queued or running)
+        self.timed_out = {}
+
+    def _job_listed(self, jobid):
+        """Whether the queue system still lists a job (True if it cannot be queried)."""
+        try:
+            output = subprocess.check_output(self.status % {'jobid': jobid}, shell=True, env=self.env,
+                                             stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            # e.g., squeue fails for job ids that left the queue
+            output = e.output if e.returncode == 1 else b'?'
+        return bool(output.strip())
+
+    def _finished(self, shard):
+        return os.path.exists(shard['done']) or os.path.exists(shard['failed'])
+
+    def _cancel(self, shard):
+        if self.cancel and shard['jobid']:
+            command = self.cancel % {'jobid': shard['jobid']}
+            print('cancelling the job %s of shard %s: %s' % (shard['jobid'], shard['name'], command))
+            subprocess.run(command, shell=True, env=self.env)
+        self.timed_out[shard['name']] = shard['jobid']
+
+    def launch(self, program, args, shards):
+        for shard in shards:
+            jobid = self.timed_out.get(shard['name'])
+            if jobid and self.status and self._job_listed(jobid):
+                # the previous job of the shard could still write its markers, the shard stays failed
+                print('shard %s is not submitted again, its job %s is still listed' % (shard['name'], jobid))
+                shard['jobid'] = jobid
+                _mark(shard['failed'])
+                continue
+            if os.path.exists(shard['failed']):
+                os.remove(shard['failed'])
+            with open(shard['script'], 'w') as f:
+                f.write('#!/bin/bash\n')
+                f.write('%s %s && echo %s > %s || touch %s\n' % (program, shard_args(shard, args), shard['key'],
+                                                                 shard['done'], shard['failed']))
+            os.chmod(shard['script'], 0o755)
+            command = self.submit % shard
+            print('submitting shard %s: %s' % (shard['name'], command))
+            process = subprocess.run(command, shell=True, env=self.env, stdout=subprocess.PIPE)
+            print(process.stdout.decode(errors='replace').strip())
+            if process.returncode != 0:
+                _mark(shard['failed'])
+            numbers = re.findall(r'\d+', process.stdout.decode(errors='replace'))
+            shard['jobid'] = numbers[-1] if numbers else None
+        start = time.time()
+        waiting = list(shards)
+        while waiting:
+            waiting = [shard for shard in waiting if not self._finished(shard)]
+            for shard in waiting:
+                if self.timeout and time.time() - start > self.timeout:
+                    print('shard %s did not finish in %d seconds' % (shard['name'], self.timeout))
+                    self._cancel(shard)
+                    _mark(shard['failed'])
+                elif self.status and shard['jobid'] and not self._job_listed(shard['jobid']):
+                    # the marker may be written just before the job leaves the queue
+                    if not self._finished(shard):
+                        print('the job %s of shard %s ended without result' % (shard['jobid'], shard['name']))
+                        _mark(shard['failed'])
+            waiting = [shard for shard in waiting if not self._finished(shard)]
+            if waiting:
+                time.sleep(self.poll)
+
+
+def merge_shards(shards, fnOut):
+    """Concatenate the outputs of the shards, in the order of the shards."""
+    mdOut = md.MetaData()
+    for shard in shards:
+        mdShard = md.MetaData(shard['output'])
+        for objId in mdShard:
+            _copy_row(mdShard, objId, mdOut)
+    mdOut.write(fnOut)
+
+
+def run_sharded(program, args, fnIn, fnOut, folder, n_shards, launcher, retries=2):
+    """Run a program over the shards of a metadata and merge their outputs.
+    @param args: arguments common to all the shards (without -i, -o and --odir).
+    @param folder: folder of the shards, keep it to resume the completed shards.
+    @param launcher: LocalLauncher or QueueLauncher.
+    @param retries: number of times the failed shards are launched again.
+    """
+    shards = split_metadata(fnIn, n_shards, folder, args)
+    for attempt in range(retries + 1):
+        todo = [shard for shard in shards if not is_done(shard)]
+        if not todo:
+            break
+        if attempt:
+            print('launching again %d failed shard(s)' % len(todo))
+        launcher.launch(program, args, todo)
+    failed = [shard['name'] for shard in shards if not is_done(shard)]
+    if failed:
+        raise Exception('%s: shards %s did not complete, see %s' % (program, ', '.join(failed), folder))
+    merge_shards(shards, fnOut)
+
+
+def add_shard_params(form, condition=None):
+    """Add the group of parameters of the sharded alignment (see run_volumeset_align) to the form of a protocol.
+    @param condition: condition of the group (e.g., the alignment is enabled).
+    """
+    group = form.addGroup('Sharded alignment', condition=condition, expertLevel=params.LEVEL_ADVANCED)
+    group.addParam('alignShards', params.IntParam, default=1,
+                   expertLevel=params.LEVEL_ADVANCED,
+                   label='Number of alignment shards',
+                   help='If more than 1, the volumes are split into this number of shards (by item id), and '
+                        'each shard is aligned by an independent job. Completed shards are not aligned again when '
+                        'the protocol is continued, and only the failed shards are launched again.')
+    group.addParam('shardLauncher', params.EnumParam, default=LAUNCHER_LOCAL,
+                   expertLevel=params.LEVEL_ADVANCED,
+                   condition='alignShards > 1',
+                   choices=['Local (one shard after the other)', 'Queue (one submission per shard)'],
+                   label='Shard launcher',
+                   help='Local runs the shards in this run, with the MPI processes of the parallel section. '
+                        'Queue submits a script for each shard with the submission command, so that the shards '
+                        'can run in separately scheduled allocations.')
+    group.addParam('shardSubmit', params.StringParam,
+                   default='sbatch --job-name=%(name)s --output=%(log)s %(script)s',
+                   expertLevel=params.LEVEL_ADVANCED,
+                   condition='alignShards > 1 and shardLauncher == %d' % LAUNCHER_QUEUE,
+                   label='Submission command',
+                   help='Command submitting the script of a shard, it should return once the script is queued. '
+                        'The keys %(script)s, %(name)s and %(log)s are replaced by the script, the name and the '
+                        'log file of the shard.')
+    group.addParam('shardStatus', params.StringParam, default='squeue -h -j %(jobid)s',
+                   expertLevel=params.LEVEL_ADVANCED,
+                   condition='alignShards > 1 and shardLauncher == %d' % LAUNCHER_QUEUE,
+                   label='Job status command',
+                   help='Command printing a submitted job while it is queued or running, the key %(jobid)s is '
+                        'replaced by the job id (the last number printed by the submission command). A shard '
+                        'whose job ended without result (e.g., killed by the queue system) is then failed '
+                        'instead of being waited for. Leave it empty to not query the queue system.')
+    group.addParam('shardTimeout', params.FloatParam, default=0,
+                   expertLevel=params.LEVEL_ADVANCED,
+                   condition='alignShards > 1 and shardLauncher == %d' % LAUNCHER_QUEUE,
+                   label='Timeout of the shards (hours)',
+                   help='The shards that did not finish after this time are failed (0 for no timeout).')
+    group.addParam('shardCancel', params.StringParam, default='scancel %(jobid)s',
+                   expertLevel=params.LEVEL_ADVANCED,
+                   condition='alignShards > 1 and shardLauncher == %d and shardTimeout > 0' % LAUNCHER_QUEUE,
+                   label='Job cancel command',
+                   help='Command cancelling the job of a shard that timed out, the key %(jobid)s is replaced by the '
+                        'job id. A shard is not submitted again while the status command still lists its previous '
+                        'job, since both jobs would write in the same folder.')
+    group.addParam('shardRetries', params.IntParam, default=2,
+                   expertLevel=params.LEVEL_ADVANCED,
+                   condition='alignShards > 1',
+                   label='Retries of failed shards')
+
+
+def run_volumeset_align(protocol, imgFn, fnOut, odir, args, shardsFolder):
+    """Run xmipp_volumeset_align on a metadata, as one job or by shards, with the parameters of add_shard_params.
+    @param protocol: protocol whose form has the parameters of add_shard_params (its runJob runs the jobs).
+    @param args: arguments of xmipp_volumeset_align (without -i, -o and --odir).
+    @param shardsFolder: folder of the shards.
+    """
+    env = Domain.importFromPlugin('xmipp3').Plugin.getEnviron()
+    if protocol.alignShards.get() <= 1:
+        protocol.runJob("xmipp_volumeset_align", shard_args({'input': imgFn, 'output': fnOut, 'odir': odir}, args),
+                        env=env)
+        return
+    if protocol.shardLauncher.get() == LAUNCHER_QUEUE:
+        launcher = QueueLauncher(protocol.shardSubmit.get(), env=env, status=protocol.shardStatus.get() or None,
+                                 timeout=int(protocol.shardTimeout.get() * 3600),
+                                 cancel=protocol.shardCancel.get() or None)
+    else:
+        launcher = LocalLauncher(lambda program, arguments: protocol.runJob(program, arguments, env=env))
+    run_sharded("xmipp_volumeset_align", args, imgFn, fnOut, shardsFolder, protocol.alignShards.get(), launcher,
+                retries=protocol.shardRetries.get())
@@ -0,0 +1,59 @@
+# Randomized truncated SVD of a matrix read by blocks of rows (e.g., the memory-mapped correlation matrix of
+# spectral_cc.py), so that the matrix is never loaded in memory.
+# It is the randomized range finder of Halko et al. (2011), as in sklearn's TruncatedSVD(algorithm='randomized'):
+# the range of X is sampled with a random matrix (Y = X G), refined by power iterations (Y = X X^T Y), and X is
+# projected on an orthonormal basis Q of Y (B = Q^T X), whose small SVD gives the components. Each product with X or
+# X^T is a sum over the blocks of rows, so only one block of X, and the thin matrices Y (N x l) and B (l x M), with
+# l = n_components + n_oversamples, are in memory at a time.
+import numpy as np
+
+
+class BlockTruncatedSVD(object):
+    """Truncated SVD (like sklearn's TruncatedSVD) fitted on the blocks of rows of a matrix.
+    @param n_components: number of components.
+    @param batch_size: number of rows read at once.
+    @param n_oversamples: additional random directions of the range finder.
+    @param n_iter: number of power iterations (each one reads the matrix twice).
+    """
+
+    def __init__(self, n_components, batch_size=1024, n_oversamples=10, n_iter=5, random_state=0):
+        self.n_components = n_components
+        self.batch_size = batch_size
+        self.n_oversamples = n_oversamples
+        self.n_iter = n_iter
+        self.random_state = random_state
+
+    def _blocks(self, X):
+        return [slice(start, min(start + self.batch_size, len(X))) for start in range(0, len(X), self.batch_size)]
+
+    def _times(self, X, G):
+        """X G, by blocks of rows of X."""
+        return np.concatenate([np.matmul(np.asarray(X[block], dtype=np.float64), G) for block in self._blocks(X)])
+
+    def _transposed_times(self, X, Y):
+        """X^T Y, by blocks of rows of X."""
+        total = np.zeros((X.shape[1], Y.shape[1]))
+        for block in self._blocks(X):
+            total += np.matmul(np.asarray(X[block], dtype=np.float64).T, Y[block])
+        return total
+
+    def fit(self, X):
+        l = min(self.n_components + self.n_oversamples, *X.shape)
+        G = np.random.RandomState(self.random_state).normal(size=(X.shape[1], l))
+        Q = np.linalg.qr(self._times(X, G))[0]
+        for _ in range(self.n_iter):
+            Q = np.linalg.qr(self._transposed_times(X, Q))[0]
+            Q = np.linalg.qr(self._times(X, Q))[0]
+        s, Vt = np.linalg.svd(self._transposed_times(X, Q).T, full_matrices=False)[1:]
+        # deterministic signs: the largest coefficient of each component is positive
+        signs = np.sign(Vt[np.arange(len(Vt)), np.argmax(np.abs(Vt), axis=1)])
+        signs[signs == 0] = 1
+        self.components_ = (Vt * signs[:, None])[:self.n_components]
+        self.singular_values_ = s[:self.n_components]
+        return self
+
+    def transform(self, X):
+        return self._times(X, self.components_.T)
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
@@ -0,0 +1,82 @@
+# Checkpoint journal of the volumes completed by a stage of an iteration (e.g., the alignment of the volumes in the
+# third iteration of TomoFlow), to resume an interrupted stage (the job was killed or preempted) where it stopped.
+# A volume is recorded only once its output is completely written, with the size and a checksum of the output and a
+# key of its inputs (e.g., the alignment applied to it). A resumed stage skips a volume only if its output is still
+# the same file made from the same inputs, so the outputs truncated by a killed worker (never recorded, or not
+# matching their checksum anymore) are calculated again.
+# The journal is a text file with one json line per volume, appended and synced as each volume is completed; a line
+# cut by a crash is dropped when the journal is opened again.
+import hashlib
+import json
+import os
+
+
+def file_checksum(path, block=1 << 20):
+    """Checksum (blake2b) of the contents of a file."""
+    checksum = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class CheckpointJournal(object):
+    """Volumes completed by a stage, with the checksums of their outputs.
+    @param path: journal file (its folder is created if needed).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        complete = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                complete += len(line)
+                try:
+                    entry = json.loads(line.decode())
+                except ValueError:
+                    continue
+                self.entries[entry['id']] = entry
+        if complete < os.path.getsize(self.path):
+            # the last line was being written when the job was killed
+            with open(self.path, 'r+b') as f:
+                f.truncate(complete)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_done(self, item_id, output, key=''):
+        """Whether the output of a volume was completed from the same inputs and is still intact.
+        @param item_id: id of the volume (e.g., the objId in the metadata).
+        @param output: path of the output of the volume.
+        @param key: inputs of the volume (e.g., its path and alignment), the output is calculated again if they change.
+        """
+        entry = self.entries.get(str(item_id))
+        if entry is None or entry['output'] != output or entry['key'] != key:
+            return False
+        if not os.path.isfile(output) or os.path.getsize(output) != entry['size']:
+            return False
+        return file_checksum(output) == entry['checksum']
+
+    def record(self, item_id, output, key=''):
+        """Record a volume whose output was completely written."""
+        entry = {'id': str(item_id), 'output': output, 'key': key, 'size': os.path.getsize(output),
+                 'checksum': file_checksum(output)}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[entry['id']] = entry
+
+    def report(self, total):
+        """Summary of a resumed stage."""
+        return '%d of %d volumes already completed (%s)' % (len(self), total, self.path)
@@ -2,70 +2,38 @@
 # given a metadata input containing a list of the subtomograms
 from pwem.emlib import metadata as md
 import numpy as np
-from math import sin, cos, radians
 from xmippLib import Euler_matrix2angles
 import pandas as pd
-import math
+from continuousflex.protocols.utilities.euler_transforms import matrices_to_euler
 
 def dynamo_mat(tdrot, tilt, narot, shiftx, shifty, shiftz):
-    tdrot = radians(tdrot)
-    tilt = radians(tilt)
-    narot = radians(narot)
-    cotd = cos(tdrot)
-    sitd = sin(tdrot)
-    coti = cos(tilt)
-    siti = sin(tilt)
-    cona = cos(narot)
-    sina = sin(narot)
-    m = np.zeros([4,4])
-    m[0,0] = cotd * cona - sitd * coti * sina
-    m[1,0] = - cona * sitd - cotd * coti * sina
-    m[2,0] = sina * siti
-    m[0,1] = cotd * sina + cona * sitd * coti
-    m[1,1] = cotd * cona * coti - sitd * sina
-    m[2,1] = -cona * siti
-    m[0,2] = sitd * siti
-    m[1,2] = cotd * siti
-    m[2,2] = coti
+    """Matrices (..., 4, 4) of Dynamo angles (in degrees) and shifts, the arguments can be arrays."""
+    tdrot, tilt, narot, shiftx, shifty, shiftz = np.broadcast_arrays(
+        *[np.asarray(v, dtype=np.float64) for v in (tdrot, tilt, narot, shiftx, shifty, shiftz)])
+    cotd = np.cos(np.deg2rad(tdrot))
+    sitd = np.sin(np.deg2rad(tdrot))
+    coti = np.cos(np.deg2rad(tilt))
+    siti = np.sin(np.deg2rad(tilt))
+    cona = np.cos(np.deg2rad(narot))
+    sina = np.sin(np.deg2rad(narot))
+    m = np.zeros(tdrot.shape + (4, 4))
+    m[..., 0, 0] = cotd * cona - sitd * coti * sina
+    m[..., 1, 0] = - cona * sitd - cotd * coti * sina
+    m[..., 2, 0] = sina * siti
+    m[..., 0, 1] = cotd * sina + cona * sitd * coti
+    m[..., 1, 1] = cotd * cona * coti - sitd * sina
+    m[..., 2, 1] = -cona * siti
+    m[..., 0, 2] = sitd * siti
+    m[..., 1, 2] = cotd * siti
+    m[..., 2, 2] = coti
     # The 4th column
-    m[0,3] = shiftx
-    m[1,3] = shifty
-    m[2,3] = shiftz
-    m[3,3] = 1
-
-
-
+    m[..., 0, 3] = shiftx
+    m[..., 1, 3] = shifty
+    m[..., 2, 3] = shiftz
+    m[..., 3, 3] = 1
     return m
 
 
-def matrix2eulerAngles(A):
-    abs_sb = np.sqrt(A[0, 2] * A[0, 2] + A[1, 2] * A[1, 2])
-    if (abs_sb > 16 * np.exp(-5)):
-        gamma = math.atan2(A[1, 2], -A[0, 2])
-        alpha = math.atan2(A[2, 1], A[2, 0])
-        if (abs(np.sin(gamma)) < np.exp(-5)):
-            sign_sb = np.sign(-A[0, 2] / np.cos(gamma))
-        else:
-            if np.sin(gamma) > 0:
-                sign_sb = np.sign(A[1, 2])
-            else:
-                sign_sb = -np.sign(A[1, 2])
-        beta = math.atan2(sign_sb * abs_sb, A[2, 2])
-    else:
-        if (np.sign(A[2, 2]) > 0):
-            alpha = 0
-            beta = 0
-            gamma = math.atan2(-A[1, 0], A[0, 0])
-        else:
-            alpha = 0
-            beta = np.pi
-            gamma = math.atan2(A[1, 0], -A[0, 0])
-    gamma = np.rad2deg(gamma)
-    beta = np.rad2deg(beta)
-    alpha = np.rad2deg(alpha)
-    return alpha, beta, gamma, A[0, 3], A[1, 3], A[2, 3]
-
-
 def tbl2metadata(table, mdfi, mdfo):
     tbl = pd.read_csv(table, delimiter=' ', header=None)
     x = tbl[:][3]
@@ -74,22 +42,9 @@ def tbl2metadata(table, mdfi, mdfo):
     tdrot = tbl[:][6]
     tiltd = tbl[:][7]
     narot = tbl[:][8]
-    # change the angles from Dynamo convention to xmipp convention
-    rot = []
-    tilt = []
-    psi = []
-    shiftx = []
-    shifty = []
-    shiftz = []
-    for i in range(tbl.shape[0]):
-        TransMat = dynamo_mat(tdrot[i], tiltd[i], narot[i], x[i], y[i], z[i])
-        rot_i, tilt_i, psi_i, shiftx_i, shifty_i, shiftz_i = matrix2eulerAngles(TransMat)
-        rot.append(rot_i)
-        tilt.append(tilt_i)
-        psi.append(psi_i)
-        shiftx.append(shiftx_i)
-        shifty.append(shifty_i)
-        shiftz.append(shiftz_i)
+    # change the angles from Dynamo convention to xmipp convention (for all the rows at once)
+    TransMat = dynamo_mat(tdrot.values, tiltd.values, narot.values, x.values, y.values, z.values)
+    rot, tilt, psi, shiftx, shifty, shiftz = [v.tolist() for v in matrices_to_euler(TransMat)]
 
     md_out = md.MetaData(mdfi)
     i = 0
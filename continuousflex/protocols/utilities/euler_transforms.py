@@ -0,0 +1,93 @@
+# Stacked rigid transforms (Euler angles and shifts) with the conventions of xmipp.
+# A transform is a 4 x 4 matrix [R t] with R the ZYZ rotation of the Euler angles (rot, tilt, psi) in degrees and t
+# the shift; all the functions take stacks of matrices (..., 4, 4) and arrays of angles, so that the alignments of a
+# whole set of volumes are converted, composed and inverted at once instead of matrix by matrix.
+import numpy as np
+import pwem.emlib.metadata as md
+
+# Metadata columns of an alignment, in the order of the arguments of euler_matrices
+ALIGNMENT_LABELS = [md.MDL_ANGLE_ROT, md.MDL_ANGLE_TILT, md.MDL_ANGLE_PSI, md.MDL_SHIFT_X, md.MDL_SHIFT_Y,
+                    md.MDL_SHIFT_Z]
+
+
+def euler_matrices(rot, tilt, psi, shiftx=0., shifty=0., shiftz=0.):
+    """Matrices (..., 4, 4) of Euler angles (ZYZ, in degrees) and shifts, the arguments are broadcast together."""
+    rot, tilt, psi, shiftx, shifty, shiftz = np.broadcast_arrays(*[np.asarray(v, dtype=np.float64) for v in
+                                                                   (rot, tilt, psi, shiftx, shifty, shiftz)])
+    ca, sa = np.cos(np.deg2rad(rot)), np.sin(np.deg2rad(rot))
+    cb, sb = np.cos(np.deg2rad(tilt)), np.sin(np.deg2rad(tilt))
+    cg, sg = np.cos(np.deg2rad(psi)), np.sin(np.deg2rad(psi))
+    A = np.zeros(rot.shape + (4, 4))
+    A[..., 0, 0] = cg * cb * ca - sg * sa
+    A[..., 0, 1] = cg * cb * sa + sg * ca
+    A[..., 0, 2] = -cg * sb
+    A[..., 1, 0] = -sg * cb * ca - cg * sa
+    A[..., 1, 1] = -sg * cb * sa + cg * ca
+    A[..., 1, 2] = sg * sb
+    A[..., 2, 0] = sb * ca
+    A[..., 2, 1] = sb * sa
+    A[..., 2, 2] = cb
+    A[..., 0, 3] = shiftx
+    A[..., 1, 3] = shifty
+    A[..., 2, 3] = shiftz
+    A[..., 3, 3] = 1
+    return A
+
+
+def matrices_to_euler(A):
+    """Euler angles (in degrees) and shifts of matrices (..., 4, 4).
+    When the tilt is 0 or 180 degrees (gimbal lock), rot is 0 and the whole in-plane rotation is given by psi.
+    @return: tuple of arrays (rot, tilt, psi, shiftx, shifty, shiftz).
+    """
+    A = np.asarray(A, dtype=np.float64)
+    abs_sb = np.sqrt(A[..., 0, 2] ** 2 + A[..., 1, 2] ** 2)
+    gamma = np.arctan2(A[..., 1, 2], -A[..., 0, 2])
+    alpha = np.arctan2(A[..., 2, 1], A[..., 2, 0])
+    sg = np.sin(gamma)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sign_sb = np.where(np.abs(sg) < np.exp(-5), np.sign(-A[..., 0, 2] / np.cos(gamma)),
+                           np.where(sg > 0, np.sign(A[..., 1, 2]), -np.sign(A[..., 1, 2])))
+    beta = np.arctan2(sign_sb * abs_sb, A[..., 2, 2])
+    # gimbal lock
+    locked = abs_sb <= 16 * np.exp(-5)
+    up = A[..., 2, 2] > 0
+    alpha = np.where(locked, 0., alpha)
+    beta = np.where(locked, np.where(up, 0., np.pi), beta)
+    gamma = np.where(locked, np.where(up, np.arctan2(-A[..., 1, 0], A[..., 0, 0]),
+                                      np.arctan2(A[..., 1, 0], -A[..., 0, 0])), gamma)
+    return np.rad2deg(alpha), np.rad2deg(beta), np.rad2deg(gamma), A[..., 0, 3], A[..., 1, 3], A[..., 2, 3]
+
+
+def compose(A, B):
+    """Matrices A B (the transform B followed by A)."""
+    return np.matmul(A, B)
+
+
+def invert(A):
+    """Inverses of rigid transforms [R t]: [R^T -R^T t]."""
+    A = np.asarray(A, dtype=np.float64)
+    inv = np.zeros_like(A)
+    R_t = np.swapaxes(A[..., :3, :3], -1, -2)
+    inv[..., :3, :3] = R_t
+    inv[..., :3, 3] = -np.matmul(R_t, A[..., :3, 3:4])[..., 0]
+    inv[..., 3, 3] = 1
+    return inv
+
+
+def read_alignments(mdIn, ids=None):
+    """Matrices (N, 4, 4) of the alignments of a metadata, for the given objIds (all the rows if None).
+    The columns are read at once (as written by write_alignments), a missing column is zero.
+    """
+    columns = [np.array(mdIn.getColumnValues(label), dtype=np.float64) if mdIn.containsLabel(label)
+               else np.zeros(mdIn.size()) for label in ALIGNMENT_LABELS]
+    if ids is not None:
+        positions = {objId: row for row, objId in enumerate(mdIn)}
+        rows = [positions[objId] for objId in ids]
+        columns = [column[rows] for column in columns]
+    return euler_matrices(*columns)
+
+
+def write_alignments(mdOut, A):
+    """Write the alignments of matrices (N, 4, 4) in the rows of a metadata (in their order)."""
+    for label, values in zip(ALIGNMENT_LABELS, matrices_to_euler(A)):
+        mdOut.setColumnValues(label, [float(v) for v in values])
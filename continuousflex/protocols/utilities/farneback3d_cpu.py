@@ -0,0 +1,257 @@
+# CPU (NumPy/SciPy) port of the 3D Farneback optical flow of farneback3d, for nodes without a CUDA GPU.
+# It follows the GPU implementation step by step, so that the same parameters give the same flows:
+#   - Gaussian pyramid (normalized Gaussian smoothing, then linear resampling with zero border),
+#   - polynomial expansion with separable filters (edge voxels repeated),
+#   - update of the 9 coefficients of the local equations using the second expansion warped by the flow,
+#   - Gaussian averaging of the coefficients over winsize and closed form (Cramer) solution for the flow.
+# Flows have shape (3, Z, Y, X) with the x, y and z components in this order, as in farneback3d.
+# All the filters are separable 1D correlations, the independent ones run in a pool of threads (NumPy and SciPy
+# release the GIL), and the class and warp_by_flow have the same interface as farneback3d.
+# The expansions of the first volume (the reference) can be found once and given to calc_flow for many flows.
+#
+# Benchmark and accuracy against the GPU (needs farneback3d and a GPU):
+#   python farneback3d_cpu.py vol0.spi vol1.spi [pyr_scale levels winsize iterations poly_n poly_sigma]
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import time
+import numpy as np
+from scipy.ndimage import correlate1d
+
+_MIN_VOL_SIZE = 32
+
+
+def _gauss_weights(sigma, kernelsize):
+    """Gaussian weights for the offsets -kernelsize//2 .. kernelsize - 1 - kernelsize//2 (as the GPU filter)."""
+    d = np.arange(kernelsize) - kernelsize // 2
+    return np.exp(-0.5 * d * d / (sigma * sigma))
+
+
+def smooth_gauss(vol, sigma, kernelsize):
+    """Gaussian smoothing normalized by the sum of the weights that fall inside the volume."""
+    w = _gauss_weights(sigma, kernelsize)
+    out = np.asarray(vol, dtype=np.float32)
+    for axis in range(3):
+        out = correlate1d(out, w, axis=axis, mode='constant', cval=0.0)
+    for axis in range(3):
+        # sum of the weights inside the volume along each axis (the 3D weight is their product)
+        norm = correlate1d(np.ones(np.shape(vol)[axis], dtype=np.float32), w, mode='constant', cval=0.0)
+        shape = [1, 1, 1]
+        shape[axis] = -1
+        out /= np.reshape(norm, shape)
+    return out
+
+
+def _linear_axis(n_src, coordinates):
+    """Indexes and weights of the linear interpolation at coordinates, samples outside the volume are zero."""
+    i0 = np.floor(coordinates).astype(np.int64)
+    w1 = (coordinates - i0).astype(np.float32)
+    w0 = 1 - w1
+    inside0 = (i0 >= 0) & (i0 < n_src)
+    inside1 = (i0 + 1 >= 0) & (i0 + 1 < n_src)
+    return np.clip(i0, 0, n_src - 1), np.clip(i0 + 1, 0, n_src - 1), w0 * inside0, w1 * inside1
+
+
+def resize(vol, shape):
+    """Linear resampling of a volume to a new shape (voxel i of the result is at i * n_src / n_dst)."""
+    out = np.asarray(vol, dtype=np.float32)
+    for axis in range(3):
+        n_src, n_dst = out.shape[axis], int(shape[axis])
+        i0, i1, w0, w1 = _linear_axis(n_src, np.arange(n_dst) * np.float32(n_src / n_dst))
+        bshape = [1, 1, 1]
+        bshape[axis] = -1
+        out = np.take(out, i0, axis=axis) * w0.reshape(bshape) + np.take(out, i1, axis=axis) * w1.reshape(bshape)
+    return out
+
+
+def warp_by_flow(vol, flow3d):
+    """Sample the volume at each voxel moved by the flow (trilinear, zero outside), as farneback3d.warp_by_flow."""
+    vol = np.asarray(vol, dtype=np.float32)
+    nz, ny, nx = vol.shape
+    grids = np.ogrid[0:nz, 0:ny, 0:nx]
+    # position in voxels along z, y and x
+    pos = [grids[0] + flow3d[2], grids[1] + flow3d[1], grids[2] + flow3d[0]]
+    out = np.zeros(vol.shape, dtype=np.float32)
+    corner = []
+    for axis, p in enumerate(pos):
+        corner.append(_linear_axis(vol.shape[axis], p))
+    for cz in range(2):
+        for cy in range(2):
+            for cx in range(2):
+                w = corner[0][2 + cz] * corner[1][2 + cy] * corner[2][2 + cx]
+                out += w * vol[corner[0][cz], corner[1][cy], corner[2][cx]]
+    return out
+
+
+class Farneback(object):
+    """ 3D Farneback optical flow on the CPU, with the parameters of farneback3d.Farneback. """
+
+    def __init__(self, pyr_scale=0.9, levels=15, winsize=9, num_iterations=5, poly_n=5, poly_sigma=1.2,
+                 n_threads=None):
+        self.pyr_scale = pyr_scale
+        self.levels = levels
+        self.winsize = winsize
+        self.num_iterations = num_iterations
+        self.poly_n = poly_n
+        self.poly_sigma = poly_sigma
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self._resize_kernel_size_factor = 4
+        self._max_resize_kernel_size = 9
+
+    def calc_flow(self, cur_vol, next_vol, cur_pyramid=None, init_flow=None):
+        """Flow between two volumes, as farneback3d.Farneback.calc_flow.
+        @param cur_pyramid: expansions of cur_vol given by expand_pyramid (when cur_vol is a reference shared by
+                            many flows, its expansions are found once and reused, and cur_vol can be None).
+        @param init_flow: initial flow (3, Z, Y, X), e.g. a flow found before for a similar pair of volumes; it is
+                          scaled down to the coarsest level used (fewer levels and iterations are then enough).
+        """
+        assert np.ndim(next_vol) == 3, 'wrong dimension'
+        assert (cur_vol is None and cur_pyramid is not None) or np.shape(cur_vol) == np.shape(next_vol)
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            if cur_pyramid is None:
+                cur_pyramid = self._expand_pyramid(np.float32(cur_vol), pool)
+            return self._calc_flow(np.shape(next_vol), np.float32(next_vol), cur_pyramid, pool, init_flow)
+
+    def pyramid_levels(self, shape):
+        """Levels (k, sigma, smoothing size, scaled shape) used for volumes of a shape, from the coarsest."""
+        levels = []
+        for k in range(self.levels, -1, -1):
+            scale = self.pyr_scale ** k
+            if np.any(np.array(shape) * scale < _MIN_VOL_SIZE):
+                continue
+            sigma = (1. / scale - 1) * 0.5
+            smooth_sz = int(sigma * self._resize_kernel_size_factor + 0.5) | 1
+            smooth_sz = min(max(smooth_sz, 3), self._max_resize_kernel_size)
+            levels.append((k, sigma, smooth_sz, [int(np.round(x * scale)) for x in shape]))
+        return levels
+
+    def expand_pyramid(self, vol):
+        """Polynomial expansions of a volume on all the levels of the pyramid (see calc_flow)."""
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            return self._expand_pyramid(np.float32(vol), pool)
+
+    def _expand_level(self, img, level):
+        k, sigma, smooth_sz, scale_shape = level
+        if k != 0:
+            img = resize(smooth_gauss(img, sigma, smooth_sz), scale_shape)
+        return self._poly_expansion(img)
+
+    def _expand_pyramid(self, vol, pool):
+        return list(pool.map(lambda level: self._expand_level(vol, level), self.pyramid_levels(np.shape(vol))))
+
+    def _calc_flow(self, shape, next_vol, cur_pyramid, pool, init_flow=None):
+        flow = None
+        levels = self.pyramid_levels(shape)
+        next_pyramid = pool.map(lambda level: self._expand_level(next_vol, level), levels)
+        for level, R0, R1 in zip(levels, next_pyramid, cur_pyramid):
+            scale_shape = level[3]
+            if flow is None and init_flow is not None:
+                scale = self.pyr_scale ** level[0]
+                flow = np.stack(list(pool.map(lambda f: resize(f * scale, scale_shape), np.float32(init_flow))))
+            elif flow is None:
+                flow = np.zeros([3] + scale_shape, dtype=np.float32)
+            else:
+                flow = np.stack(list(pool.map(lambda f: resize(f / self.pyr_scale, scale_shape), flow)))
+
+            M = self._update_matrices(R0, R1, flow, pool)
+            for i in range(self.num_iterations):
+                M = pool.map(lambda m: smooth_gauss(m, self.winsize * 0.3, self.winsize), M)
+                flow = self._solve(list(M))
+                if i < self.num_iterations - 1:
+                    M = self._update_matrices(R0, R1, flow, pool)
+        if flow is None:
+            return np.zeros([3] + list(shape), dtype=np.float32)
+        return flow
+
+    def _poly_expansion(self, img):
+        """The 9 coefficients (b_x, b_y, b_z, a_xx, a_yy, a_zz, a_xy, a_xz, a_yz) of the local polynomial."""
+        n = self.poly_n
+        sigma = self.poly_sigma if self.poly_sigma >= 1e-7 else n * 0.3
+        x = np.arange(-n, n + 1, dtype=np.float64)
+        g = np.exp(-(x * x) / (2 * sigma * sigma))
+        g /= np.sum(g)
+        kernels = [g, x * g, x * x * g]
+        # powers of (x, y, z) of the basis (1 x y z xx yy zz xy xz yz)
+        powers = [(0, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1), (2, 0, 0), (0, 2, 0), (0, 0, 2),
+                  (1, 1, 0), (1, 0, 1), (0, 1, 1)]
+        basis = np.array([[x ** px * y ** py * z ** pz for (px, py, pz) in powers]
+                          for z in range(-n, n + 1) for y in range(-n, n + 1) for x in range(-n, n + 1)])
+        weights = np.array([g[z] * g[y] * g[x] for z in range(2 * n + 1) for y in range(2 * n + 1)
+                            for x in range(2 * n + 1)])
+        invG = np.linalg.inv(np.matmul(basis.T * weights, basis))
+
+        # separable correlations, cached by the powers already applied along x and y
+        img = np.asarray(img, dtype=np.float32)
+        along_x = {}
+        along_xy = {}
+        sums = []
+        for px, py, pz in powers:
+            if px not in along_x:
+                along_x[px] = correlate1d(img, kernels[px], axis=2, mode='nearest')
+            if (px, py) not in along_xy:
+                along_xy[(px, py)] = correlate1d(along_x[px], kernels[py], axis=1, mode='nearest')
+            sums.append(correlate1d(along_xy[(px, py)], kernels[pz], axis=0, mode='nearest'))
+        sums = np.stack(sums)
+        return np.float32(np.tensordot(invG[1:], sums, axes=1))
+
+    def _update_matrices(self, R0, R1, flow, pool):
+        R1 = list(pool.map(lambda r: warp_by_flow(r, flow), R1))
+        b = [0.5 * (R0[i] - R1[i]) for i in range(3)]
+        a = [0.5 * (R0[i] + R1[i]) for i in range(3, 6)] + [0.25 * (R0[i] + R1[i]) for i in range(6, 9)]
+        fx, fy, fz = flow
+        b[0] = b[0] + fx * a[0] + fy * a[3] + fz * a[4]
+        b[1] = b[1] + fx * a[3] + fy * a[1] + fz * a[5]
+        b[2] = b[2] + fx * a[4] + fy * a[5] + fz * a[2]
+        return [a[0] * a[0] + a[3] * a[3] + a[4] * a[4],
+                a[1] * a[1] + a[3] * a[3] + a[5] * a[5],
+                a[2] * a[2] + a[4] * a[4] + a[5] * a[5],
+                a[4] * a[5] + a[1] * a[3] + a[0] * a[3],
+                a[3] * a[5] + a[2] * a[4] + a[0] * a[4],
+                a[2] * a[5] + a[1] * a[5] + a[3] * a[4],
+                a[4] * b[2] + a[3] * b[1] + a[0] * b[0],
+                a[5] * b[2] + a[1] * b[1] + a[3] * b[0],
+                a[2] * b[2] + a[5] * b[1] + a[4] * b[0]]
+
+    def _solve(self, M):
+        a0, a1, a2, a3, a4, a5, b0, b1, b2 = M
+        det = a0 * a5 * a5 - 2 * a3 * a4 * a5 + a1 * a4 * a4 + a2 * a3 * a3 - a0 * a1 * a2
+        singular = np.abs(det) < 1e-2
+        inv_det = 1 / np.where(singular, 1, det)
+        flow = np.stack([-inv_det * ((a1 * a2 - a5 * a5) * b0 + (a4 * a5 - a2 * a3) * b1 + (a3 * a5 - a1 * a4) * b2),
+                         inv_det * ((a2 * a3 - a4 * a5) * b0 + (a4 * a4 - a0 * a2) * b1 + (a0 * a5 - a3 * a4) * b2),
+                         inv_det * ((a1 * a4 - a3 * a5) * b0 + (a0 * a5 - a3 * a4) * b1 + (a3 * a3 - a0 * a1) * b2)])
+        flow[:, singular] = 0
+        return np.float32(flow)
+
+
+def compare_with_gpu(vol0, vol1, pyr_scale=0.5, levels=4, winsize=10, iterations=10, poly_n=5, poly_sigma=1.2):
+    """Time both backends on the same pair of volumes and report how far the CPU flow is from the GPU flow."""
+    import farneback3d
+    params = dict(pyr_scale=pyr_scale, levels=levels, winsize=winsize, num_iterations=iterations, poly_n=poly_n,
+                  poly_sigma=poly_sigma)
+    vol0, vol1 = np.float32(vol0), np.float32(vol1)
+    t0 = time.time()
+    flow_gpu = farneback3d.Farneback(**params).calc_flow(vol0, vol1)
+    t_gpu = time.time() - t0
+    t0 = time.time()
+    flow_cpu = Farneback(**params).calc_flow(vol0, vol1)
+    t_cpu = time.time() - t0
+    epe = np.sqrt(np.sum((flow_cpu - flow_gpu) ** 2, axis=0))
+    norm = np.sqrt(np.sum(flow_gpu ** 2, axis=0))
+    report = {'gpu seconds': t_gpu, 'cpu seconds': t_cpu,
+              'mean endpoint error': float(np.mean(epe)), 'max endpoint error': float(np.max(epe)),
+              'mean flow magnitude': float(np.mean(norm)),
+              'correlation': float(np.corrcoef(flow_cpu.ravel(), flow_gpu.ravel())[0, 1])}
+    for key, value in report.items():
+        print('%s: %f' % (key, value))
+    return report
+
+
+if __name__ == '__main__':
+    from continuousflex.protocols.utilities.spider_files3 import open_volume
+    if len(sys.argv) < 3:
+        print('usage: farneback3d_cpu.py vol0 vol1 [pyr_scale levels winsize iterations poly_n poly_sigma]')
+        sys.exit(1)
+    args = [float(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]), int(sys.argv[6]), int(sys.argv[7]),
+            float(sys.argv[8])] if len(sys.argv) == 9 else []
+    compare_with_gpu(open_volume(sys.argv[1]) * 100, open_volume(sys.argv[2]) * 100, *args)
@@ -0,0 +1,137 @@
+# Tiled computation of the matrix of inner products between all the optical flows of a flow store.
+# The flows are flattened into blocks of rows (optionally keeping only the voxels inside a mask), and each
+# tile of the matrix is one matrix multiplication F_i . F_j^T between two blocks. Only the tiles on and above
+# the diagonal are computed. The block size is chosen to fit a memory budget, and finished tiles can be saved
+# to a checkpoint so that an interrupted computation resumes from the missing tiles.
+# When flows are added to a set whose matrix is known, only the rows and columns of the new flows are computed.
+import os
+import numpy as np
+
+
+def block_size(n_features, memory_mb, n_max):
+    """Number of flows per block so that two blocks (in double precision) fit in memory_mb."""
+    b = int(memory_mb * 1024 ** 2 // (2 * 8 * max(n_features, 1)))
+    return max(1, min(b, n_max))
+
+
+def flow_rows(store, start, stop, mask=None):
+    """Flows start..stop-1 of the store flattened as rows of a float64 matrix.
+    @param mask: boolean mask (Z, Y, X), only the voxels inside it are kept.
+    """
+    return _flatten(store[start:stop], mask)
+
+
+def _flatten(block, mask=None):
+    if mask is None:
+        return np.array(np.reshape(block, [len(block), -1]), dtype=np.float64)
+    return np.array(block[:, :, mask], dtype=np.float64).reshape([len(block), -1])
+
+
+class _Checkpoint(object):
+    """ The matrix and a bitmap of the finished tiles, saved as .npy files. """
+
+    def __init__(self, root, n, b):
+        self.fn_matrix = root + '_matrix.npy'
+        self.fn_tiles = root + '_tiles.npy'
+        nb = (n + b - 1) // b
+        resume = os.path.exists(self.fn_matrix) and os.path.exists(self.fn_tiles)
+        if resume:
+            self.tiles = np.load(self.fn_tiles)
+            self.matrix = np.load(self.fn_matrix, mmap_mode='r+')
+            # the tiling changes if the number of flows or the block size change
+            resume = self.tiles.shape == (nb + 1, nb) and self.tiles[nb, 0] == b and self.matrix.shape == (n, n)
+        if not resume:
+            self.tiles = np.zeros([nb + 1, nb], dtype=np.int64)
+            self.tiles[nb, 0] = b
+            self.matrix = np.lib.format.open_memmap(self.fn_matrix, mode='w+', dtype=np.float64, shape=(n, n))
+
+    def done(self, bi, bj):
+        return bool(self.tiles[bi, bj])
+
+    def save(self, bi, bj):
+        self.matrix.flush()
+        self.tiles[bi, bj] = 1
+        np.save(self.fn_tiles, self.tiles)
+
+    def clean(self):
+        for fn in [self.fn_matrix, self.fn_tiles]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+
+def flow_gram_matrix(store, mask=None, memory_mb=2048, checkpoint=None):
+    """Matrix of inner products <flow_i, flow_j> of all the flows of a store.
+    @param store: flow store (see flow_store.py).
+    @param mask: boolean mask (Z, Y, X) of the voxels to use (e.g., the spherical mask of the flows).
+    @param memory_mb: memory budget for the blocks of flows in MB.
+    @param checkpoint: root name of the checkpoint files (None for no checkpoint).
+    @return: the N x N matrix.
+    """
+    n = len(store)
+    n_features = 3 * (int(np.sum(mask)) if mask is not None else int(np.prod(store.shape)))
+    b = block_size(n_features, memory_mb, n)
+    starts = list(range(0, n, b))
+    if checkpoint is not None:
+        ckpt = _Checkpoint(checkpoint, n, b)
+        metric_mat = ckpt.matrix
+    else:
+        ckpt = None
+        metric_mat = np.zeros([n, n])
+
+    for bi, i0 in enumerate(starts):
+        i1 = min(i0 + b, n)
+        Fi = None
+        for bj in range(bi, len(starts)):
+            if ckpt is not None and ckpt.done(bi, bj):
+                continue
+            j0 = starts[bj]
+            j1 = min(j0 + b, n)
+            print('finding the correlation matrix tile rows %d-%d, columns %d-%d' % (i0 + 1, i1, j0 + 1, j1))
+            if Fi is None:
+                Fi = flow_rows(store, i0, i1, mask)
+            Fj = Fi if bj == bi else flow_rows(store, j0, j1, mask)
+            tile = np.matmul(Fi, Fj.T)
+            metric_mat[i0:i1, j0:j1] = tile
+            metric_mat[j0:j1, i0:i1] = tile.T
+            if ckpt is not None:
+                ckpt.save(bi, bj)
+
+    metric_mat = np.array(metric_mat)
+    if ckpt is not None:
+        ckpt.clean()
+    return metric_mat
+
+
+def update_flow_gram_matrix(store, old_matrix, old_keys, keys, mask=None, memory_mb=2048):
+    """Matrix of inner products of the flows of a store, reusing a matrix calculated before.
+    Only the rows (and columns) of the flows that are not in the old matrix are calculated.
+    @param old_matrix: matrix of a previous calculation.
+    @param old_keys: key (volume id, flow hash) of each row of the old matrix.
+    @param keys: key (volume id, flow hash) of each flow of the store.
+    @return: the N x N matrix.
+    """
+    n = len(store)
+    old_index = {tuple(k): i for i, k in enumerate(old_keys)}
+    kept = [slot for slot, k in enumerate(keys) if tuple(k) in old_index]
+    new = [slot for slot, k in enumerate(keys) if tuple(k) not in old_index]
+    print('%d rows of the correlation matrix are reused, %d rows are calculated' % (len(kept), len(new)))
+    metric_mat = np.zeros([n, n])
+    if kept:
+        old = [old_index[tuple(keys[slot])] for slot in kept]
+        metric_mat[np.ix_(kept, kept)] = np.asarray(old_matrix)[np.ix_(old, old)]
+    if not new:
+        return metric_mat
+
+    n_features = 3 * (int(np.sum(mask)) if mask is not None else int(np.prod(store.shape)))
+    b = block_size(n_features, memory_mb, n)
+    for r0 in range(0, len(new), b):
+        rows = new[r0:r0 + b]
+        Fr = _flatten(store[rows], mask)
+        for c0 in range(0, n, b):
+            cols = list(range(c0, min(c0 + b, n)))
+            print('finding the correlation matrix rows of %d new flows, columns %d-%d'
+                  % (len(rows), c0 + 1, cols[-1] + 1))
+            tile = np.matmul(Fr, flow_rows(store, c0, cols[-1] + 1, mask).T)
+            metric_mat[np.ix_(rows, cols)] = tile
+            metric_mat[np.ix_(cols, rows)] = tile.T
+    return metric_mat
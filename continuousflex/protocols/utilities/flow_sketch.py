@@ -0,0 +1,135 @@
+# Randomized sketches of optical flows, for sets too large for the N x N matrix of inner products.
+# Each flow (voxels inside the mask, flattened) is projected onto k coordinates of a structured random
+# transform: random signs, an orthonormal DCT, and k randomly chosen coefficients scaled by sqrt(D / k).
+# The transform preserves inner products in expectation, so <flow_i, flow_j> ~ <sketch_i, sketch_j>, and the
+# sketches (N x k) can be used instead of the matrix for dimensionality reduction and clustering.
+# The sketches are kept in a .npy file opened as a memory map, a row full of NaN has not been sketched yet, and each
+# row is keyed by the id of its volume, the encoding of the store and the hash of the flow it sketches, as recorded
+# when the row is written (by the workers of optflow_engine.py, or by sketch_store), so that finding the rows to
+# sketch does not read the flows: rows without a key, or sketched from a store with another encoding (the lossy
+# encodings change the flows), are sketched again.
+import os
+import numpy as np
+from scipy.fft import dct
+from continuousflex.protocols.utilities.flow_store import flow_hash
+
+# Key of a row: id of the volume, encoding of the store and hash of the flow that was sketched (see
+# flow_store.flow_hash), the hash is empty for rows not sketched yet
+SKETCH_KEY = np.dtype([('id', '<i8'), ('encoding', '<u4'), ('hash', 'S32')])
+
+# Transforms already drawn, by (number of features, sketch size, seed)
+_projections = {}
+
+
+def _projection(n_features, k, seed):
+    key = (n_features, k, seed)
+    if key not in _projections:
+        rng = np.random.default_rng(seed)
+        signs = rng.choice([-1.0, 1.0], size=n_features)
+        coefficients = np.sort(rng.choice(n_features, size=min(k, n_features), replace=False))
+        _projections[key] = (signs, coefficients)
+    return _projections[key]
+
+
+def sketch_flow(flow, mask, k, seed=0):
+    """Sketch of one flow.
+    @param flow: flow of shape (3, Z, Y, X).
+    @param mask: boolean mask (Z, Y, X) of the voxels to use.
+    @param k: size of the sketch.
+    @param seed: seed of the random transform (the same for all the flows of a set).
+    @return: vector of size k.
+    """
+    x = np.asarray(flow, dtype=np.float64)[:, mask].ravel()
+    signs, coefficients = _projection(x.size, k, seed)
+    y = dct(x * signs, norm='ortho')
+    return y[coefficients] * np.sqrt(x.size / len(coefficients))
+
+
+def sketch_keys_path(path):
+    """File with the key (volume id, store encoding, hash of the sketched flow) of each row of a sketches file."""
+    return os.path.splitext(path)[0] + '_keys.npy'
+
+
+def open_sketches(path, ids=None, k=None):
+    """Open the sketches file, it is created (empty) if it does not exist.
+    If the ids or the sketch size k changed (e.g., volumes were appended), the file is rebuilt keeping the rows of the
+    ids found in both (when k is the same), so that only the new flows are sketched.
+    """
+    keys_path = sketch_keys_path(path)
+    old = None
+    if os.path.exists(path) and os.path.exists(keys_path):
+        sketches = np.load(path, mmap_mode='r+')
+        if ids is None:
+            return sketches
+        keys = np.load(keys_path)
+        if sketches.shape[1] == k and [int(i) for i in keys['id']] == [int(i) for i in ids]:
+            return sketches
+        old = (sketches, keys)
+    ids = np.asarray(ids, dtype='<i8')
+    sketches = np.lib.format.open_memmap(path + '.tmp.npy', mode='w+', dtype=np.float32, shape=(len(ids), k))
+    sketches[:] = np.nan
+    keys = np.zeros(len(ids), dtype=SKETCH_KEY)
+    keys['id'] = ids
+    if old is not None and old[0].shape[1] == k:
+        rows = {int(objId): row for row, objId in enumerate(old[1]['id'])}
+        for slot, objId in enumerate(ids):
+            row = rows.get(int(objId))
+            if row is not None:
+                sketches[slot] = old[0][row]
+                keys[slot] = old[1][row]
+    sketches.flush()
+    del sketches, old
+    np.save(keys_path + '.tmp.npy', keys)
+    os.replace(path + '.tmp.npy', path)
+    os.replace(keys_path + '.tmp.npy', keys_path)
+    return np.load(path, mmap_mode='r+')
+
+
+def missing_sketches(sketches, keys=None, encoding=None):
+    """Rows that have not been sketched yet, or that were sketched from a store with another encoding.
+    @param keys: keys of the rows (see sketch_keys_path), with encoding the one of the current store.
+    """
+    missing = np.isnan(sketches[:, 0])
+    if keys is not None:
+        missing |= (keys['hash'] == b'') | (keys['encoding'] != encoding)
+    return [int(i) for i in np.flatnonzero(missing)]
+
+
+def sketch_store(store, sketches, mask, path, seed=0):
+    """Sketch the flows of a store whose rows are missing or out of date, only those flows are read.
+    @param path: sketches file (its keys are updated).
+    """
+    k = sketches.shape[1]
+    keys = np.load(sketch_keys_path(path), mmap_mode='r+')
+    for slot in missing_sketches(sketches, keys, store.encoding):
+        print('sketching optical flow ', slot + 1)
+        flow = store[slot]
+        sketches[slot] = sketch_flow(flow, mask, k, seed)
+        keys[slot] = (store.ids[slot], store.encoding, flow_hash(flow))
+    sketches.flush()
+    keys.flush()
+
+
+def approximate_gram(sketches, rows=None, cols=None):
+    """Approximate inner products between flows, recovered from their sketches.
+    @param rows: indexes of the rows (all if None).
+    @param cols: indexes of the columns (all if None).
+    """
+    S = np.asarray(sketches, dtype=np.float64)
+    Sr = S if rows is None else S[rows]
+    Sc = S if cols is None else S[cols]
+    return np.matmul(Sr, Sc.T)
+
+
+def flows_from_sketches(store, sketches, points):
+    """Flows whose sketches are the given points (e.g., from an inverse PCA), as combinations of the flows.
+    The coefficients c of each point s are the least squares solution of S^T c = s, and the flow is F^T c.
+    @param points: array (P x k) of sketch vectors.
+    @return: array (P x 3 x Z x Y x X).
+    """
+    S = np.asarray(sketches, dtype=np.float64)
+    coefficients = np.matmul(np.linalg.pinv(S.T), np.transpose(points))
+    flows = np.zeros((np.shape(points)[0], 3) + tuple(store.shape))
+    for slot in range(len(store)):
+        flows += np.multiply.outer(coefficients[slot], store[slot])
+    return np.float32(flows)
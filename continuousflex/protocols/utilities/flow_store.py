@@ -0,0 +1,301 @@
+# Single-file store for the optical flows of a whole set of volumes.
+# The flows are kept as one contiguous array with one slot per flow, preceded by a small header, so that the file
+# can be opened with np.memmap and one flow can be read without parsing any further header.
+# Flows are masked by a sphere (everything outside is zero), so besides full float32 cubes (N, 3, Z, Y, X), a store
+# can keep only the voxels inside the sphere: as float32 (lossless), float16, or 8-bit codes quantized by blocks of
+# values (each block has its own minimum and step). Reading a flow gives a full (3, Z, Y, X) cube for all encodings
+# (a zero-copy view for full cubes), and the maximum error of each lossy flow is kept when it is written.
+#
+# Layout of the file:
+#   header (64 bytes): magic, version, data offset, N, Z, Y, X, encoding, radius of the sphere
+#   ids    (N x int64): id of the volume (metadata objId) of each slot
+#   done   (N x uint8): 1 when the flow of the slot has been written completely
+#   errors (N x float32, version 2): maximum absolute error of the encoded flow of each slot
+#   data   starting at the data offset (aligned to 64 bytes):
+#          ENCODING_FULL      N x 3 x Z x Y x X float32
+#          ENCODING_SPHERE    N x 3 x V float32 (V voxels inside the sphere)
+#          ENCODING_SPHERE16  N x 3 x V float16
+#          ENCODING_SPHERE8   N x 3V uint8 codes, then (aligned) N x B x 2 float32 (minimum, step) of the B blocks
+import os
+import struct
+from glob import glob
+import numpy as np
+
+FLOW_STORE = 'flows.flw'
+MAGIC = b'CFXFLOW\x00'
+VERSION = 2
+_HEADER = struct.Struct('<8sIQQQQQII')
+_HEADER_SIZE = 64
+_ALIGN = 64
+
+ENCODING_FULL = 0
+ENCODING_SPHERE = 1
+ENCODING_SPHERE16 = 2
+ENCODING_SPHERE8 = 3
+ENCODING_NAMES = ['full float32 volumes', 'float32 voxels inside the sphere', 'float16 voxels inside the sphere',
+                  '8-bit voxels inside the sphere, quantized by blocks']
+
+# Number of values quantized together (ENCODING_SPHERE8)
+QUANT_BLOCK = 4096
+
+
+def spherical_mask(shape, radius=None):
+    """Boolean mask of the voxels inside a sphere centred on the volume.
+    It follows the convention of 'xmipp_transform_mask --mask circular -radius' (center at size//2).
+    @param shape: shape of the volume.
+    @param radius: radius of the sphere in voxels (default is half the smallest dimension).
+    @return: mask with True inside the sphere.
+    """
+    if radius is None:
+        radius = min(shape) // 2
+    grids = np.ogrid[tuple(slice(0, n) for n in shape)]
+    r2 = sum((g - n // 2) ** 2 for g, n in zip(grids, shape))
+    return r2 <= radius ** 2
+
+
+def _aligned(offset):
+    return ((offset + _ALIGN - 1) // _ALIGN) * _ALIGN
+
+
+def _data_offset(n, version=VERSION):
+    offset = _HEADER_SIZE + 8 * n + n
+    if version >= 2:
+        offset += 4 * n
+    return _aligned(offset)
+
+
+def _n_blocks(n_values):
+    return (n_values + QUANT_BLOCK - 1) // QUANT_BLOCK
+
+
+def _data_size(n, shape, encoding, n_inside):
+    """Size in bytes of the data of n flows (the block parameters of ENCODING_SPHERE8 included)."""
+    if encoding == ENCODING_FULL:
+        return 4 * n * 3 * int(np.prod(shape))
+    if encoding == ENCODING_SPHERE:
+        return 4 * n * 3 * n_inside
+    if encoding == ENCODING_SPHERE16:
+        return 2 * n * 3 * n_inside
+    return _aligned(n * 3 * n_inside) + 4 * n * 2 * _n_blocks(3 * n_inside)
+
+
+class FlowStore(object):
+    """ Memory-mapped store of N optical flows of shape (3, Z, Y, X). """
+
+    def __init__(self, path, mode='r'):
+        """ Open an existing store.
+        @param path: store file.
+        @param mode: 'r' to read the flows, 'r+' to write them.
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, offset, n, nz, ny, nx, encoding, radius = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC:
+            raise IOError('%s is not an optical flow store' % path)
+        if version > VERSION:
+            raise IOError('%s was written by a newer version (%d) of the optical flow store' % (path, version))
+        self.n = n
+        self.shape = (nz, ny, nx)
+        # stores of version 1 have zeros here (full volumes)
+        self.encoding = encoding
+        self.radius = radius
+        self.ids = np.memmap(path, dtype='<i8', mode='r', offset=_HEADER_SIZE, shape=(n,))
+        self._done = np.memmap(path, dtype=np.uint8, mode=mode, offset=_HEADER_SIZE + 8 * n, shape=(n,))
+        if version >= 2:
+            self.errors = np.memmap(path, dtype='<f4', mode=mode, offset=_HEADER_SIZE + 9 * n, shape=(n,))
+        else:
+            self.errors = np.zeros(n, dtype=np.float32)
+        if encoding == ENCODING_FULL:
+            self.mask = None
+            self.data = np.memmap(path, dtype='<f4', mode=mode, offset=offset, shape=(n, 3, nz, ny, nx))
+        else:
+            self.mask = spherical_mask(self.shape, radius)
+            n_inside = int(np.sum(self.mask))
+            if encoding == ENCODING_SPHERE8:
+                self.data = np.memmap(path, dtype=np.uint8, mode=mode, offset=offset, shape=(n, 3 * n_inside))
+                self._blocks = np.memmap(path, dtype='<f4', mode=mode, offset=offset + _aligned(n * 3 * n_inside),
+                                         shape=(n, _n_blocks(3 * n_inside), 2))
+            else:
+                dtype = '<f4' if encoding == ENCODING_SPHERE else '<f2'
+                self.data = np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=(n, 3, n_inside))
+        self._slots = {int(objId): slot for slot, objId in enumerate(self.ids)}
+
+    @classmethod
+    def create(cls, path, ids, shape, encoding=ENCODING_FULL, radius=None):
+        """ Create an empty store (the file is allocated but not written).
+        @param ids: ids of the volumes, one slot per id in the same order.
+        @param shape: shape (Z, Y, X) of the volumes.
+        @param encoding: one of the ENCODING_ constants.
+        @param radius: radius of the sphere kept by the compact encodings (default is half the smallest dimension).
+        """
+        ids = np.asarray(ids, dtype='<i8')
+        n = len(ids)
+        nz, ny, nx = [int(d) for d in shape]
+        if radius is None:
+            radius = min(nz, ny, nx) // 2
+        n_inside = int(np.sum(spherical_mask((nz, ny, nx), radius))) if encoding != ENCODING_FULL else 0
+        offset = _data_offset(n)
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, offset, n, nz, ny, nx, encoding, radius).ljust(_HEADER_SIZE, b'\x00'))
+            f.write(ids.tobytes())
+            f.write(bytes(n))
+            f.truncate(offset + _data_size(n, (nz, ny, nx), encoding, n_inside))
+        return cls(path, mode='r+')
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, item):
+        """ Flows as full (3, Z, Y, X) cubes, e.g. store[i] is flow i and store[i, 0] its x component.
+        For full volumes it is a zero-copy view, the compact encodings are decoded.
+        """
+        if self.encoding == ENCODING_FULL:
+            return self.data[item]
+        key = item if isinstance(item, tuple) else (item,)
+        slots = key[0]
+        if isinstance(slots, (int, np.integer)):
+            return self._decode(int(slots))[key[1:]]
+        slots = range(self.n)[slots] if isinstance(slots, slice) else slots
+        flows = np.zeros((len(slots), 3) + self.shape, dtype=np.float32)
+        for i, slot in enumerate(slots):
+            flows[i] = self._decode(int(slot))
+        return flows[(slice(None),) + key[1:]]
+
+    def _decode(self, slot):
+        flow = np.zeros((3,) + self.shape, dtype=np.float32)
+        if self.encoding == ENCODING_SPHERE8:
+            codes = np.float32(self.data[slot])
+            blocks = np.repeat(self._blocks[slot], QUANT_BLOCK, axis=0)[:len(codes)]
+            flow[:, self.mask] = np.reshape(blocks[:, 0] + codes * blocks[:, 1], [3, -1])
+        else:
+            flow[:, self.mask] = self.data[slot]
+        return flow
+
+    def _encode(self, slot, flow):
+        """ Write a flow in the encoding of the store, return the maximum absolute error. """
+        if self.encoding == ENCODING_FULL:
+            self.data[slot] = flow
+            return 0.
+        values = np.asarray(flow, dtype=np.float32)[:, self.mask]
+        if self.encoding == ENCODING_SPHERE8:
+            values = values.ravel()
+            pad = (-len(values)) % QUANT_BLOCK
+            blocks = np.reshape(np.concatenate([values, np.repeat(values[-1:], pad)]), [-1, QUANT_BLOCK])
+            low = blocks.min(axis=1)
+            step = (blocks.max(axis=1) - low) / 255
+            step[step == 0] = 1
+            codes = np.round((blocks - low[:, None]) / step[:, None]).ravel()[:len(values)]
+            self.data[slot] = np.uint8(codes)
+            self._blocks[slot] = np.stack([low, step], axis=1)
+        else:
+            self.data[slot] = values
+        stored = self._decode(slot)[:, self.mask]
+        return float(np.max(np.abs(stored - np.asarray(flow, dtype=np.float32)[:, self.mask]), initial=0))
+
+    def slot(self, objId):
+        """ Position in the store of the flow of volume objId. """
+        return self._slots[int(objId)]
+
+    def flow(self, objId):
+        return self[self.slot(objId)]
+
+    def write(self, slot, flow):
+        """ Write the flow of a slot and mark it as done.
+        @return: the maximum absolute error of the stored flow (0 for the lossless encodings).
+        """
+        error = self._encode(slot, flow)
+        self.data.flush()
+        if self.encoding == ENCODING_SPHERE8:
+            self._blocks.flush()
+        if isinstance(self.errors, np.memmap):
+            self.errors[slot] = error
+            self.errors.flush()
+        self._done[slot] = 1
+        self._done.flush()
+        return error
+
+    def is_done(self, slot):
+        return bool(self._done[slot])
+
+    def missing(self):
+        """ Slots whose flows have not been written yet. """
+        return [int(slot) for slot in np.flatnonzero(self._done == 0)]
+
+    def flush(self):
+        self.data.flush()
+        self._done.flush()
+
+    def report(self):
+        """ Size of the store compared to full float32 volumes and maximum error of the encoding. """
+        full = 4 * self.n * 3 * int(np.prod(self.shape))
+        size = os.path.getsize(self.path)
+        return 'optical flows stored as %s: %.1f MB (%.1f times smaller than full volumes), ' \
+               'maximum absolute error %g' % (ENCODING_NAMES[self.encoding], size / 1024 ** 2, full / max(size, 1),
+                                             float(np.max(self.errors, initial=0)))
+
+
+def flow_store_path(folder):
+    return os.path.join(folder, FLOW_STORE)
+
+
+def open_flow_store(folder, ids=None, shape=None, encoding=None):
+    """ Open the store of a folder of optical flows, creating it if needed.
+    If the store does not exist but the folder has flows saved as x/y/z spider files (older runs),
+    then they are converted into a store.
+    @param ids: ids of the volumes (to create a new store).
+    @param shape: shape (Z, Y, X) of the volumes (to create a new store).
+    @param encoding: encoding of the flows (to create a new store, default is full volumes); an existing store
+                     with another encoding is converted.
+    @return: a store opened for reading and writing.
+    """
+    path = flow_store_path(folder)
+    if os.path.exists(path):
+        store = FlowStore(path, mode='r+')
+        same_ids = ids is None or [int(i) for i in ids] == [int(i) for i in store.ids]
+        if same_ids and (encoding is None or encoding == store.encoding):
+            return store
+        # the set of volumes changed (e.g., new volumes were appended), keep the flows already calculated
+        return _rebuild_flow_store(store, store.ids if ids is None else ids,
+                                   store.encoding if encoding is None else encoding)
+    if encoding is None:
+        encoding = ENCODING_FULL
+    triplets = sorted(glob(os.path.join(folder, '*_opflowx.spi')))
+    if ids is None and not triplets:
+        raise IOError('No optical flows found in %s' % folder)
+    if triplets:
+        from continuousflex.protocols.utilities.spider_files3 import open_volume
+        if ids is None:
+            ids = [int(os.path.basename(fn).split('_')[0]) for fn in triplets]
+        shape = np.shape(open_volume(triplets[0]))
+        store = FlowStore.create(path, ids, shape, encoding)
+        for slot, objId in enumerate(ids):
+            root = os.path.join(folder, str(objId).zfill(6) + '_opflow')
+            if not os.path.exists(root + 'x.spi'):
+                continue
+            store.write(slot, [open_volume(root + c + '.spi') for c in 'xyz'])
+        return store
+    return FlowStore.create(path, ids, shape, encoding)
+
+
+def _rebuild_flow_store(store, ids, encoding):
+    """ Copy a store into a new one with other ids (or encoding), keeping the flows of the ids found in both. """
+    path = store.path
+    new_store = FlowStore.create(path + '.tmp', ids, store.shape, encoding)
+    for slot, objId in enumerate(new_store.ids):
+        objId = int(objId)
+        if objId in store._slots and store.is_done(store.slot(objId)):
+            new_store.write(slot, store.flow(objId))
+    del store, new_store
+    os.replace(path + '.tmp', path)
+    return FlowStore(path, mode='r+')
+
+
+def flow_hash(flow):
+    """ Content hash of a flow (as read from a store). """
+    import hashlib
+    return hashlib.blake2b(np.ascontiguousarray(flow, dtype=np.float32).tobytes(), digest_size=16).hexdigest()
+
+
+def flow_hashes(store):
+    """ Content hash of each flow of a store (to know if a flow changed since it was used). """
+    return [flow_hash(store[slot]) for slot in range(len(store))]
@@ -0,0 +1,78 @@
+# Fused warp-and-score pass over the optical flows of a flow store.
+# A pool of long-lived workers loads the reference once, then for each volume reads its flow and the volume a
+# single time, warps the reference by the flow, and finds the normalized cross correlation, the normalized mean
+# square distance and the normalized mean absolute distance between the warped reference and the volume in one
+# streaming reduction (slab by slab, accumulating sums in double precision). The warped volume is written only if
+# an output path is given.
+import multiprocessing
+import time
+import numpy as np
+from continuousflex.protocols.utilities.flow_store import FlowStore
+from continuousflex.protocols.utilities.optflow_engine import read_volume, farneback_backend, BACKEND_GPU
+
+# State kept by each worker process between volumes
+_worker = {}
+
+# Number of z slices reduced at once
+SLAB = 16
+
+
+def warp_scores(warped, vol):
+    """Scores between a warped reference and a volume.
+    @return: (normalized cross correlation, mean square distance normalized by the mean square of warped,
+              mean absolute distance normalized by the mean absolute value of warped).
+    """
+    s = np.zeros(7)
+    for z in range(0, np.shape(warped)[0], SLAB):
+        w = np.asarray(warped[z:z + SLAB], dtype=np.float64).ravel()
+        v = np.asarray(vol[z:z + SLAB], dtype=np.float64).ravel()
+        d = w - v
+        s += [np.sum(w), np.sum(v), np.dot(w, w), np.dot(v, v), np.dot(w, v), np.sum(np.abs(d)),
+              np.sum(np.abs(w))]
+    sw, sv, sww, svv, swv, sad, saw = s
+    n = np.size(warped)
+    mw, mv = sw / n, sv / n
+    ncc = (swv / n - mw * mv) / np.sqrt((sww / n - mw ** 2) * (svv / n - mv ** 2))
+    msd = (sww - 2 * swv + svv) / sww
+    mad = sad / saw
+    return ncc, msd, mad
+
+
+def _init_worker(path_reference, path_store, backend):
+    _worker['warp'] = farneback_backend(backend).warp_by_flow
+    _worker['reference'] = read_volume(path_reference)
+    _worker['store'] = FlowStore(path_store, mode='r')
+
+
+def _process_volume(job):
+    slot, path_vol, path_out = job
+    t0 = time.time()
+    warped = _worker['warp'](_worker['reference'], np.array(_worker['store'][slot]))
+    if path_out is not None:
+        from continuousflex.protocols.utilities.spider_files3 import save_volume
+        save_volume(warped, path_out)
+    scores = warp_scores(warped, read_volume(path_vol))
+    return slot, scores, time.time() - t0
+
+
+def warp_and_score(path_reference, path_store, jobs, n_jobs=1, backend=BACKEND_GPU):
+    """Warp the reference by the flows of a store and score each warped copy against its volume.
+    @param path_reference: reference volume (the same for all the flows).
+    @param path_store: flow store with the flows.
+    @param jobs: list of tuples (slot in the store, path_vol_i, path of the warped volume or None to not save it).
+    @param n_jobs: number of workers processing volumes in parallel.
+    @param backend: backend of warp_by_flow (see optflow_engine.py).
+    @return: array (N jobs x 3) with the scores (see warp_scores) in the order of the jobs.
+    """
+    scores = np.zeros([len(jobs), 3])
+    if not jobs:
+        return scores
+    row = {job[0]: i for i, job in enumerate(jobs)}
+    n_jobs = max(1, min(int(n_jobs), len(jobs)))
+    # spawn (not fork) to get clean CUDA contexts in the workers
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes=n_jobs, initializer=_init_worker, initargs=(path_reference, path_store, backend)) as pool:
+        for slot, score, spent in pool.imap_unordered(_process_volume, jobs):
+            print('optical flow ', slot + 1, ' warped and scored in ', np.round(spent, 2), ' seconds')
+            scores[row[slot]] = score
+    return scores
@@ -0,0 +1,87 @@
+# Indexed reconciliation of image paths and item ids between metadata files and the input set.
+# The results of the xmipp programs (or metadata imported from another project or computer) lose the item ids and
+# may have other paths than the input set. Instead of scanning the input for every row, the input is indexed once by
+# full path, by basename, by stack location (index, basename of the stack) and by item id, and each row of a
+# metadata is matched with dictionary lookups, in the same order of preference as before: the same path, then for
+# stacks the item whose id is the stack index (or the same location in a stack with the same name), and otherwise
+# the item with the same basename.
+from os.path import basename
+import pwem.emlib.metadata as md
+
+
+def split_location(path):
+    """Stack index (0 if the path is not in a stack) and file name of a location 'index@file' or 'file'."""
+    if '@' in path:
+        index, fn = path.split('@', 1)
+        if index.isdigit():
+            return int(index), fn
+    return 0, path
+
+
+class LocationIndex(object):
+    """Items (path, item id) of an input, indexed by path, basename, stack location and id."""
+
+    def __init__(self):
+        self.by_path = {}
+        self.by_basename = {}
+        self.by_location = {}
+        self.by_id = {}
+
+    def add(self, path, item_id):
+        item = (path, int(item_id))
+        index, fn = split_location(path)
+        self.by_path.setdefault(path, item)
+        self.by_id.setdefault(item[1], item)
+        if index:
+            self.by_location.setdefault((index, basename(fn)), item)
+        else:
+            self.by_basename.setdefault(basename(path), item)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    @classmethod
+    def from_set(cls, inputSet):
+        """Index of a set of particles or volumes, with the locations written by xmipp3.convert."""
+        from xmipp3.convert import getImageLocation
+        index = cls()
+        for item in inputSet:
+            index.add(getImageLocation(item), item.getObjId())
+        return index
+
+    @classmethod
+    def from_metadata(cls, fnMd):
+        """Index of a metadata file (or md.MetaData) with image paths and item ids."""
+        mdIn = fnMd if isinstance(fnMd, md.MetaData) else md.MetaData(fnMd)
+        index = cls()
+        for objId in mdIn:
+            index.add(mdIn.getValue(md.MDL_IMAGE, objId), mdIn.getValue(md.MDL_ITEM_ID, objId))
+        return index
+
+    def lookup(self, path):
+        """Item (path, item id) matching a path, or None."""
+        if path in self.by_path:
+            return self.by_path[path]
+        index, fn = split_location(path)
+        if index:
+            # Consider the index is the id in the input set
+            return self.by_id.get(index) or self.by_location.get((index, basename(fn)))
+        return self.by_basename.get(basename(path))
+
+
+def reconcile_metadata(mdImgs, index, update_paths=True):
+    """Set the item id (and the path of the input item) of each row of a metadata, in one pass.
+    @param mdImgs: md.MetaData modified in place.
+    @param index: LocationIndex of the input.
+    @param update_paths: replace the image paths by the ones of the input, otherwise only the item ids are set.
+    @return: mdImgs.
+    """
+    for objId in mdImgs:
+        imgPath = mdImgs.getValue(md.MDL_IMAGE, objId)
+        item = index.lookup(imgPath)
+        if item is None:
+            raise Exception('%s does not match any item of the input' % imgPath)
+        if update_paths:
+            mdImgs.setValue(md.MDL_IMAGE, item[0], objId)
+        mdImgs.setValue(md.MDL_ITEM_ID, item[1], objId)
+    return mdImgs
@@ -0,0 +1,62 @@
+# Missing wedge masks evaluated directly on the Fourier grid.
+# The mask of a tilt series with tilt angles in [tiltLow, tiltHigh] is 1 where the Fourier coefficients are measured
+# and 0 in the missing wedge, with the zero frequency at size//2 (it is used after fftshift). It is the same mask as
+# the one the protocols used to draw and rotate with 'xmipp_transform_geometry --rotate_volume euler 0 90 0', and the
+# mask of an aligned subtomogram is the same wedge sampled at rotated frequencies, so each mask is computed in memory
+# when it is needed, from the tilt range and the alignment, instead of being rotated and written per subtomogram.
+# The masks are binary: they can be kept as booleans, or packed to one bit per voxel.
+import numpy as np
+from continuousflex.protocols.utilities.euler_transforms import euler_matrices
+
+# Decimals of the rotated frequencies (the frequencies on the axes of the wedge stay exactly on them)
+_DECIMALS = 6
+
+
+def wedge_mask(size, tilt_range, matrix=None):
+    """Missing wedge mask of a volume.
+    @param size: side of a cubic volume in voxels, or shape (Z, Y, X) of the volume.
+    @param tilt_range: (tiltLow, tiltHigh) in degrees.
+    @param matrix: 3 x 3 (or 4 x 4, the shifts are ignored) matrix P, the mask is sampled at P k like a volume aligned
+                   by volume_average.transform_volume (e.g., P of volume_average.alignment_matrix), or None.
+    @return: boolean mask (Z, Y, X).
+    """
+    shape = (int(size),) * 3 if np.isscalar(size) else tuple(int(n) for n in size)
+    # frequencies in units of the largest side, so that the angles of the wedge are the same along all the axes
+    z, y, x = np.meshgrid(*[(np.arange(n, dtype=np.float64) - n // 2) * (max(shape) / n) for n in shape],
+                          indexing='ij', sparse=True)
+    # frequencies in the frame of the wedge before its rotation by euler 0 90 0
+    R = np.linalg.inv(euler_matrices(0, 90, 0))[:3, :3]
+    if matrix is not None:
+        R = np.matmul(R, np.asarray(matrix, dtype=np.float64)[:3, :3])
+    u = np.round(R[2, 0] * x + R[2, 1] * y + R[2, 2] * z, _DECIMALS)
+    v = np.round(R[0, 0] * x + R[0, 1] * y + R[0, 2] * z, _DECIMALS)
+    angles = np.rad2deg(np.arctan(np.divide(v, u, out=np.zeros(np.broadcast(u, v).shape), where=u != 0)))
+    mask = (angles <= -tilt_range[0]) & (angles >= -tilt_range[1]) & (u != 0)
+    # on the plane u = 0 only the line v = 0 is measured
+    return mask | ((u == 0) & (v == 0))
+
+
+def pack_mask(mask):
+    """Mask packed to one bit per voxel."""
+    return np.packbits(mask.ravel())
+
+
+def unpack_mask(bits, shape):
+    """Boolean mask of a packed mask."""
+    return np.unpackbits(bits, count=int(np.prod(shape))).reshape(shape).astype(bool)
+
+
+class RotatedWedge(object):
+    """Missing wedge mask of one aligned subtomogram, computed when it is called (see wedge_mask)."""
+
+    def __init__(self, size, tilt_range, matrix=None):
+        self.size = int(size) if np.isscalar(size) else tuple(int(n) for n in size)
+        self.tilt_range = (float(tilt_range[0]), float(tilt_range[1]))
+        self.matrix = None if matrix is None else np.asarray(matrix, dtype=np.float64)[:3, :3]
+
+    def __call__(self):
+        return wedge_mask(self.size, self.tilt_range, self.matrix)
+
+    def __repr__(self):
+        matrix = None if self.matrix is None else np.round(self.matrix, _DECIMALS).tolist()
+        return 'wedge(%s, %g, %g, %s)' % (self.size, self.tilt_range[0], self.tilt_range[1], matrix)
@@ -0,0 +1,233 @@
+# In-process engine that finds the 3D optical flows of a set of volumes against one reference.
+# A pool of long-lived workers is started once, each worker imports the Farneback backend (farneback3d on the GPU,
+# or its NumPy/SciPy port on the CPU) and loads (and scales) the reference a single time, then takes volumes from
+# the queue until the whole set is processed.
+# The flows are written into the slots of a flow store (see flow_store.py), and optionally sketched as soon as
+# they are calculated (see flow_sketch.py).
+# With the CPU backend, the pyramid of polynomial expansions of the reference is found once (before the workers
+# start) and cached on disk in a temporary folder of the protocol, keyed by the content of the reference and the
+# parameters, so that every flow against the same reference reuses it (the workers then never load the reference
+# itself, unless they also warp it in the fused mode). The CPU backend can also start a flow from a previous one
+# (e.g., the flow of the same volume in the previous refinement iteration).
+# In the fused mode (one refinement iteration of TomoFlow), each worker also prepares the volume in memory (filling its
+# missing wedge with the reference, aligning it and masking it) before finding its flow, then warps the reference by
+# the flow and writes the warped volume, so that the filled and aligned volumes are never written.
+import hashlib
+import multiprocessing
+import os
+import time
+import numpy as np
+from continuousflex.protocols.utilities.flow_store import FlowStore, spherical_mask, flow_hash
+from continuousflex.protocols.utilities.flow_sketch import sketch_flow, sketch_keys_path
+
+# Backends of the 3D Farneback optical flow
+BACKEND_GPU = 0
+BACKEND_CPU = 1
+
+# State kept by each worker process between volumes
+_worker = {}
+
+
+def farneback_backend(backend=BACKEND_GPU):
+    """Module with the Farneback class and warp_by_flow of a backend (farneback3d or farneback3d_cpu)."""
+    if backend == BACKEND_CPU:
+        from continuousflex.protocols.utilities import farneback3d_cpu
+        return farneback3d_cpu
+    import farneback3d
+    return farneback3d
+
+
+def read_volume(path):
+    """Read a volume (spider, mrc, or a location inside a stack 'index@file') into a float32 array."""
+    from pwem.emlib.image import ImageHandler
+    return np.float32(ImageHandler().read(path).getData())
+
+
+def reference_pyramid(path_vol0, factor1, optflow, cache_dir=None):
+    """Path of the cached polynomial expansions of a reference (CPU backend), they are found if not cached yet.
+    @param optflow: farneback3d_cpu.Farneback with the parameters of the flows.
+    @param cache_dir: folder of the cache (e.g., the tmp folder of the protocol), the folder of the reference if None.
+    """
+    key = hashlib.blake2b(digest_size=8)
+    with open(path_vol0, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            key.update(chunk)
+    key.update(repr((factor1, optflow.pyr_scale, optflow.levels, optflow.poly_n, optflow.poly_sigma)).encode())
+    root = os.path.splitext(path_vol0)[0]
+    if cache_dir is not None:
+        root = os.path.join(cache_dir, os.path.basename(root))
+    path = root + '_pyramid_' + key.hexdigest() + '.npz'
+    if not os.path.exists(path):
+        print('finding the polynomial expansions of the reference')
+        pyramid = optflow.expand_pyramid(read_volume(path_vol0) * factor1)
+        np.savez(path + '.tmp.npz', *pyramid)
+        os.replace(path + '.tmp.npz', path)
+    return path
+
+
+def rigid_displacement(shape, matrix):
+    """Displacement x' - x (3, Z, Y, X), x component first, of the rigid transform x' = A x + b of a volume.
+    @param matrix: 4 x 4 matrix [A b] acting on (x, y, z) centred on the volume (xmipp convention, center size//2).
+    """
+    nz, ny, nx = shape
+    z, y, x = np.mgrid[0:nz, 0:ny, 0:nx].astype(np.float32)
+    p = [x - nx // 2, y - ny // 2, z - nz // 2]
+    A = np.asarray(matrix, dtype=np.float32)
+    return np.stack([A[c, 0] * p[0] + A[c, 1] * p[1] + A[c, 2] * p[2] + A[c, 3] - p[c] for c in range(3)])
+
+
+def warm_start_flow(flow, matrix, warp_by_flow):
+    """Initial flow for a volume moved by a rigid transform since its flow was found.
+    If V'(x) = V(A x + b) and V(x) ~ ref(x + flow(x)), then V'(x) ~ ref(x + d(x) + flow(x + d(x))) with d the
+    rigid displacement, which is the returned flow.
+    """
+    d = rigid_displacement(np.shape(flow)[1:], matrix)
+    return np.float32(d + np.stack([warp_by_flow(np.float32(flow[c]), d) for c in range(3)]))
+
+
+def _farneback(backend, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, n_threads):
+    extra = {'n_threads': n_threads} if backend == BACKEND_CPU else {}
+    return farneback_backend(backend).Farneback(
+        pyr_scale=pyr_scale,  # Scaling between multi-scale pyramid levels
+        levels=levels,  # Number of multi-scale levels
+        winsize=winsize,  # Window size for Gaussian filtering of polynomial coefficients
+        num_iterations=iterations,  # Iterations on each multi-scale level
+        poly_n=poly_n,  # Size of window for weighted least-square estimation of polynomial coefficients
+        poly_sigma=poly_sigma,  # Sigma for Gaussian weighting of least-square estimation of polynomial coefficients
+        **extra
+    )
+
+
+def _load_pyramid(path_pyramid):
+    if path_pyramid is None:
+        return None
+    with np.load(path_pyramid) as pyramid:
+        return [pyramid['arr_%d' % i] for i in range(len(pyramid.files))]
+
+
+def _init_worker(path_vol0, path_store, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, factor1,
+                 factor2, mask_radius, sketch, backend, n_threads, path_pyramid, warm, fused):
+    _worker['store'] = FlowStore(path_store, mode='r+')
+    _worker['sketch'] = sketch
+    if sketch is not None:
+        _worker['sketches'] = np.load(sketch[0], mmap_mode='r+')
+        _worker['sketch_keys'] = np.load(sketch_keys_path(sketch[0]), mmap_mode='r+')
+    # the reference is only needed by the backends without a cached pyramid
+    _worker['vol0'] = read_volume(path_vol0) * factor1 if path_pyramid is None else None
+    _worker['factor2'] = factor2
+    _worker['outside'] = np.logical_not(spherical_mask(_worker['store'].shape, mask_radius))
+    _worker['optflow'] = _farneback(backend, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, n_threads)
+    _worker['pyramid'] = _load_pyramid(path_pyramid)
+    _worker['warm'] = None
+    if warm is not None:
+        path_prev_store, warm_levels, warm_iterations, path_warm_pyramid = warm
+        _worker['warm'] = {
+            'store': FlowStore(path_prev_store, mode='r'),
+            'optflow': _farneback(backend, pyr_scale, warm_levels, winsize, warm_iterations, poly_n, poly_sigma,
+                                  n_threads),
+            'pyramid': _load_pyramid(path_warm_pyramid),
+            'warp_by_flow': farneback_backend(backend).warp_by_flow}
+    _worker['fused'] = None
+    if fused is not None:
+        path_fill, path_wedge, path_mask = fused
+        _worker['fused'] = {
+            'reference': read_volume(path_vol0),
+            'fill': None if path_fill is None else read_volume(path_fill),
+            'wedge': None if path_wedge is None else read_volume(path_wedge),
+            'mask': None if path_mask is None else read_volume(path_mask),
+            'warp_by_flow': farneback_backend(backend).warp_by_flow}
+
+
+def _prepare_volume(vol, P):
+    from continuousflex.protocols.utilities.volume_average import transform_volume, fill_missing_wedge
+    fused = _worker['fused']
+    if fused['fill'] is not None:
+        # the reference in the frame of the volume (the inverse of its alignment)
+        vol = fill_missing_wedge(vol, transform_volume(fused['fill'], np.linalg.inv(P)), fused['wedge'])
+    vol = transform_volume(vol, P)
+    if fused['mask'] is not None:
+        vol = vol * fused['mask']
+    return vol
+
+
+def _process_volume(job):
+    objId, slot, path_vol1 = job[:3]
+    init = job[3] if len(job) > 3 else None
+    steps = job[4] if len(job) > 4 else None
+    t0 = time.time()
+    vol1 = read_volume(path_vol1)
+    if steps is not None:
+        vol1 = _prepare_volume(vol1, steps[0])
+    vol1 = vol1 * _worker['factor2']
+    warm = _worker['warm']
+    if init is not None and warm is not None:
+        # warm start from the previous flow of the volume, moved by the change of its alignment
+        prev_slot, matrix = init
+        init_flow = warm_start_flow(warm['store'][prev_slot], matrix, warm['warp_by_flow'])
+        flow = warm['optflow'].calc_flow(_worker['vol0'], vol1, cur_pyramid=warm['pyramid'], init_flow=init_flow)
+    elif _worker['pyramid'] is not None:
+        flow = _worker['optflow'].calc_flow(_worker['vol0'], vol1, cur_pyramid=_worker['pyramid'])
+    else:
+        flow = _worker['optflow'].calc_flow(_worker['vol0'], vol1)
+    # spherical mask with the maximum radius (everything outside is set to zero)
+    flow[:, _worker['outside']] = 0
+    if steps is not None:
+        # the warped reference is written before the flow is marked as done, so that a done flow always has a
+        # complete warped reference (a worker killed in between leaves the flow to be calculated again)
+        from continuousflex.protocols.utilities.spider_files3 import save_volume
+        save_volume(np.float32(_worker['fused']['warp_by_flow'](_worker['fused']['reference'], flow)), steps[1])
+    error = _worker['store'].write(slot, flow)
+    if _worker['sketch'] is not None:
+        path_sketch, k, seed = _worker['sketch']
+        _worker['sketches'][slot] = sketch_flow(flow, np.logical_not(_worker['outside']), k, seed)
+        _worker['sketches'].flush()
+        # keyed by the flow as it is stored (the lossy encodings change it)
+        _worker['sketch_keys'][slot] = (objId, _worker['store'].encoding, flow_hash(_worker['store'][slot]))
+        _worker['sketch_keys'].flush()
+    return objId, time.time() - t0, error
+
+
+def calculate_optical_flows(path_vol0, path_store, jobs, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma,
+                            factor1=100, factor2=100, mask_radius=None, n_jobs=1, sketch=None,
+                            backend=BACKEND_GPU, warm_start=None, fused=None, cache_dir=None):
+    """Find the optical flows between a reference and a set of volumes.
+    @param path_vol0: reference volume (the same for all the flows).
+    @param path_store: flow store where the flows are written (it should already exist).
+    @param jobs: list of tuples (objId, slot in the store, path_vol_i), or (objId, slot, path_vol_i, (previous slot,
+                 4 x 4 matrix)) to start from the flow of the previous store moved by the matrix (see warm_start_flow),
+                 or (objId, slot, path_vol_i, previous flow or None, (alignment matrix P, path of the warped reference))
+                 in the fused mode.
+    @param n_jobs: number of workers processing volumes in parallel (e.g., on the same GPU).
+    @param sketch: tuple (sketches file, sketch size, seed) to sketch each flow once calculated, or None.
+    @param backend: BACKEND_GPU (farneback3d) or BACKEND_CPU (farneback3d_cpu, the cores are shared by the workers).
+    @param warm_start: tuple (previous flow store, levels, iterations) for the jobs with a previous flow, or None.
+                       Only the CPU backend can start from a given flow, the GPU one starts all the flows from zero.
+    @param fused: tuple (reference filling the missing wedge or None, missing wedge mask or None, mask or None) to
+                  fill, align (volume_average.transform_volume by P) and mask each volume before finding its flow, then
+                  write the reference warped by the flow, or None to use the volumes as they are.
+    @param cache_dir: folder of the cached expansions of the reference (CPU backend), see reference_pyramid.
+    """
+    if not jobs:
+        return
+    n_jobs = max(1, min(int(n_jobs), len(jobs)))
+    n_threads = max(1, (multiprocessing.cpu_count() or 1) // n_jobs)
+    path_pyramid = None
+    warm = None
+    if backend == BACKEND_CPU:
+        optflow = _farneback(backend, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, n_threads)
+        path_pyramid = reference_pyramid(path_vol0, factor1, optflow, cache_dir)
+        if warm_start is not None:
+            path_prev_store, warm_levels, warm_iterations = warm_start
+            optflow = _farneback(backend, pyr_scale, warm_levels, winsize, warm_iterations, poly_n, poly_sigma,
+                                 n_threads)
+            warm = (path_prev_store, warm_levels, warm_iterations, reference_pyramid(path_vol0, factor1, optflow, cache_dir))
+    elif warm_start is not None:
+        print('the GPU optical flow cannot start from a given flow, all the flows are calculated from zero')
+    # spawn (not fork) to get clean CUDA contexts in the workers
+    ctx = multiprocessing.get_context('spawn')
+    initargs = (path_vol0, path_store, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, factor1, factor2,
+                mask_radius, sketch, backend, n_threads, path_pyramid, warm, fused)
+    with ctx.Pool(processes=n_jobs, initializer=_init_worker, initargs=initargs) as pool:
+        for objId, spent, error in pool.imap_unordered(_process_volume, jobs):
+            print('optical flow of volume ', objId, ' calculated in ', np.round(spent, 2), ' seconds',
+                  ' (maximum encoding error %g)' % error if error else '')
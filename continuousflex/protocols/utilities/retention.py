@@ -0,0 +1,195 @@
+# Retention of the intermediate files of an iterative protocol (e.g., the refinement iterations of TomoFlow).
+# Each step releases the intermediates (folders of volumes or flow stores) of an iteration once the next steps do not
+# need them anymore, and the manager keeps, compresses or removes them according to a policy and a disk budget.
+# The state (what was released, its size, and what is still on the disk) is kept in a json file, so that it survives
+# the steps (and the protocol being continued), and the bytes written by each iteration can be reported.
+# Compressed volumes are packed into one float16 .npz file per folder, and compressed flows are re-encoded with
+# float16 values inside the sphere (see flow_store.py).
+# The sampled volumes (KEEP_SAMPLE) are chosen once, as item ids, and kept in the state, so that every kind of
+# intermediate keeps the same volumes: each release gives the name (or slot) of each item in its folder (or store).
+import json
+import os
+import shutil
+import numpy as np
+
+# Policies
+KEEP_NEEDED = 0
+KEEP_LAST = 1
+KEEP_FLOWS = 2
+KEEP_SAMPLE = 3
+KEEP_ALL = 4
+
+# Kinds of intermediates
+KIND_FLOWS = 'flows'
+
+# States of a released intermediate
+STATE_KEPT = 'kept'
+STATE_COMPRESSED = 'compressed'
+STATE_SAMPLED = 'sampled'
+STATE_REMOVED = 'removed'
+
+
+def disk_usage(path):
+    """Bytes used by a file or a folder."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, fn)) for fn in files)
+    return total
+
+
+def compress_volumes(folder):
+    """Pack the volumes of a folder into a float16 <folder>.npz and remove the folder."""
+    from continuousflex.protocols.utilities.optflow_engine import read_volume
+    fns = sorted(fn for fn in os.listdir(folder) if fn.endswith(('.spi', '.vol', '.mrc')))
+    path = folder.rstrip('/') + '.npz'
+    np.savez_compressed(path, **{fn: np.float16(read_volume(os.path.join(folder, fn))) for fn in fns})
+    shutil.rmtree(folder)
+    return path
+
+
+def sample_ids(ids, n):
+    """n item ids evenly spaced in the sorted ids."""
+    ids = sorted(int(i) for i in ids)
+    if not ids:
+        return []
+    return [ids[i] for i in np.unique(np.linspace(0, len(ids) - 1, min(n, len(ids))).astype(int))]
+
+
+def sample_volumes(folder, names):
+    """Keep only the volumes of a folder with the given file names."""
+    keep = set(names)
+    for fn in os.listdir(folder):
+        if fn.endswith(('.spi', '.vol', '.mrc')) and fn not in keep:
+            os.remove(os.path.join(folder, fn))
+    return folder
+
+
+def compress_flows(folder):
+    """Re-encode the flow store of a folder with float16 values inside the sphere."""
+    from continuousflex.protocols.utilities.flow_store import open_flow_store, ENCODING_SPHERE16
+    open_flow_store(folder, encoding=ENCODING_SPHERE16)
+    return folder
+
+
+def sample_flows(folder, slots, items=None):
+    """Keep only the flows of the given slots of a store, in a <folder>_sample.npz file with their ids.
+    @param items: item ids of the slots (saved with the flows), or None.
+    """
+    from continuousflex.protocols.utilities.flow_store import open_flow_store
+    store = open_flow_store(folder)
+    slots = [int(s) for s in slots]
+    path = folder.rstrip('/') + '_sample.npz'
+    np.savez_compressed(path, ids=np.asarray(store.ids)[slots], items=np.asarray(items if items is not None else []),
+                        flows=np.float16([store[s] for s in slots]).reshape((len(slots), 3) + tuple(store.shape)))
+    del store
+    shutil.rmtree(folder)
+    return path
+
+
+class RetentionManager(object):
+    """Keep, compress or remove the intermediates released by the steps.
+    @param path: json file with the state.
+    @param policy: KEEP_NEEDED (remove everything once released), KEEP_LAST (keep the last iterations), KEEP_FLOWS
+                   (keep only the optical flows), KEEP_SAMPLE (keep everything for a subset of the volumes) or
+                   KEEP_ALL.
+    @param last: number of iterations kept with KEEP_LAST.
+    @param sample: number of volumes kept with KEEP_SAMPLE (the same item ids for all the intermediates).
+    @param budget: maximum bytes of the kept intermediates (0 for no budget), the oldest ones are removed first.
+    @param compress: compress the intermediates that are kept.
+    """
+
+    def __init__(self, path, policy=KEEP_NEEDED, last=1, sample=10, budget=0, compress=False):
+        self.path = path
+        self.policy = policy
+        self.last = last
+        self.sample = sample
+        self.budget = budget
+        self.compress = compress
+        self.items = []
+        self.sampled = None
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            # older states are only the list of the intermediates
+            self.items = state['items'] if isinstance(state, dict) else state
+            self.sampled = state.get('sampled') if isinstance(state, dict) else None
+
+    def _save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'sampled': self.sampled, 'items': self.items}, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+    def release(self, iteration, kind, path, names=None):
+        """An intermediate of an iteration is not needed by the next steps anymore.
+        @param names: dict {item id: name of its volume in the folder}, or {item id: slot in the store} for the
+                      flows, used to keep the sampled volumes (KEEP_SAMPLE); intermediates without names (e.g., not
+                      made of one file per volume) are removed by KEEP_SAMPLE.
+        """
+        if not os.path.exists(path):
+            return
+        self.items = [item for item in self.items if item['path'] != path]
+        item = {'iteration': iteration, 'kind': kind, 'path': path, 'written': disk_usage(path)}
+        self.items.append(item)
+        if self.policy == KEEP_SAMPLE and names and self.sampled is None:
+            # chosen once, among the item ids of the first released intermediate
+            self.sampled = sample_ids(names.keys(), self.sample)
+        self._apply(item, names)
+        self._evict_old(iteration)
+        self._enforce_budget()
+        self._save()
+
+    def _apply(self, item, names=None):
+        path, flows = item['path'], item['kind'] == KIND_FLOWS
+        keep = self.policy in (KEEP_LAST, KEEP_ALL) or (self.policy == KEEP_FLOWS and flows)
+        if self.policy == KEEP_SAMPLE and names:
+            sampled = [i for i in self.sampled if i in names]
+            kept = [names[i] for i in sampled]
+            path = sample_flows(path, kept, sampled) if flows else sample_volumes(path, kept)
+            state = STATE_SAMPLED
+        elif keep and self.compress:
+            path = compress_flows(path) if flows else compress_volumes(path)
+            state = STATE_COMPRESSED
+        elif keep:
+            state = STATE_KEPT
+        else:
+            self._remove(path)
+            path, state = None, STATE_REMOVED
+        item.update({'kept_path': path, 'state': state, 'kept': 0 if path is None else disk_usage(path)})
+
+    def _remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _evict(self, item):
+        self._remove(item['kept_path'])
+        item.update({'kept_path': None, 'state': STATE_REMOVED, 'kept': 0})
+
+    def _evict_old(self, iteration):
+        if self.policy != KEEP_LAST:
+            return
+        for item in self.items:
+            if item['kept'] and item['iteration'] <= iteration - self.last:
+                self._evict(item)
+
+    def _enforce_budget(self):
+        if not self.budget:
+            return
+        for item in sorted(self.items, key=lambda item: item['iteration']):
+            if sum(item['kept'] for item in self.items) <= self.budget:
+                break
+            if item['kept']:
+                print('disk budget reached, removing %s' % item['kept_path'])
+                self._evict(item)
+
+    def report(self):
+        """Bytes written and kept by each iteration."""
+        lines = ['iteration  written (MB)  kept (MB)']
+        for iteration in sorted(set(item['iteration'] for item in self.items)):
+            items = [item for item in self.items if item['iteration'] == iteration]
+            lines.append('%9d  %12.1f  %9.1f' % (iteration, sum(item['written'] for item in items) / 1024 ** 2,
+                                                   sum(item['kept'] for item in items) / 1024 ** 2))
+        return '\n'.join(lines)
@@ -0,0 +1,344 @@
+# Cross correlation of subtomograms constrained to the Fourier coefficients measured in both (the common region of
+# their missing wedge masks), computed in Fourier space from cached spectra.
+# The constrained volume of Vi for the pair (i, j) is real(ifft(fft(Vi) Wi Wj)), which is the volume with the
+# spectrum fft(Vi) Omega, where Omega(k) = (Wi(k) Wj(k) + Wi(-k) Wj(-k)) / 2 is the Hermitian part of the joint mask.
+# By Parseval, the normalized cross correlation of the constrained volumes of i and j is then
+#   sum_k Omega^2 Re(Fi Fj*) / sqrt(sum_k Omega^2 |Fi|^2 sum_k Omega^2 |Fj|^2)
+# over all the frequencies but the zero one (the means), without any inverse transform. The sums are taken over the
+# half spectrum of the real FFT, each coefficient weighted by the number of coefficients it stands for.
+# The real FFT of each volume and its mask (at k and at -k) are computed once and kept in memory-mapped arrays, so
+# that each pair only reads them and multiplies them. The masks are binary, and they are packed to one bit per
+# coefficient (see missing_wedge.pack_mask), 1/32 of the size of float32 masks.
+# The matrix of all the pairs is split into square tiles (only the tiles on and above the diagonal, the matrix is
+# symmetric) computed by a pool of workers. Each worker writes its tiles (and their mirror) directly into a
+# memory-mapped matrix, and a tile is marked in a completion bitmap once it was written, so a new run only computes
+# the tiles that are not marked.
+# For large sets, the correlations can be computed only between neighbors: each volume gets a short signature (the
+# measured coefficients of the volume binned to a low resolution, projected on random directions), the nearest
+# neighbors of each volume by the cosine of the signatures are the candidates, and the exact constrained correlation
+# is computed only for the candidate pairs, which gives a sparse matrix with about N k entries instead of N^2. The
+# store then keeps only the packed masks: the spectra of the pairs are computed from the volumes by each worker, with
+# a bounded cache of the last spectra, instead of writing the full spectra of all the volumes on the disk.
+import collections
+import glob
+import multiprocessing
+import os
+import time
+import numpy as np
+from scipy import sparse
+from continuousflex.protocols.utilities.spider_files3 import open_volume
+from continuousflex.protocols.utilities.missing_wedge import pack_mask, unpack_mask
+
+SPECTRA = 'spectra.npy'
+MASKS = 'masks.npy'
+SHAPE = 'shape.txt'
+VOLUMES = 'volumes.txt'
+MATRIX = 'covar_mat.npy'
+BITMAP = 'covar_tiles.npy'
+NEIGHBORS = 'covar_knn_%d_%d.npz'
+
+# Number of volumes j correlated with a volume i at once
+CC_BLOCK = 32
+# Number of volumes on each side of a tile of the matrix
+CC_TILE = 64
+# Length of the signatures of the volumes (random projections of their low frequencies)
+SIGNATURE_DIM = 64
+# Number of spectra kept in memory by each worker when the store has no spectra
+SPECTRUM_CACHE = 256
+
+_worker = {}
+
+
+def half_spectrum_weights(shape):
+    """Weights of the coefficients of a real FFT (rfftn) of a volume, for sums over the full spectrum.
+    The zero frequency has weight 0 (the correlation is of volumes with zero mean).
+    """
+    w = np.full(shape[:-1] + (shape[-1] // 2 + 1,), 2, dtype=np.float32)
+    w[..., 0] = 1
+    if shape[-1] % 2 == 0:
+        w[..., -1] = 1
+    w[(0,) * len(shape)] = 0
+    return w
+
+
+def mask_half_spectra(mask):
+    """Values at k and at -k of a missing wedge mask (zero frequency at the center), on the half spectrum."""
+    mask = np.fft.ifftshift(np.asarray(mask, dtype=np.float32))
+    reverse = np.roll(mask[::-1, ::-1, ::-1], 1, axis=(0, 1, 2))
+    n = mask.shape[-1] // 2 + 1
+    return np.stack([mask[..., :n], reverse[..., :n]])
+
+
+def _file_key(fn):
+    """Size and modification time of a file (or of the stack of an index@path location)."""
+    fn = fn.split('@', 1)[-1]
+    stat = os.stat(fn) if os.path.exists(fn) else None
+    return '%d %d' % (stat.st_size, stat.st_mtime_ns) if stat else 'missing'
+
+
+class SpectrumStore(object):
+    """Memory-mapped real FFTs of a set of volumes and of their missing wedge masks."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, VOLUMES)) as f:
+            self.volumes = [line.split('\t')[0] for line in f.read().splitlines()]
+        fn_spectra = os.path.join(folder, SPECTRA)
+        self.spectra = np.load(fn_spectra, mmap_mode='r') if os.path.exists(fn_spectra) else None
+        self._cache = collections.OrderedDict()
+        self.masks = np.load(os.path.join(folder, MASKS), mmap_mode='r')
+        # the size of the last axis (even or odd) is not given by the half spectra
+        self.shape = tuple(int(n) for n in np.loadtxt(os.path.join(folder, SHAPE), dtype=np.int64, ndmin=1))
+        self.weights = half_spectrum_weights(self.shape)
+        self.half = self.shape[:-1] + (self.shape[-1] // 2 + 1,)
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def spectrum(self, j):
+        """Real FFT of volume j, read from the store or computed from the volume (and cached)."""
+        if self.spectra is not None:
+            return np.asarray(self.spectra[j])
+        if j in self._cache:
+            self._cache.move_to_end(j)
+        else:
+            self._cache[j] = np.complex64(np.fft.rfftn(open_volume(self.volumes[j])))
+            if len(self._cache) > SPECTRUM_CACHE:
+                self._cache.popitem(last=False)
+        return self._cache[j]
+
+    def mask_halves(self, indices):
+        """Masks at k and at -k of the volumes on the half spectrum, float32 array (n, 2) + half spectrum."""
+        return np.stack([unpack_mask(self.masks[j], (2,) + self.half) for j in indices]).astype(np.float32)
+
+    @classmethod
+    def create(cls, folder, volumes, masks, spectra=True):
+        """Compute the spectra of the volumes and masks (lists in the same order).
+        The masks are paths or functions returning the mask (e.g., missing_wedge.RotatedWedge), they are binary (the
+        values of a mask file are thresholded at 0.5).
+        The spectra of a previous run are used as they are if they were computed for the same files (same paths, sizes
+        and modification times) and masks.
+        @param spectra: False to keep only the masks, the spectra are then computed when they are needed (for the
+                        pairs of neighbors of large sets).
+        """
+        listing = ''.join('%s\t%s\t%s\n' % (fn_volume, _file_key(fn_volume),
+                                             fn_mask if callable(fn_mask) else '%s %s' % (fn_mask, _file_key(fn_mask)))
+                          for fn_volume, fn_mask in zip(volumes, masks))
+        fn_listing = os.path.join(folder, VOLUMES)
+        fn_spectra = os.path.join(folder, SPECTRA)
+        if os.path.exists(fn_listing):
+            with open(fn_listing) as f:
+                if f.read() == listing and (os.path.exists(fn_spectra) or not spectra):
+                    return cls(folder)
+            os.remove(fn_listing)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        # the tiles of a previous matrix (and the neighbors) are not valid for new spectra
+        for fn in [os.path.join(folder, BITMAP), fn_spectra] + \
+                glob.glob(os.path.join(folder, NEIGHBORS.replace('%d', '*'))):
+            if os.path.exists(fn):
+                os.remove(fn)
+        shape = np.shape(open_volume(volumes[0]))
+        half = shape[:-1] + (shape[-1] // 2 + 1,)
+        halves = np.lib.format.open_memmap(os.path.join(folder, MASKS), mode='w+', dtype=np.uint8,
+                                           shape=(len(volumes), (2 * int(np.prod(half)) + 7) // 8))
+        for i, fn_mask in enumerate(masks):
+            halves[i] = pack_mask(mask_half_spectra(fn_mask() if callable(fn_mask) else open_volume(fn_mask)) > 0.5)
+        halves.flush()
+        del halves
+        if spectra:
+            spectra = np.lib.format.open_memmap(fn_spectra + '.tmp.npy', mode='w+', dtype=np.complex64,
+                                                shape=(len(volumes),) + half)
+            for i, fn_volume in enumerate(volumes):
+                spectra[i] = np.fft.rfftn(open_volume(fn_volume))
+            spectra.flush()
+            del spectra
+            os.replace(fn_spectra + '.tmp.npy', fn_spectra)
+        np.savetxt(os.path.join(folder, SHAPE), [shape], fmt='%d')
+        # written last, the spectra are complete
+        with open(fn_listing, 'w') as f:
+            f.write(listing)
+        return cls(folder)
+
+    def correlations(self, i, js):
+        """Constrained cross correlations of volume i with the volumes js."""
+        Fi = self.spectrum(i)
+        Wi = self.mask_halves([i])[0]
+        Pi = np.abs(Fi) ** 2
+        cc = np.empty(len(js))
+        for start in range(0, len(js), CC_BLOCK):
+            block = list(js[start:start + CC_BLOCK])
+            Fj = np.stack([self.spectrum(j) for j in block])
+            Wj = self.mask_halves(block)
+            omega2 = (0.5 * (Wi[0] * Wj[:, 0] + Wi[1] * Wj[:, 1])) ** 2 * self.weights
+            n = len(block)
+            num = np.sum((omega2 * (Fj.real * Fi.real + Fj.imag * Fi.imag)).reshape(n, -1), axis=1)
+            power_i = np.sum((omega2 * Pi).reshape(n, -1), axis=1)
+            power_j = np.sum((omega2 * np.abs(Fj) ** 2).reshape(n, -1), axis=1)
+            cc[start:start + n] = num / np.sqrt(power_i * power_j)
+        return cc
+
+
+def matrix_tiles(n, tile=CC_TILE):
+    """Tiles (first row, end row, first column, end column) on and above the diagonal of an n x n matrix."""
+    bounds = [(start, min(start + tile, n)) for start in range(0, n, tile)]
+    return [rows + columns for k, rows in enumerate(bounds) for columns in bounds[k:]]
+
+
+def _init_worker(folder, fn_matrix):
+    _worker['store'] = SpectrumStore(folder)
+    _worker['matrix'] = np.load(fn_matrix, mmap_mode='r+')
+
+
+def _correlate_tile(task):
+    k, (i0, i1, j0, j1) = task
+    t0 = time.time()
+    matrix = _worker['matrix']
+    for i in range(i0, i1):
+        js = range(max(i, j0), j1)
+        if len(js):
+            cc = _worker['store'].correlations(i, js)
+            matrix[i, js.start:js.stop] = cc
+            matrix[js.start:js.stop, i] = cc
+    matrix.flush()
+    return k, time.time() - t0
+
+
+def correlation_matrix(folder, n_jobs=1, tile=CC_TILE):
+    """Constrained cross correlations of all the pairs of volumes of a spectrum store, by tiles.
+    @param folder: folder of the SpectrumStore, where the matrix and the completion bitmap of its tiles are kept.
+    @param n_jobs: number of worker processes.
+    @param tile: number of volumes on each side of a tile (the tiles of a previous run are reused only with the
+                 same size).
+    @return: the N x N matrix, memory-mapped read-only from the folder (covar_mat.npy).
+    """
+    n = len(SpectrumStore(folder))
+    tiles = matrix_tiles(n, tile)
+    fn_matrix = os.path.join(folder, MATRIX)
+    fn_bitmap = os.path.join(folder, BITMAP)
+    done = np.load(fn_bitmap, mmap_mode='r+') if os.path.exists(fn_bitmap) else None
+    if done is None or len(done) != len(tiles) or not os.path.exists(fn_matrix) or \
+            np.load(fn_matrix, mmap_mode='r').shape != (n, n):
+        np.lib.format.open_memmap(fn_matrix, mode='w+', dtype=np.float64, shape=(n, n)).flush()
+        done = np.lib.format.open_memmap(fn_bitmap, mode='w+', dtype=np.uint8, shape=(len(tiles),))
+        done.flush()
+    tasks = [(k, bounds) for k, bounds in enumerate(tiles) if not done[k]]
+    print('%d of %d tiles of the correlation matrix to compute' % (len(tasks), len(tiles)))
+    if tasks:
+        t0 = time.time()
+        n_jobs = max(1, min(int(n_jobs), len(tasks)))
+        with multiprocessing.Pool(processes=n_jobs, initializer=_init_worker, initargs=(folder, fn_matrix)) as pool:
+            for count, (k, spent) in enumerate(pool.imap_unordered(_correlate_tile, tasks), 1):
+                # the tile was flushed by the worker before it returned
+                done[k] = 1
+                done.flush()
+                print('tile %d computed in %.2f seconds, estimated time to finish is %.0f seconds' %
+                      (k, spent, (time.time() - t0) * (len(tasks) - count) / count))
+    return np.load(fn_matrix, mmap_mode='r')
+
+
+def binning_factors(shape, radius):
+    """Largest binning factor of each axis (a divisor of its size) that keeps the frequencies up to radius."""
+    return tuple(max(b for b in range(1, n + 1) if n % b == 0 and n // b >= 2 * radius + 2) if n >= 2 * radius + 2
+                 else 1 for n in shape)
+
+
+def bin_volume(vol, factors):
+    """Volume binned by averaging blocks of factors voxels (the factors divide the sizes)."""
+    shape = sum(((n // b, b) for n, b in zip(np.shape(vol), factors)), ())
+    return np.reshape(vol, shape).mean(axis=tuple(range(1, 2 * len(factors), 2)))
+
+
+def spectral_signatures(folder, radius, dim=SIGNATURE_DIM, seed=0):
+    """Signatures of the volumes of a spectrum store, normalized so that their dot product is a cosine similarity.
+    The coefficients are taken from the real FFT of the volumes binned to a low resolution (see binning_factors),
+    the measured ones of each volume are selected with its mask at the same frequencies.
+    @param radius: maximum frequency (in Fourier voxels) of the coefficients in the signatures.
+    @param dim: length of the signatures.
+    @return: array (N, dim) float32.
+    """
+    store = SpectrumStore(folder)
+    factors = binning_factors(store.shape, radius)
+    binned = tuple(n // b for n, b in zip(store.shape, factors))
+    freqs = np.meshgrid(*[np.fft.fftfreq(n) * n for n in binned[:-1]] + [np.fft.rfftfreq(binned[-1]) * binned[-1]],
+                        indexing='ij', sparse=True)
+    band = np.nonzero((sum(f ** 2 for f in freqs) <= radius ** 2) & (half_spectrum_weights(binned) > 0))
+    # the same frequencies on the half spectrum of the full volumes (for the masks and the weights)
+    full = tuple(np.int64(f[band]) % n for f, n in zip(np.broadcast_arrays(*freqs), store.shape))
+    sqrt_w = np.sqrt(store.weights[full])
+    projection = np.random.RandomState(seed).normal(size=(2 * len(sqrt_w), dim)).astype(np.float32) / np.sqrt(dim)
+    signatures = np.empty((len(store), dim), dtype=np.float32)
+    for i in range(len(store)):
+        coefs = np.fft.rfftn(bin_volume(open_volume(store.volumes[i]), factors))[band]
+        coefs = coefs * store.mask_halves([i])[0, 0][full] * sqrt_w
+        v = np.concatenate([coefs.real, coefs.imag]).astype(np.float32)
+        signatures[i] = np.matmul(v / max(np.linalg.norm(v), 1e-30), projection)
+    signatures /= np.maximum(np.linalg.norm(signatures, axis=1, keepdims=True), 1e-30)
+    return signatures
+
+
+def nearest_neighbors(signatures, k, block=1024):
+    """Indexes (N, k) of the k most similar signatures of each one (itself excluded)."""
+    n = len(signatures)
+    k = min(k, n - 1)
+    neighbors = np.empty((n, max(k, 0)), dtype=np.int64)
+    if k <= 0:
+        return neighbors
+    for start in range(0, n, block):
+        rows = np.arange(start, min(start + block, n))
+        similarity = np.matmul(signatures[rows], signatures.T)
+        similarity[np.arange(len(rows)), rows] = -np.inf
+        neighbors[rows] = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+    return neighbors
+
+
+def _init_store(folder):
+    _worker['store'] = SpectrumStore(folder)
+
+
+def _correlate_rows(task):
+    rows = []
+    for i, js in task:
+        rows.append((i, js, _worker['store'].correlations(i, js)))
+    return rows
+
+
+def neighbor_correlation_matrix(folder, k, radius, n_jobs=1):
+    """Constrained cross correlations of each volume of a spectrum store with its candidate neighbors.
+    @param k: number of candidates of each volume (from the nearest signatures, see spectral_signatures).
+    @param radius: maximum frequency of the signatures.
+    @param n_jobs: number of worker processes.
+    @return: sparse symmetric matrix (scipy csr) with the correlations of the pairs of neighbors and 1 on the diagonal,
+             kept in the folder (and reused) for the same k and radius.
+    """
+    fn_matrix = os.path.join(folder, NEIGHBORS % (k, radius))
+    if os.path.exists(fn_matrix):
+        return sparse.load_npz(fn_matrix).tocsr()
+    n = len(SpectrumStore(folder))
+    t0 = time.time()
+    candidates = nearest_neighbors(spectral_signatures(folder, radius), k)
+    print('nearest neighbors of the signatures found in %.2f seconds' % (time.time() - t0))
+    # each pair is correlated once (the candidates are symmetrized, then only j > i is kept)
+    pattern = sparse.csr_matrix((np.ones(candidates.size), (np.repeat(np.arange(n), candidates.shape[1]),
+                                                            candidates.ravel())), shape=(n, n))
+    pattern = sparse.triu(pattern + pattern.T, k=1).tocsr()
+    rows = [(i, pattern.indices[pattern.indptr[i]:pattern.indptr[i + 1]]) for i in range(n)]
+    rows = [row for row in rows if len(row[1])]
+    n_jobs = max(1, min(int(n_jobs), len(rows)))
+    tasks = [rows[start:start + CC_BLOCK] for start in range(0, len(rows), CC_BLOCK)]
+    print('%d pairs of neighbors to correlate' % pattern.nnz)
+    i_all, j_all, cc_all = [], [], []
+    with multiprocessing.Pool(processes=n_jobs, initializer=_init_store, initargs=(folder,)) as pool:
+        for count, result in enumerate(pool.imap_unordered(_correlate_rows, tasks), 1):
+            for i, js, cc in result:
+                i_all.append(np.full(len(js), i))
+                j_all.append(js)
+                cc_all.append(cc)
+            if count % 100 == 0:
+                print('estimated time to finish is %.0f seconds' % ((time.time() - t0) * (len(tasks) - count) / count))
+    i_all, j_all, cc_all = [np.concatenate(v) for v in (i_all, j_all, cc_all)] if i_all else [np.zeros(0)] * 3
+    matrix = sparse.coo_matrix((np.concatenate([cc_all, cc_all, np.ones(n)]),
+                                (np.concatenate([i_all, j_all, np.arange(n)]),
+                                 np.concatenate([j_all, i_all, np.arange(n)]))), shape=(n, n)).tocsr()
+    sparse.save_npz(fn_matrix, matrix)
+    return matrix
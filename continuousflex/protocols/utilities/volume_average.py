@@ -0,0 +1,226 @@
+# In-memory averaging of aligned volumes.
+# The alignment of each volume (Euler angles, shifts and the optional 90 degrees rotation about Y used for the
+# missing wedge compensation) is composed into one affine transform, and a pool of workers interpolates the volumes
+# in memory and accumulates them into running statistics per worker; the statistics are merged at the end.
+# This gives the same result as 'xmipp_transform_geometry' (B-spline interpolation of order 3, wrapped borders)
+# followed by 'xmipp_image_operate --plus' for each volume, without writing any intermediate file.
+# Each worker streams its volumes through a prefetching reader (the next volume is read by a thread while the current
+# one is accumulated) and keeps, for each group of volumes (e.g., the classes of a classification), the count, the
+# running mean and the running sum of squared deviations (Welford); the partial statistics of the workers are merged
+# at the end (Chan et al.), which gives the mean and the per-voxel variance in a single pass over the volumes.
+# The running statistics are float64 by default. They can be float32 to halve the memory per group (e.g., for the
+# class averages of many classes): the running mean stays in the range of the volumes (unlike a running sum), but its
+# rounding error still grows with the number of volumes of the group, so it is less precise than float64.
+# For the iterative averages, the sum is also written as a map-reduce over subsets of the volumes: each subset has a
+# partial file (sum and count), keyed by the files and the alignments of its volumes, and the partials are merged
+# into the average (and masked) at the end. A partial whose key did not change is reused, so adding, removing or
+# realigning the volumes of a subset only recomputes that subset, and the partials can be found by any node that sees
+# the folder.
+import hashlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.ndimage import affine_transform
+from continuousflex.protocols.utilities.optflow_engine import read_volume
+from continuousflex.protocols.utilities.euler_transforms import euler_matrices
+
+# Number of consecutive item ids in each subset of partial sums
+PARTIAL_SUBSET = 250
+
+
+def euler_matrix(rot, tilt, psi, shiftx=0., shifty=0., shiftz=0.):
+    """4 x 4 matrix of Euler angles (ZYZ, in degrees) and shifts, with the convention of xmipp."""
+    return euler_matrices(rot, tilt, psi, shiftx, shifty, shiftz)
+
+
+def alignment_matrix(rot, tilt, psi, shiftx, shifty, shiftz, flip=0):
+    """Matrix P such that the aligned volume is vol(P x), for an alignment of xmipp_volumeset_align.
+    Without missing wedge compensation (flip 0) the alignment is applied inversely ('--inverse'), otherwise the
+    volume is first rotated 90 degrees about Y and then transformed by the alignment.
+    """
+    A = euler_matrix(rot, tilt, psi, shiftx, shifty, shiftz)
+    if not flip:
+        return A
+    return np.linalg.inv(np.matmul(A, euler_matrix(0, 90, 0)))
+
+
+def transform_volume(vol, P, order=3):
+    """Sample a volume at P x, with x in voxels (x, y, z) centred on the volume (xmipp origin at size//2)."""
+    vol = np.asarray(vol, dtype=np.float32)
+    # from (x, y, z) to the (z, y, x) indexes of the array
+    M = np.asarray(P, dtype=np.float64)[2::-1, 2::-1]
+    t = np.asarray(P, dtype=np.float64)[2::-1, 3]
+    center = np.array(vol.shape) // 2
+    offset = center - np.matmul(M, center) + t
+    return affine_transform(vol, M, offset=offset, order=order, mode='grid-wrap')
+
+
+def fill_missing_wedge(vol, reference, wedge):
+    """Volume with the Fourier coefficients of vol inside the wedge mask, and those of the reference outside.
+    @param reference: reference aligned with the volume.
+    @param wedge: missing wedge mask (1 where the coefficients are measured) with the zero frequency at the center.
+    """
+    I = np.fft.fftshift(np.fft.fftn(vol)) + np.fft.fftshift(np.fft.fftn(reference)) * (1 - wedge)
+    return np.float32(np.real(np.fft.ifftn(np.fft.ifftshift(I))))
+
+
+def prefetch_volumes(paths):
+    """Volumes of a list of paths, in order; the next volume is read in the background while the current one is used."""
+    if not paths:
+        return
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        future = reader.submit(read_volume, paths[0])
+        for next_path in paths[1:]:
+            vol = future.result()
+            future = reader.submit(read_volume, next_path)
+            yield vol
+        yield future.result()
+
+
+def _statistics_chunk(task):
+    chunk, dtype = task
+    stats = {}
+    for (path, P, group), vol in zip(chunk, prefetch_volumes([job[0] for job in chunk])):
+        if P is not None:
+            vol = transform_volume(vol, P)
+        vol = np.asarray(vol, dtype=dtype)
+        if group not in stats:
+            stats[group] = [0, np.zeros(np.shape(vol), dtype=dtype), np.zeros(np.shape(vol), dtype=dtype)]
+        s = stats[group]
+        s[0] += 1
+        delta = vol - s[1]
+        s[1] += delta / s[0]
+        s[2] += delta * (vol - s[1])
+    return stats
+
+
+def _merge_statistics(a, b):
+    n = a[0] + b[0]
+    delta = b[1] - a[1]
+    return [n, a[1] + delta * (b[0] / n), a[2] + b[2] + delta ** 2 * (a[0] * b[0] / n)]
+
+
+def volume_statistics(jobs, n_jobs=1, dtype=np.float64):
+    """Mean and variance of each group of a set of volumes, each one transformed by its alignment.
+    @param jobs: list of tuples (path of the volume, matrix P of alignment_matrix or None to use it as it is, group),
+                 the group can be any hashable key (all the volumes are in the group None if it is not given).
+    @param n_jobs: number of worker processes.
+    @param dtype: type of the running statistics.
+    @return: dictionary {group: (number of volumes, mean (float32), per-voxel variance (float32))}.
+    """
+    jobs = [tuple(job) + (None,) * (3 - len(job)) for job in jobs]
+    n_jobs = max(1, min(int(n_jobs), len(jobs)))
+    chunks = [(jobs[i::n_jobs], dtype) for i in range(n_jobs)]
+    stats = {}
+    with multiprocessing.Pool(processes=n_jobs) as pool:
+        for partial in pool.imap_unordered(_statistics_chunk, chunks):
+            for group, s in partial.items():
+                stats[group] = s if group not in stats else _merge_statistics(stats[group], s)
+    return {group: (n, np.float32(mean), np.float32(m2 / n)) for group, (n, mean, m2) in stats.items()}
+
+
+def pooled_statistics(stats):
+    """Number of volumes, mean and variance of all the groups of volume_statistics together."""
+    pooled = None
+    for n, mean, variance in stats.values():
+        s = [n, np.float64(mean), np.float64(variance) * n]
+        pooled = s if pooled is None else _merge_statistics(pooled, s)
+    n, mean, m2 = pooled
+    return n, np.float32(mean), np.float32(m2 / n)
+
+
+def subsets_by_id(jobs, ids, size):
+    """Subsets of jobs by blocks of item ids.
+    @param ids: item id of each job.
+    @param size: number of consecutive ids per subset.
+    @return: dictionary {subset number: list of jobs}.
+    """
+    subsets = {}
+    for job, item_id in zip(jobs, ids):
+        subsets.setdefault(int(item_id) // size, []).append(job)
+    return subsets
+
+
+def partial_key(jobs):
+    """Key of the partial sum of a subset of jobs (path, P), from the files (size and time) and the matrices."""
+    key = hashlib.blake2b(digest_size=16)
+    for path, P in jobs:
+        fn = path.split('@', 1)[-1]
+        stat = os.stat(fn) if os.path.exists(fn) else None
+        key.update(repr((path, stat and (stat.st_size, stat.st_mtime_ns))).encode())
+        key.update(b'none' if P is None else np.round(np.asarray(P, dtype=np.float64), 6).tobytes())
+    return key.hexdigest()
+
+
+def _partial_sum(task):
+    path_partial, key, jobs = task
+    t0 = time.time()
+    total = None
+    for (path, P), vol in zip(jobs, prefetch_volumes([job[0] for job in jobs])):
+        if P is not None:
+            vol = transform_volume(vol, P)
+        if total is None:
+            total = np.zeros(np.shape(vol), dtype=np.float64)
+        total += vol
+    np.savez(path_partial + '.tmp.npz', sum=total, count=len(jobs), key=key)
+    os.replace(path_partial + '.tmp.npz', path_partial)
+    return path_partial, len(jobs), time.time() - t0
+
+
+def _partial_is_current(path_partial, key):
+    if not os.path.exists(path_partial):
+        return False
+    with np.load(path_partial) as partial:
+        return str(partial['key']) == key
+
+
+def partial_sums(subsets, folder, n_jobs=1):
+    """Write the partial sum (and count) of each subset of volumes, only for the subsets that changed.
+    @param subsets: dictionary {subset number: list of tuples (path of the volume, matrix P or None)}.
+    @param folder: folder of the partials, 'partial_<subset>.npz' (partials of other subsets are removed).
+    @param n_jobs: number of worker processes.
+    @return: paths of the partials of all the subsets.
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    paths = {os.path.join(folder, 'partial_%05d.npz' % subset): jobs for subset, jobs in sorted(subsets.items())}
+    for fn in os.listdir(folder):
+        if os.path.join(folder, fn) not in paths:
+            os.remove(os.path.join(folder, fn))
+    tasks = []
+    for path, jobs in paths.items():
+        key = partial_key(jobs)
+        if not _partial_is_current(path, key):
+            tasks.append((path, key, jobs))
+    print('%d of %d partial sums to update' % (len(tasks), len(paths)))
+    if tasks:
+        with multiprocessing.Pool(processes=max(1, min(int(n_jobs), len(tasks)))) as pool:
+            for path, count, spent in pool.imap_unordered(_partial_sum, tasks):
+                print('partial sum ', os.path.basename(path), ' of ', count, ' volumes in ', np.round(spent, 2),
+                      ' seconds')
+    return list(paths)
+
+
+def merge_partials(paths, mask=None):
+    """Average of the volumes of a set of partial sums, optionally multiplied by a mask."""
+    total, count = None, 0
+    for path in paths:
+        with np.load(path) as partial:
+            total = partial['sum'] if total is None else total + partial['sum']
+            count += int(partial['count'])
+    if not count:
+        raise Exception('no volume to average in the partial sums')
+    average = total / count
+    if mask is not None:
+        average *= mask
+    return np.float32(average)
+
+
+def write_volume(vol, path):
+    """Write a volume in any format known by xmipp (e.g., mrc or spider, from the extension)."""
+    from pwem.emlib.image import ImageHandler
+    img = ImageHandler().createImage()
+    img.setData(np.float32(vol))
+    img.write(path)
@@ -4,3 +4,16 @@ from .test_workflow_StA import *
 from .test_structure_mapping import *
 from .test_workflow_subtomogram_synthesize import *
 from .test_workflow_TomoFlow import *
+from .test_farneback3d_cpu import *
+from .test_spectral_cc import *
+from .test_flow_store import *
+from .test_flow_gram import *
+from .test_flow_sketch import *
+from .test_flow_warp import *
+from .test_volume_average import *
+from .test_metadata_index import *
+from .test_align_shards import *
+from .test_retention import *
+from .test_euler_transforms import *
+from .test_checkpoint import *
+from .test_missing_wedge import *
@@ -0,0 +1,140 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import os
+import unittest
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+import pwem.emlib.metadata as md
+from continuousflex.protocols.utilities.align_shards import split_metadata, is_done, run_sharded, LocalLauncher, \
+    QueueLauncher
+
+
+def copy_program(program, args):
+    """ A job that writes its input as its output (args as given by shard_args) """
+    words = args.split()
+    md.MetaData(words[words.index('-i') + 1]).write(words[words.index('-o') + 1])
+
+
+class TestAlignShards(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.fnIn = cls.getOutputPath('input.xmd')
+        mdIn = md.MetaData()
+        for item_id in [7, 3, 9, 1, 5, 2, 8]:
+            objId = mdIn.addObject()
+            mdIn.setValue(md.MDL_ITEM_ID, item_id, objId)
+            mdIn.setValue(md.MDL_IMAGE, 'vol_%d.spi' % item_id, objId)
+        mdIn.write(cls.fnIn)
+
+    def setUp(self):
+        self.runs = []
+
+    def run_job(self, program, args):
+        self.runs.append(args.split()[1])
+        copy_program(program, args)
+
+    def item_ids(self, fnMd):
+        mdIn = md.MetaData(fnMd)
+        return [mdIn.getValue(md.MDL_ITEM_ID, objId) for objId in mdIn]
+
+    def test_split(self):
+        shards = split_metadata(self.fnIn, 3, self.getOutputPath('split'))
+        self.assertEqual([self.item_ids(shard['input']) for shard in shards], [[1, 2], [3, 5], [7, 8, 9]])
+        self.assertFalse(any(is_done(shard) for shard in shards))
+
+    def test_resume(self):
+        folder = self.getOutputPath('resume')
+        fnOut = self.getOutputPath('resume_aligned.xmd')
+        fnRef = self.getOutputPath('reference.spi')
+        with open(fnRef, 'w') as f:
+            f.write('first reference')
+        args = '--ref ' + fnRef
+        run_sharded('align', args, self.fnIn, fnOut, folder, 3, LocalLauncher(self.run_job))
+        self.assertEqual(self.item_ids(fnOut), [1, 2, 3, 5, 7, 8, 9])
+        self.assertEqual(len(self.runs), 3)
+        # the complete shards are not aligned again
+        run_sharded('align', args, self.fnIn, fnOut, folder, 3, LocalLauncher(self.run_job))
+        self.assertEqual(len(self.runs), 3)
+        # nor after a change of the modification time only of the reference
+        os.utime(fnRef, ns=(0, 0))
+        run_sharded('align', args, self.fnIn, fnOut, folder, 3, LocalLauncher(self.run_job))
+        self.assertEqual(len(self.runs), 3)
+        # but they are after a change of its contents
+        with open(fnRef, 'w') as f:
+            f.write('second reference')
+        run_sharded('align', args, self.fnIn, fnOut, folder, 3, LocalLauncher(self.run_job))
+        self.assertEqual(len(self.runs), 6)
+        # or of the arguments
+        run_sharded('align', args + ' --maxShift 5', self.fnIn, fnOut, folder, 3, LocalLauncher(self.run_job))
+        self.assertEqual(len(self.runs), 9)
+        self.assertEqual(self.item_ids(fnOut), [1, 2, 3, 5, 7, 8, 9])
+
+    def test_retry(self):
+        failures = []
+
+        def flaky(program, args):
+            if not failures:
+                failures.append(args)
+                raise Exception('killed')
+            copy_program(program, args)
+
+        folder = self.getOutputPath('retry')
+        fnOut = self.getOutputPath('retry_aligned.xmd')
+        run_sharded('align', '', self.fnIn, fnOut, folder, 2, LocalLauncher(flaky), retries=1)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(self.item_ids(fnOut), [1, 2, 3, 5, 7, 8, 9])
+        with self.assertRaises(Exception):
+            run_sharded('align', '--other', self.fnIn, fnOut, folder, 2,
+                        LocalLauncher(lambda program, args: 1 / 0), retries=1)
+
+    def test_queue(self):
+        folder = self.getOutputPath('queue')
+        program = self.getOutputPath('copy.sh')
+        with open(program, 'w') as f:
+            f.write('#!/bin/sh\ncp "$2" "$4"\n')
+        os.chmod(program, 0o755)
+        fnOut = self.getOutputPath('queue_aligned.xmd')
+        run_sharded(program, '', self.fnIn, fnOut, folder, 2, QueueLauncher('sh %(script)s', poll=0.1))
+        self.assertEqual(self.item_ids(fnOut), [1, 2, 3, 5, 7, 8, 9])
+        shards = split_metadata(self.fnIn, 2, folder, '--other')
+        # a job that left the queue without writing its marker
+        QueueLauncher('echo Submitted batch job 123', poll=0.1, status='true').launch(program, '--other', shards)
+        self.assertTrue(all(os.path.exists(shard['failed']) for shard in shards))
+        # a job that never finished is cancelled
+        cancelled = self.getOutputPath('cancelled.txt')
+        launcher = QueueLauncher('echo 123', poll=0.1, timeout=0.3, cancel='echo %(jobid)s >> ' + cancelled)
+        launcher.launch(program, '--other', shards)
+        self.assertTrue(all(os.path.exists(shard['failed']) for shard in shards))
+        self.assertFalse(any(is_done(shard) for shard in shards))
+        with open(cancelled) as f:
+            self.assertEqual(f.read().split(), ['123', '123'])
+        # and not submitted again while the queue system still lists it
+        launcher.submit = 'echo 456 > %(log)s'
+        launcher.status = 'echo %(jobid)s'
+        launcher.launch(program, '--other', shards)
+        self.assertFalse(any(os.path.exists(shard['log']) for shard in shards))
+        self.assertTrue(all(os.path.exists(shard['failed']) for shard in shards))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import os
+import unittest
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils.path import makePath
+
+from continuousflex.protocols.utilities.checkpoint import CheckpointJournal, file_checksum
+
+
+class TestCheckpoint(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def writeOutputs(self, root):
+        """ Journal path and three outputs of a stage, in their own folder """
+        makePath(self.getOutputPath(root))
+        outputs = [self.getOutputPath(root, 'out_%d.spi' % i) for i in range(3)]
+        for i, output in enumerate(outputs):
+            with open(output, 'wb') as f:
+                f.write(bytes([i]) * 100)
+        return self.getOutputPath(root, 'journal', 'align.jsonl'), outputs
+
+    def test_record(self):
+        path, outputs = self.writeOutputs('record')
+        journal = CheckpointJournal(path)
+        journal.record(1, outputs[0], 'key 1')
+        journal.record(2, outputs[1], 'key 2')
+        journal = CheckpointJournal(path)
+        self.assertEqual(len(journal), 2)
+        self.assertTrue(journal.is_done(1, outputs[0], 'key 1'))
+        self.assertFalse(journal.is_done(1, outputs[0], 'other inputs'))
+        self.assertFalse(journal.is_done(1, outputs[1], 'key 1'))
+        self.assertFalse(journal.is_done(3, outputs[2], 'key 3'))
+        # an output changed (same size) or truncated after it was recorded
+        with open(outputs[0], 'r+b') as f:
+            f.write(b'\x07')
+        self.assertFalse(journal.is_done(1, outputs[0], 'key 1'))
+        with open(outputs[1], 'r+b') as f:
+            f.truncate(50)
+        self.assertFalse(journal.is_done(2, outputs[1], 'key 2'))
+        self.assertNotEqual(journal.entries['2']['checksum'], file_checksum(outputs[1]))
+
+    def test_truncated_journal(self):
+        path, outputs = self.writeOutputs('truncated')
+        journal = CheckpointJournal(path)
+        journal.record(1, outputs[0], 'key 1')
+        size = os.path.getsize(path)
+        # the job was killed while the second line was written
+        with open(path, 'a') as f:
+            f.write('{"id": "2", "output": "%s", "ke' % outputs[1])
+        journal = CheckpointJournal(path)
+        self.assertEqual(len(journal), 1)
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertTrue(journal.is_done(1, outputs[0], 'key 1'))
+        # the journal is appended after the last complete line
+        journal.record(2, outputs[1], 'key 2')
+        journal = CheckpointJournal(path)
+        self.assertEqual(sorted(journal.entries), ['1', '2'])
+        self.assertIn('2 of 3', journal.report(3))
+
+
+if __name__ == '__main__':
+    unittest.main()
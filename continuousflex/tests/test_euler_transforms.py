@@ -0,0 +1,84 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import unittest
+import numpy as np
+
+import pwem.emlib.metadata as md
+from continuousflex.protocols.utilities.euler_transforms import euler_matrices, matrices_to_euler, compose, invert, \
+    read_alignments, write_alignments
+
+
+class TestEulerTransforms(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 200
+        self.rot = rng.uniform(-180, 180, n)
+        # away from the tilts handled as gimbal lock (see matrices_to_euler)
+        self.tilt = rng.uniform(10, 170, n)
+        self.psi = rng.uniform(-180, 180, n)
+        self.shifts = rng.uniform(-5, 5, (3, n))
+        self.A = euler_matrices(self.rot, self.tilt, self.psi, *self.shifts)
+
+    def test_round_trip(self):
+        rot, tilt, psi, sx, sy, sz = matrices_to_euler(self.A)
+        np.testing.assert_allclose(rot, self.rot, atol=1e-8)
+        np.testing.assert_allclose(tilt, self.tilt, atol=1e-8)
+        np.testing.assert_allclose(psi, self.psi, atol=1e-8)
+        np.testing.assert_allclose([sx, sy, sz], self.shifts, atol=1e-12)
+        np.testing.assert_allclose(euler_matrices(rot, tilt, psi, sx, sy, sz), self.A, atol=1e-12)
+
+    def test_gimbal_lock(self):
+        for tilt in (0, 180):
+            A = euler_matrices(30, tilt, 20)
+            rot, tilt_out, psi = matrices_to_euler(A)[:3]
+            self.assertEqual(float(rot), 0)
+            self.assertAlmostEqual(float(tilt_out), tilt)
+            np.testing.assert_allclose(euler_matrices(rot, tilt_out, psi), A, atol=1e-12)
+
+    def test_rotation(self):
+        R = self.A[..., :3, :3]
+        np.testing.assert_allclose(np.matmul(R, np.swapaxes(R, -1, -2)), np.broadcast_to(np.eye(3), R.shape),
+                                   atol=1e-12)
+        np.testing.assert_allclose(np.linalg.det(R), 1, atol=1e-12)
+
+    def test_compose_invert(self):
+        np.testing.assert_allclose(invert(self.A), np.linalg.inv(self.A), atol=1e-10)
+        np.testing.assert_allclose(compose(self.A, invert(self.A)), np.broadcast_to(np.eye(4), self.A.shape),
+                                   atol=1e-10)
+        np.testing.assert_allclose(compose(self.A[0], self.A[1]), np.matmul(self.A[0], self.A[1]))
+
+    def test_metadata(self):
+        mdOut = md.MetaData()
+        for i in range(5):
+            mdOut.addObject()
+        write_alignments(mdOut, self.A[:5])
+        np.testing.assert_allclose(read_alignments(mdOut), self.A[:5], atol=1e-10)
+        ids = [objId for objId in mdOut][::2]
+        np.testing.assert_allclose(read_alignments(mdOut, ids), self.A[:5:2], atol=1e-10)
+        # the columns that are not in the metadata are zero
+        mdShifts = md.MetaData()
+        mdShifts.setValue(md.MDL_SHIFT_X, 2., mdShifts.addObject())
+        np.testing.assert_allclose(read_alignments(mdShifts), [euler_matrices(0, 0, 0, 2, 0, 0)], atol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
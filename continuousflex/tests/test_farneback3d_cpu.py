@@ -0,0 +1,59 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import unittest
+import numpy as np
+from scipy.ndimage import gaussian_filter, shift
+
+from continuousflex.protocols.utilities.farneback3d_cpu import Farneback, warp_by_flow
+
+
+class TestFarneback3dCpu(unittest.TestCase):
+    """ Check the CPU optical flow recovers a known rigid shift """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vol0 = np.float32(gaussian_filter(rng.standard_normal((32, 32, 32)), 3) * 10000)
+        # shift of (z, y, x) = (1, -2, 1.5) voxels
+        self.shift = np.array([1.0, -2.0, 1.5])
+        self.vol1 = np.float32(shift(self.vol0, self.shift, order=3, mode='wrap'))
+        self.optflow = Farneback(pyr_scale=0.5, levels=4, winsize=10, num_iterations=10, poly_n=5, poly_sigma=1.2)
+
+    def test_shift_recovery(self):
+        flow = self.optflow.calc_flow(self.vol0, self.vol1)
+        self.assertEqual(flow.shape, (3, 32, 32, 32))
+        center = (slice(8, 24),) * 3
+        # the flow is (x, y, z) and goes from vol1 back to vol0
+        expected = -self.shift[::-1]
+        for c in range(3):
+            self.assertAlmostEqual(float(np.mean(flow[c][center])), expected[c], delta=0.05)
+        warped = warp_by_flow(self.vol0, flow)
+        self.assertLess(np.mean(np.abs(warped - self.vol1)[center]),
+                        0.2 * np.mean(np.abs(self.vol0 - self.vol1)[center]))
+
+    def test_cached_pyramid(self):
+        pyramid = self.optflow.expand_pyramid(self.vol0)
+        flow = self.optflow.calc_flow(self.vol0, self.vol1)
+        np.testing.assert_allclose(self.optflow.calc_flow(self.vol0, self.vol1, cur_pyramid=pyramid), flow,
+                                   atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import os
+import unittest
+import numpy as np
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from continuousflex.protocols.utilities.flow_store import FlowStore, spherical_mask
+from continuousflex.protocols.utilities.flow_gram import block_size, flow_gram_matrix, update_flow_gram_matrix, \
+    _Checkpoint
+
+
+class TestFlowGram(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.shape = (8, 8, 8)
+        cls.flows = np.float32(np.random.default_rng(0).standard_normal((5, 3) + cls.shape))
+        cls.store = FlowStore.create(cls.getOutputPath('flows.flw'), range(1, 6), cls.shape)
+        for slot, flow in enumerate(cls.flows):
+            cls.store.write(slot, flow)
+        F = np.float64(cls.flows).reshape(5, -1)
+        cls.dense = np.matmul(F, F.T)
+        # two flows per block, three blocks of rows
+        cls.memory_mb = 2.5 * 2 * 8 * F.shape[1] / 1024 ** 2
+
+    def test_tiled_vs_dense(self):
+        self.assertEqual(block_size(self.flows[0].size, self.memory_mb, 5), 2)
+        np.testing.assert_allclose(flow_gram_matrix(self.store, memory_mb=self.memory_mb), self.dense, rtol=1e-10)
+        mask = spherical_mask(self.shape)
+        F = np.float64(self.flows[:, :, mask]).reshape(5, -1)
+        np.testing.assert_allclose(flow_gram_matrix(self.store, mask, memory_mb=self.memory_mb),
+                                   np.matmul(F, F.T), rtol=1e-10)
+
+    def test_resume_checkpoint(self):
+        root = self.getOutputPath('gram')
+        # a previous run finished the first tile (marked with a value that is not recomputed)
+        ckpt = _Checkpoint(root, 5, 2)
+        ckpt.matrix[0:2, 0:2] = -1
+        ckpt.save(0, 0)
+        del ckpt
+        matrix = flow_gram_matrix(self.store, memory_mb=self.memory_mb, checkpoint=root)
+        np.testing.assert_array_equal(matrix[0:2, 0:2], -1)
+        np.testing.assert_allclose(matrix[2:, :], self.dense[2:, :], rtol=1e-10)
+        np.testing.assert_allclose(matrix[:, 2:], self.dense[:, 2:], rtol=1e-10)
+        # the checkpoint is removed once the matrix is complete
+        self.assertFalse(os.path.exists(root + '_matrix.npy'))
+        self.assertFalse(os.path.exists(root + '_tiles.npy'))
+
+    def test_update(self):
+        keys = [(i, 'h%d' % i) for i in range(1, 6)]
+        # the flows 2 and 5 are new or changed since the old matrix
+        old_keys = [keys[0], (2, 'old'), keys[2], keys[3]]
+        old_matrix = self.dense[:4, :4].copy()
+        old_matrix[1, :] = old_matrix[:, 1] = np.nan
+        matrix = update_flow_gram_matrix(self.store, old_matrix, old_keys, keys, memory_mb=self.memory_mb)
+        np.testing.assert_allclose(matrix, self.dense, rtol=1e-10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import unittest
+import numpy as np
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from continuousflex.protocols.utilities.flow_store import FlowStore, spherical_mask, ENCODING_SPHERE16
+from continuousflex.protocols.utilities.flow_sketch import sketch_flow, open_sketches, missing_sketches, \
+    sketch_store, sketch_keys_path, approximate_gram
+
+
+class TestFlowSketch(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.shape = (8, 8, 8)
+        cls.mask = spherical_mask(cls.shape)
+        cls.flows = np.float32(np.random.default_rng(0).standard_normal((4, 3) + cls.shape))
+
+    def newStore(self, name, encoding=0):
+        store = FlowStore.create(self.getOutputPath(name + '.flw'), [10, 20, 30, 40], self.shape, encoding)
+        for slot, flow in enumerate(self.flows):
+            store.write(slot, flow)
+        return store
+
+    def test_inner_products(self):
+        # with all the coefficients the transform is orthonormal
+        n_features = 3 * int(np.sum(self.mask))
+        S = np.array([sketch_flow(flow, self.mask, n_features) for flow in self.flows])
+        F = np.float64(self.flows[:, :, self.mask]).reshape(4, -1)
+        np.testing.assert_allclose(approximate_gram(S), np.matmul(F, F.T), rtol=1e-8)
+        np.testing.assert_allclose(approximate_gram(S, rows=[1, 3], cols=[0]), np.matmul(F, F.T)[[1, 3]][:, [0]],
+                                   rtol=1e-8)
+
+    def test_sketch_only_new_flows(self):
+        k = 16
+        store = self.newStore('flows')
+        path = self.getOutputPath('sketches.npy')
+        sketches = open_sketches(path, store.ids, k)
+        self.assertEqual(missing_sketches(sketches), [0, 1, 2, 3])
+        sketch_store(store, sketches, self.mask, path)
+        keys = np.load(sketch_keys_path(path))
+        self.assertEqual(missing_sketches(sketches, keys, store.encoding), [])
+        np.testing.assert_allclose(sketches[2], sketch_flow(self.flows[2], self.mask, k), rtol=1e-5)
+        # a volume is appended, the rows of the others are kept
+        del sketches
+        sketches = open_sketches(path, [10, 20, 30, 40, 50], k)
+        self.assertEqual(missing_sketches(sketches, np.load(sketch_keys_path(path)), store.encoding), [4])
+        np.testing.assert_allclose(sketches[2], sketch_flow(self.flows[2], self.mask, k), rtol=1e-5)
+        # the rows sketched from a store with another encoding are sketched again
+        lossy = self.newStore('flows16', ENCODING_SPHERE16)
+        self.assertEqual(missing_sketches(sketches[:4], np.load(sketch_keys_path(path))[:4], lossy.encoding),
+                         [0, 1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import unittest
+import numpy as np
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils.path import makePath
+
+from continuousflex.protocols.utilities.flow_store import FlowStore, open_flow_store, flow_store_path, \
+    flow_hash, spherical_mask, ENCODING_FULL, ENCODING_SPHERE, ENCODING_SPHERE16, ENCODING_SPHERE8
+
+
+class TestFlowStore(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.shape = (12, 12, 12)
+        cls.mask = spherical_mask(cls.shape)
+        # the flows are zero outside the sphere, as the ones of the optical flow engine
+        cls.flows = np.float32(np.random.default_rng(0).standard_normal((3, 3) + cls.shape)) * cls.mask
+
+    def newStore(self, name, ids=(4, 7, 9), encoding=ENCODING_FULL):
+        folder = self.getOutputPath(name)
+        makePath(folder)
+        return folder, open_flow_store(folder, ids=ids, shape=self.shape, encoding=encoding)
+
+    def test_round_trip(self):
+        for encoding in (ENCODING_FULL, ENCODING_SPHERE):
+            folder, store = self.newStore('round_trip_%d' % encoding, encoding=encoding)
+            self.assertEqual([store.write(slot, flow) for slot, flow in enumerate(self.flows)], [0.] * 3)
+            np.testing.assert_array_equal(store[:], self.flows)
+            np.testing.assert_array_equal(store.flow(7), self.flows[1])
+            np.testing.assert_array_equal(store[2, 1], self.flows[2, 1])
+            reopened = FlowStore(flow_store_path(folder))
+            self.assertEqual(list(reopened.ids), [4, 7, 9])
+            np.testing.assert_array_equal(reopened[:], self.flows)
+
+    def test_lossy_round_trip(self):
+        for encoding, tolerance in ((ENCODING_SPHERE16, 1e-2), (ENCODING_SPHERE8, 5e-2)):
+            store = self.newStore('lossy_%d' % encoding, encoding=encoding)[1]
+            errors = [store.write(slot, flow) for slot, flow in enumerate(self.flows)]
+            for slot, error in enumerate(errors):
+                stored = store[slot]
+                self.assertAlmostEqual(float(np.max(np.abs(stored - self.flows[slot]))), error, places=6)
+                self.assertLess(error, tolerance)
+                # nothing is kept outside the sphere
+                self.assertFalse(np.any(stored[:, ~self.mask]))
+            self.assertAlmostEqual(float(np.max(store.errors)), max(errors), places=6)
+
+    def test_resume_and_rebuild(self):
+        folder, store = self.newStore('resume', encoding=ENCODING_SPHERE)
+        store.write(1, self.flows[1])
+        self.assertEqual(store.missing(), [0, 2])
+        del store
+        reopened = FlowStore(flow_store_path(folder))
+        self.assertEqual(reopened.missing(), [0, 2])
+        np.testing.assert_array_equal(reopened.flow(7), self.flows[1])
+        del reopened
+        # a volume appended to the set keeps the flows calculated before
+        store = open_flow_store(folder, ids=[4, 7, 9, 12])
+        self.assertEqual(store.missing(), [0, 2, 3])
+        np.testing.assert_array_equal(store.flow(7), self.flows[1])
+        # and so does a change of the encoding
+        store = open_flow_store(folder, encoding=ENCODING_FULL)
+        self.assertEqual(store.encoding, ENCODING_FULL)
+        np.testing.assert_array_equal(store.flow(7), self.flows[1])
+
+    def test_flow_hash(self):
+        self.assertEqual(flow_hash(self.flows[0]), flow_hash(np.float64(self.flows[0])))
+        changed = self.flows[0].copy()
+        changed[0, 6, 6, 6] += 1
+        self.assertNotEqual(flow_hash(self.flows[0]), flow_hash(changed))
+
+
+if __name__ == '__main__':
+    unittest.main()
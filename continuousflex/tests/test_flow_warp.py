@@ -0,0 +1,52 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import unittest
+import numpy as np
+
+from continuousflex.protocols.utilities.flow_warp import warp_scores, SLAB
+from continuousflex.protocols.utilities.farneback3d_cpu import warp_by_flow
+
+
+class TestFlowWarp(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # more slices than one slab
+        self.warped = np.float32(rng.standard_normal((2 * SLAB + 3, 10, 10)) + 1)
+        self.vol = np.float32(0.7 * self.warped + 0.3 * rng.standard_normal(self.warped.shape))
+
+    def test_scores(self):
+        ncc, msd, mad = warp_scores(self.warped, self.vol)
+        w, v = np.float64(self.warped).ravel(), np.float64(self.vol).ravel()
+        self.assertAlmostEqual(ncc, np.corrcoef(w, v)[0, 1], places=10)
+        self.assertAlmostEqual(msd, np.sum((w - v) ** 2) / np.sum(w ** 2), places=10)
+        self.assertAlmostEqual(mad, np.sum(np.abs(w - v)) / np.sum(np.abs(w)), places=10)
+
+    def test_zero_flow(self):
+        warped = warp_by_flow(self.vol, np.zeros((3,) + self.vol.shape, dtype=np.float32))
+        ncc, msd, mad = warp_scores(warped, self.vol)
+        self.assertAlmostEqual(ncc, 1, places=5)
+        self.assertAlmostEqual(msd, 0, places=5)
+        self.assertAlmostEqual(mad, 0, places=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import unittest
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+import pwem.emlib.metadata as md
+from continuousflex.protocols.utilities.metadata_index import split_location, LocationIndex, reconcile_metadata
+
+
+class TestMetadataIndex(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.index = LocationIndex()
+        cls.index.add('/data/input/vol_001.spi', 11)
+        cls.index.add('/data/input/vol_002.spi', 12)
+        cls.index.add('3@/data/input/stack.mrcs', 3)
+        cls.index.add('5@/data/input/stack.mrcs', 25)
+
+    def test_split_location(self):
+        self.assertEqual(split_location('3@/data/stack.mrcs'), (3, '/data/stack.mrcs'))
+        self.assertEqual(split_location('/data/vol.spi'), (0, '/data/vol.spi'))
+        self.assertEqual(split_location('a@b.spi'), (0, 'a@b.spi'))
+
+    def test_lookup(self):
+        self.assertEqual(len(self.index), 4)
+        # the same path, then the basename
+        self.assertEqual(self.index.lookup('/data/input/vol_002.spi'), ('/data/input/vol_002.spi', 12))
+        self.assertEqual(self.index.lookup('/other/vol_001.spi'), ('/data/input/vol_001.spi', 11))
+        # in a stack, the item whose id is the index, then the same location in a stack with the same name
+        self.assertEqual(self.index.lookup('11@/other/out.mrcs'), ('/data/input/vol_001.spi', 11))
+        self.assertEqual(self.index.lookup('5@/other/stack.mrcs'), ('5@/data/input/stack.mrcs', 25))
+        self.assertIsNone(self.index.lookup('/other/unknown.spi'))
+
+    def test_reconcile(self):
+        mdImgs = md.MetaData()
+        for path in ['/aligned/vol_002.spi', '/aligned/vol_001.spi']:
+            mdImgs.setValue(md.MDL_IMAGE, path, mdImgs.addObject())
+        fnMd = self.getOutputPath('images.xmd')
+        mdImgs.write(fnMd)
+        reconcile_metadata(mdImgs, self.index)
+        self.assertEqual([mdImgs.getValue(md.MDL_ITEM_ID, objId) for objId in mdImgs], [12, 11])
+        self.assertEqual([mdImgs.getValue(md.MDL_IMAGE, objId) for objId in mdImgs],
+                         ['/data/input/vol_002.spi', '/data/input/vol_001.spi'])
+        # only the ids, and an index made from the reconciled metadata
+        mdImgs = reconcile_metadata(md.MetaData(fnMd), self.index, update_paths=False)
+        self.assertEqual(mdImgs.getValue(md.MDL_IMAGE, mdImgs.firstObject()), '/aligned/vol_002.spi')
+        self.assertEqual(LocationIndex.from_metadata(mdImgs).lookup('/aligned/vol_001.spi')[1], 11)
+        mdImgs.setValue(md.MDL_IMAGE, '/aligned/unknown.spi', mdImgs.addObject())
+        with self.assertRaises(Exception):
+            reconcile_metadata(mdImgs, self.index)
+
+
+if __name__ == '__main__':
+    unittest.main()
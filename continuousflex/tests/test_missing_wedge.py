@@ -0,0 +1,87 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import unittest
+import numpy as np
+
+from continuousflex.protocols.utilities.missing_wedge import wedge_mask, pack_mask, unpack_mask, RotatedWedge
+from continuousflex.protocols.utilities.euler_transforms import euler_matrices
+from continuousflex.protocols.utilities.volume_average import transform_volume
+
+
+def drawn_mask(size, tilt_range):
+    """ Mask as the protocols drew it, before it was rotated by 'xmipp_transform_geometry ... euler 0 90 0' """
+    mask = np.ones((size, size, size))
+    x, z = np.mgrid[0.:size, 0.:size]
+    x -= size / 2
+    z -= size / 2
+    angles = np.zeros(z.shape)
+    angles[np.where(x)] = np.arctan(z[np.where(x)] / x[np.where(x)]) * 180 / np.pi
+    angles = np.repeat(np.reshape(angles, (size, 1, size)), size, axis=1)
+    mask[angles > -tilt_range[0]] = 0
+    mask[angles < -tilt_range[1]] = 0
+    mask[size // 2, :, :] = 0
+    mask[size // 2, :, size // 2] = 1
+    return mask
+
+
+class TestMissingWedge(unittest.TestCase):
+
+    def test_drawn_mask(self):
+        # a rotation of 90 degrees about Y moves the voxels without interpolation
+        rotation = np.linalg.inv(euler_matrices(0, 90, 0))
+        for size in (24, 32):
+            for tilt_range in ((-60, 60), (-45, 70), (-70, 30)):
+                rotated = transform_volume(drawn_mask(size, tilt_range), rotation, order=0) > 0.5
+                # the rotation wraps the frequency -size/2 of the drawn mask around, it is only compared inside
+                inside = (slice(1, None),) * 3
+                np.testing.assert_array_equal(wedge_mask(size, tilt_range)[inside], rotated[inside])
+
+    def test_rotated_wedge(self):
+        size, tilt_range = 33, (-60, 50)
+        mask = wedge_mask(size, tilt_range)
+        # a rotation of 90 degrees about Z of an odd box is a permutation of the voxels
+        P = euler_matrices(90, 0, 0)
+        np.testing.assert_array_equal(wedge_mask(size, tilt_range, P), transform_volume(mask, P, order=0) > 0.5)
+        P = euler_matrices(30, 40, 50)
+        wedge = RotatedWedge(size, tilt_range, P)
+        np.testing.assert_array_equal(wedge(), wedge_mask(size, tilt_range, P))
+        self.assertEqual(repr(wedge), repr(RotatedWedge(size, tilt_range, P + 1e-9)))
+        self.assertNotEqual(repr(wedge), repr(RotatedWedge(size, tilt_range)))
+
+    def test_non_cubic(self):
+        tilt_range = (-60, 50)
+        self.assertEqual(wedge_mask((32, 24, 48), tilt_range).shape, (32, 24, 48))
+        np.testing.assert_array_equal(wedge_mask((24, 24, 24), tilt_range), wedge_mask(24, tilt_range))
+        # the frequencies of a box with half the side along Z and Y are every other frequency of the cube
+        P = euler_matrices(30, 40, 50)
+        np.testing.assert_array_equal(wedge_mask((32, 32, 64), tilt_range, P),
+                                      wedge_mask(64, tilt_range, P)[::2, ::2, :])
+        self.assertEqual(RotatedWedge((32, 32, 64), tilt_range)().shape, (32, 32, 64))
+
+    def test_pack(self):
+        mask = wedge_mask(17, (-60, 60), euler_matrices(10, 20, 30))
+        bits = pack_mask(mask)
+        self.assertEqual(bits.nbytes, (mask.size + 7) // 8)
+        np.testing.assert_array_equal(unpack_mask(bits, mask.shape), mask)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import os
+import unittest
+import numpy as np
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils.path import makePath
+
+from continuousflex.protocols.utilities.flow_store import open_flow_store, ENCODING_SPHERE16
+from continuousflex.protocols.utilities.retention import RetentionManager, sample_ids, KEEP_NEEDED, KEEP_LAST, \
+    KEEP_SAMPLE, KEEP_ALL, KIND_FLOWS, STATE_REMOVED, STATE_KEPT, STATE_SAMPLED, STATE_COMPRESSED
+
+
+class TestRetention(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        # item ids 11, 13, ..., 29 in the slots 0..9
+        cls.items = list(range(11, 31, 2))
+
+    def volumes(self, root, iteration):
+        folder = self.getOutputPath(root, 'volumes_%d' % iteration)
+        makePath(folder)
+        for slot in range(len(self.items)):
+            with open(os.path.join(folder, '%06d.spi' % (slot + 1)), 'wb') as f:
+                f.write(bytes(1000))
+        return folder, {item: '%06d.spi' % (slot + 1) for slot, item in enumerate(self.items)}
+
+    def flows(self, root, iteration):
+        folder = self.getOutputPath(root, 'flows_%d' % iteration)
+        makePath(folder)
+        store = open_flow_store(folder, ids=range(1, len(self.items) + 1), shape=(6, 6, 6))
+        for slot in range(len(self.items)):
+            store.write(slot, np.full((3, 6, 6, 6), slot, dtype=np.float32))
+        del store
+        return folder, {item: slot for slot, item in enumerate(self.items)}
+
+    def test_sample_ids(self):
+        self.assertEqual(sample_ids([5, 1, 3, 9, 7], 3), [1, 5, 9])
+        self.assertEqual(sample_ids([2, 1], 5), [1, 2])
+        self.assertEqual(sample_ids([], 5), [])
+
+    def test_keep_needed(self):
+        manager = RetentionManager(self.getOutputPath('needed.json'), KEEP_NEEDED)
+        folder, names = self.volumes('needed', 1)
+        manager.release(1, 'volumes', folder, names)
+        self.assertFalse(os.path.exists(folder))
+        self.assertEqual(manager.items[0]['state'], STATE_REMOVED)
+        self.assertEqual(manager.items[0]['written'], 10 * 1000)
+
+    def test_keep_last(self):
+        manager = RetentionManager(self.getOutputPath('last.json'), KEEP_LAST, last=1)
+        first = self.volumes('last', 1)[0]
+        manager.release(1, 'volumes', first)
+        self.assertEqual(manager.items[0]['state'], STATE_KEPT)
+        second = self.volumes('last', 2)[0]
+        manager.release(2, 'volumes', second)
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+    def test_keep_sample(self):
+        state = self.getOutputPath('sample.json')
+        manager = RetentionManager(state, KEEP_SAMPLE, sample=3)
+        folder, names = self.volumes('sample', 1)
+        manager.release(1, 'volumes', folder, names)
+        self.assertEqual(manager.sampled, [11, 19, 29])
+        self.assertEqual(sorted(os.listdir(folder)), ['000001.spi', '000005.spi', '000010.spi'])
+        # the same items are kept from the flows, also by a manager reopened from the state
+        manager = RetentionManager(state, KEEP_SAMPLE, sample=3)
+        folder, slots = self.flows('sample', 1)
+        manager.release(1, KIND_FLOWS, folder, slots)
+        item = manager.items[-1]
+        self.assertEqual(item['state'], STATE_SAMPLED)
+        with np.load(item['kept_path']) as sample:
+            self.assertEqual(list(sample['items']), [11, 19, 29])
+            self.assertEqual(list(sample['ids']), [1, 5, 10])
+            self.assertEqual([float(flow[0, 0, 0, 0]) for flow in sample['flows']], [0, 4, 9])
+        # an intermediate without names is removed
+        other = self.volumes('sample', 2)[0]
+        manager.release(2, 'other', other)
+        self.assertFalse(os.path.exists(other))
+
+    def test_budget_and_compression(self):
+        manager = RetentionManager(self.getOutputPath('budget.json'), KEEP_ALL, budget=15000)
+        first = self.volumes('budget', 1)[0]
+        manager.release(1, 'volumes', first)
+        second = self.volumes('budget', 2)[0]
+        manager.release(2, 'volumes', second)
+        # the oldest intermediates are removed first
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+        self.assertIn('iteration', manager.report())
+        manager = RetentionManager(self.getOutputPath('compressed.json'), KEEP_ALL, compress=True)
+        folder = self.flows('compressed', 3)[0]
+        manager.release(3, KIND_FLOWS, folder)
+        self.assertEqual(manager.items[0]['state'], STATE_COMPRESSED)
+        store = open_flow_store(folder)
+        self.assertEqual(store.encoding, ENCODING_SPHERE16)
+        self.assertEqual(float(store[4][0, 3, 3, 3]), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
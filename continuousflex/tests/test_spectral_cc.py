@@ -0,0 +1,100 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import unittest
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from continuousflex.protocols.utilities.spider_files3 import save_volume, open_volume
+from continuousflex.protocols.utilities.missing_wedge import RotatedWedge
+from continuousflex.protocols.utilities.euler_transforms import euler_matrices
+from continuousflex.protocols.utilities.spectral_cc import SpectrumStore, correlation_matrix, \
+    neighbor_correlation_matrix, nearest_neighbors
+
+
+def direct_correlation(vol_i, vol_j, mask_i, mask_j):
+    """ Correlation of the volumes filtered by the common region of their masks (zero frequency at the center) """
+    joint = np.fft.ifftshift(mask_i * mask_j)
+    a = np.real(np.fft.ifftn(np.fft.fftn(vol_i) * joint))
+    b = np.real(np.fft.ifftn(np.fft.fftn(vol_j) * joint))
+    a -= a.mean()
+    b -= b.mean()
+    return np.sum(a * b) / np.sqrt(np.sum(a * a) * np.sum(b * b))
+
+
+class TestSpectralCC(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def write_volumes(self, name, size, n, classes=1):
+        """ Noisy copies of a few smooth volumes, with randomly rotated wedges """
+        rng = np.random.default_rng(size)
+        bases = [gaussian_filter(rng.standard_normal((size,) * 3), 2) for _ in range(classes)]
+        volumes, wedges = [], []
+        for i in range(n):
+            fn = self.getOutputPath('%s_%d.spi' % (name, i))
+            vol = bases[i % classes] / np.std(bases[i % classes]) + 0.5 * rng.standard_normal((size,) * 3)
+            save_volume(np.float32(vol), fn)
+            volumes.append(fn)
+            wedges.append(RotatedWedge(size, (-60, 60), euler_matrices(*rng.uniform(-180, 180, 3))))
+        return volumes, wedges
+
+    def check_size(self, size):
+        volumes, wedges = self.write_volumes('vol%d' % size, size, 3)
+        store = SpectrumStore.create(self.getOutputPath('spectra%d' % size), volumes, wedges)
+        self.assertEqual(store.shape, (size,) * 3)
+        for i in range(3):
+            cc = store.correlations(i, range(3))
+            for j in range(3):
+                expected = direct_correlation(open_volume(volumes[i]), open_volume(volumes[j]),
+                                              np.float64(wedges[i]()), np.float64(wedges[j]()))
+                self.assertAlmostEqual(cc[j], expected, places=5)
+
+    def test_even_box(self):
+        self.check_size(32)
+
+    def test_odd_box(self):
+        self.check_size(33)
+
+    def test_neighbors(self):
+        volumes, wedges = self.write_volumes('classes', 32, 10, classes=2)
+        dense = np.asarray(correlation_matrix(SpectrumStore.create(self.getOutputPath('all'), volumes,
+                                                                   wedges).folder))
+        folder = self.getOutputPath('neighbors')
+        store = SpectrumStore.create(folder, volumes, wedges, spectra=False)
+        self.assertIsNone(store.spectra)
+        matrix = neighbor_correlation_matrix(folder, 3, 8).toarray()
+        pairs = matrix != 0
+        np.testing.assert_allclose(matrix[pairs], dense[pairs], atol=1e-5)
+        # the candidates are found in the same class
+        for i in range(10):
+            self.assertTrue(all(j % 2 == i % 2 for j in np.flatnonzero(pairs[i])))
+        # a single volume has no neighbor
+        self.assertEqual(nearest_neighbors(np.ones((1, 4)), 3).shape, (1, 0))
+        folder = self.getOutputPath('one')
+        SpectrumStore.create(folder, volumes[:1], wedges[:1], spectra=False)
+        np.testing.assert_array_equal(neighbor_correlation_matrix(folder, 3, 8).toarray(), [[1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# **************************************************************************
+import os
+import unittest
+import numpy as np
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from continuousflex.protocols.utilities.spider_files3 import save_volume
+from continuousflex.protocols.utilities.volume_average import euler_matrix, alignment_matrix, transform_volume, \
+    volume_statistics, pooled_statistics, partial_sums, merge_partials, subsets_by_id
+
+
+class TestVolumeAverage(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.volumes = np.float32(np.random.default_rng(0).standard_normal((5, 32, 32, 32)))
+        cls.paths = cls.writeVolumes('vol', cls.volumes)
+
+    @classmethod
+    def writeVolumes(cls, root, volumes):
+        paths = [cls.getOutputPath('%s%d.spi' % (root, i)) for i in range(len(volumes))]
+        for vol, path in zip(volumes, paths):
+            save_volume(vol, path)
+        return paths
+
+    def test_transform(self):
+        vol = self.volumes[0]
+        np.testing.assert_allclose(transform_volume(vol, np.eye(4)), vol, atol=1e-5)
+        # an integer shift (x, y, z) samples vol(x + t) with wrapped borders
+        shifted = transform_volume(vol, euler_matrix(0, 0, 0, 2, -1, 3))
+        np.testing.assert_allclose(shifted, np.roll(vol, (-3, 1, -2), axis=(0, 1, 2)), atol=1e-5)
+        A = euler_matrix(10, 20, 30, 1, 2, 3)
+        np.testing.assert_allclose(alignment_matrix(10, 20, 30, 1, 2, 3), A)
+        np.testing.assert_allclose(alignment_matrix(10, 20, 30, 1, 2, 3, flip=1),
+                                   np.linalg.inv(np.matmul(A, euler_matrix(0, 90, 0))))
+
+    def test_statistics(self):
+        groups = [0, 1, 0, 1, 1]
+        stats = volume_statistics([(path, None, group) for path, group in zip(self.paths, groups)], n_jobs=2)
+        for group in (0, 1):
+            vols = np.float64(self.volumes[np.array(groups) == group])
+            self.assertEqual(stats[group][0], len(vols))
+            np.testing.assert_allclose(stats[group][1], vols.mean(axis=0), atol=1e-5)
+            np.testing.assert_allclose(stats[group][2], vols.var(axis=0), atol=1e-5)
+        count, mean, variance = pooled_statistics(stats)
+        self.assertEqual(count, 5)
+        np.testing.assert_allclose(mean, np.float64(self.volumes).mean(axis=0), atol=1e-5)
+        np.testing.assert_allclose(variance, np.float64(self.volumes).var(axis=0), atol=1e-5)
+        # the float32 running statistics of the class averages
+        stats32 = volume_statistics([(path, None, group) for path, group in zip(self.paths, groups)], dtype=np.float32)
+        for group in (0, 1):
+            np.testing.assert_allclose(stats32[group][1], stats[group][1], atol=1e-5)
+            np.testing.assert_allclose(stats32[group][2], stats[group][2], atol=1e-5)
+
+    def test_partial_sums(self):
+        volumes = self.volumes.copy()
+        vol_paths = self.writeVolumes('partial_vol', volumes)
+        subsets = subsets_by_id([(path, None) for path in vol_paths], [1, 2, 3, 4, 5], 2)
+        self.assertEqual(sorted(subsets), [0, 1, 2])
+        folder = self.getOutputPath('partials')
+        paths = partial_sums(subsets, folder)
+        np.testing.assert_allclose(merge_partials(paths), np.float64(volumes).mean(axis=0), atol=1e-5)
+        times = [os.path.getmtime(path) for path in paths]
+        # only the subset of a volume that changed is summed again
+        volumes[4] += 1
+        save_volume(volumes[4], vol_paths[4])
+        # same size, the modification time tells the file changed (even within the resolution of the clock)
+        os.utime(vol_paths[4], ns=(0, 0))
+        paths = partial_sums(subsets, folder)
+        self.assertEqual([os.path.getmtime(path) == t for path, t in zip(paths, times)], [True, True, False])
+        np.testing.assert_allclose(merge_partials(paths), np.float64(volumes).mean(axis=0), atol=1e-5)
+        with self.assertRaises(Exception):
+            merge_partials([])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,7 +32,9 @@ from pwem.viewers import ObjectView
 import numpy as np
 import matplotlib.pyplot as plt
 from continuousflex.protocols.utilities.OF_plots import plot_quiver_3d, plot_quiver_2d
-from continuousflex.protocols.utilities.spider_files3 import open_volume, open_image
+from continuousflex.protocols.utilities.spider_files3 import save_volume, open_image
+from continuousflex.protocols.utilities.flow_store import open_flow_store
+from continuousflex.protocols.utilities.euler_transforms import euler_matrices
 import pyworkflow.protocol.params as params
 from pyworkflow.utils.process import runJob
 from pyworkflow.utils.path import makePath
@@ -42,6 +44,8 @@ XY = 0
 XZ = 1
 ZY = 2
 
+GRAM_DISPLAY = 2000
+
 
 class FlexHeteroFlowViewer(EmProtocolViewer):
     """ Visualization of results from the HeteroFlow protocol
@@ -77,6 +81,10 @@ class FlexHeteroFlowViewer(EmProtocolViewer):
                        expertLevel=params.LEVEL_ADVANCED,
                        label='rot tilt psi',
                        help='Project the 3D optical flow using specific Euler angles')
+        form.addParam('displayGram', LabelParam,
+                      label="Display the inner products of the optical flows",
+                      help="Display the matrix of inner products between the optical flows (approximated from "
+                           "their sketches when the protocol only sketched the flows)")
         form.addParam('displayVolumes', LabelParam,
                       label="Display warped volumes",
                       help="Display the volumes that are generated by applying the calculated optical flow of each of "
@@ -95,7 +103,8 @@ class FlexHeteroFlowViewer(EmProtocolViewer):
                            "the warped reference")
 
     def _getVisualizeDict(self):
-        return {'displayVolumes': self._viewVolumes,
+        return {'displayGram': self._viewGram,
+                'displayVolumes': self._viewVolumes,
                 'displayHistCC': self._viewParam,
                 'displayHistmsd': self._viewParam,
                 'displayHistmad': self._viewParam,
@@ -108,6 +117,16 @@ class FlexHeteroFlowViewer(EmProtocolViewer):
         volumes = self.protocol.WarpedRefByFlows
         return [ObjectView(self._project, volumes.strId(), volumes.getFileName())]
 
+    def _viewGram(self, paramName):
+        # at most the first GRAM_DISPLAY volumes for large sets
+        n = min(len(open_flow_store(self.protocol._getExtraPath() + '/optical_flows/')), GRAM_DISPLAY)
+        plt.figure('Inner products of the optical flows')
+        plt.imshow(self.protocol.getGramMatrix(np.arange(n), np.arange(n)), cmap='viridis')
+        plt.colorbar()
+        plt.xlabel('Volume number')
+        plt.ylabel('Volume number')
+        plt.show()
+
     def _viewParam(self, paramName):
         datamat_fn = self.protocol._getExtraPath('cc_msd_mad.txt')
         datamat = np.loadtxt(datamat_fn, delimiter=' ')
@@ -139,19 +158,21 @@ class FlexHeteroFlowViewer(EmProtocolViewer):
         pass
 
     def _viewFlow(self, paramName):
-        number = str(self.FlowNumber).zfill(6)
-        flow = self.read_optical_flow_by_number(number)
+        flow = self.read_optical_flow_by_number(self.FlowNumber.get())
         title = '3D optical flow for input volume number %d' % self.FlowNumber
         plot_quiver_3d(flow, downsample=self.DownSample.get(), title=title)
         pass
 
     def _viewFlow2(self, paramName):
-        number = str(self.FlowNumber).zfill(6)
-        op_path = self.protocol._getExtraPath() + '/optical_flows/'
-        path_flowx = op_path + str(number).zfill(6) + '_opflowx.spi'
-        path_flowy = op_path + str(number).zfill(6) + '_opflowy.spi'
-        path_flowz = op_path + str(number).zfill(6) + '_opflowz.spi'
+        flow = self.read_optical_flow_by_number(self.FlowNumber.get())
         makePath(self.protocol._getTmpPath())
+        # the projection program needs each component in a separate volume file
+        path_flowx = self.protocol._getTmpPath('flow_x.spi')
+        path_flowy = self.protocol._getTmpPath('flow_y.spi')
+        path_flowz = self.protocol._getTmpPath('flow_z.spi')
+        save_volume(np.array(flow[0]), path_flowx)
+        save_volume(np.array(flow[1]), path_flowy)
+        save_volume(np.array(flow[2]), path_flowz)
         proj_x = self.protocol._getTmpPath('proj_x.spi')
         proj_y = self.protocol._getTmpPath('proj_y.spi')
         proj_z = self.protocol._getTmpPath('proj_z.spi')
@@ -194,38 +215,8 @@ class FlexHeteroFlowViewer(EmProtocolViewer):
         pass
 
     def read_optical_flow_by_number(self, num):
-        op_path = self.protocol._getExtraPath() + '/optical_flows/'
-        path_flowx = op_path + str(num).zfill(6) + '_opflowx.spi'
-        path_flowy = op_path + str(num).zfill(6) + '_opflowy.spi'
-        path_flowz = op_path + str(num).zfill(6) + '_opflowz.spi'
-        flow = self.read_optical_flow(path_flowx, path_flowy, path_flowz)
-        return flow
-
-    def read_optical_flow(self, path_flowx, path_flowy, path_flowz):
-        x = open_volume(path_flowx)
-        y = open_volume(path_flowy)
-        z = open_volume(path_flowz)
-        l = np.shape(x)
-        # print(l)
-        flow = np.zeros([3, l[0], l[1], l[2]])
-        flow[0, :, :, :] = x
-        flow[1, :, :, :] = y
-        flow[2, :, :, :] = z
-        return flow
+        store = open_flow_store(self.protocol._getExtraPath() + '/optical_flows/')
+        return store[num - 1]
 
     def euler_matrix(self,rot, tilt, psi):
-        from math import sin, cos, radians
-        t1 = -radians(psi)
-        t2 = -radians(tilt)
-        t3 = -radians(rot)
-        a11 = cos(t1) * cos(t2) * cos(t3) - sin(t1) * sin(t3)
-        a12 = -cos(t3) * sin(t1) - cos(t1) * cos(t2) * sin(t3)
-        a13 = cos(t1) * sin(t2)
-        a21 = cos(t1) * sin(t3) + cos(t2) * cos(t3) * sin(t1)
-        a22 = cos(t1) * cos(t3) - cos(t2) * sin(t1) * sin(t3)
-        a23 = sin(t1) * sin(t2)
-        a31 = -cos(t3) * sin(t2)
-        a32 = sin(t2) * sin(t3)
-        a33 = cos(t2)
-        T = np.array([[a11, a12, a13], [a21, a22, a23], [a31, a32, a33]])
-        return T
+        return euler_matrices(rot, tilt, psi)[:3, :3]
@@ -31,7 +31,6 @@ visualization program.
 import os
 from os.path import basename, join, exists, isfile
 import numpy as np
-import pwem.emlib.metadata as md
 from pyworkflow.utils.path import cleanPath, makePath, cleanPattern
 from pyworkflow.viewer import (ProtocolViewer, DESKTOP_TKINTER, WEB_DJANGO)
 from pyworkflow.protocol.params import StringParam, LabelParam
@@ -46,9 +45,11 @@ from pwem.viewers.viewer_chimera import Chimera
 
 from joblib import load, dump
 from continuousflex.protocols.utilities.spider_files3 import open_volume, save_volume
-import farneback3d
+from continuousflex.protocols.utilities.flow_store import open_flow_store
+from continuousflex.protocols.utilities.flow_sketch import open_sketches, flows_from_sketches
+from continuousflex.protocols.utilities.optflow_engine import farneback_backend
+from continuousflex.protocols.protocol_heteroflow import MATRIX_SKETCH
 import matplotlib.pyplot as plt
-from pwem.emlib.image import ImageHandler
 
 from pyworkflow.protocol import params
 
@@ -384,38 +385,32 @@ class FlexDimredHeteroFlowViewer(ProtocolViewer):
             # Find closest points in deformations
             deformations = [X[np.argmin(np.sum((Y - p) ** 2, axis=1))] for p in trajectoryPoints]
 
-        # get the original size of the input:
-        mdImgs = md.MetaData(self.protocol.inputOpFlow.get()._getExtraPath('volumes_out.xmd'))
-        N = 0
-        for objId in mdImgs:
-            N += 1
-
-        # reading back all optical flows
-        bigmat = []
-        if(isfile(self.protocol._getExtraPath('bigmat_inverse.pkl'))):
-            print('bigmat_inverse.txt found')
-            # bigmat_pinv = np.loadtxt(self.protocol._getExtraPath('bigmat_inverse.txt'))
-            bigmat_pinv = load(self.protocol._getExtraPath('bigmat_inverse.pkl'))
+        store = self.get_flow_store()
+        heteroflow = self.protocol.inputOpFlow.get()
+        if heteroflow.matrixMode.get() == MATRIX_SKETCH:
+            # the analyzed data are the sketches of the flows, not the matrix of their inner products
+            sketches = open_sketches(heteroflow.getSketchFile())
+            line = np.reshape(flows_from_sketches(store, sketches, np.array(deformations)), [len(deformations), -1]).T
         else:
-            if(isfile(self.protocol._getExtraPath('bigmat.pkl'))):
-                bigmat = load(self.protocol._getExtraPath('bigmat.pkl'))
-            else:
-                for j in range(1, N+1):
-                    flowj = self.read_optical_flow_by_number(j)
-                    flowj = np.reshape(flowj, [3 * np.shape(flowj)[1] * np.shape(flowj)[2] * np.shape(flowj)[3]])
-                    bigmat.append(flowj)
-                bigmat = np.array(bigmat)
-                print('bigmat created successfully')
-                # np.savetxt(self.protocol._getExtraPath('bigmat.txt'),bigmat)
-                dump(bigmat,self.protocol._getExtraPath('bigmat.pkl'))
-                print('bigmat.pkl saved successfully')
-            bigmat_pinv = np.linalg.pinv(bigmat)
-            bigmat = None  # removing it from the memory
-            # np.savetxt(self.protocol._getExtraPath('bigmat_inverse.txt'),bigmat_pinv)
-            dump(bigmat_pinv,self.protocol._getExtraPath('bigmat_inverse.pkl'))
-
-        line = np.matmul(bigmat_pinv, np.transpose(deformations))
-        bigmat_pinv = None # removing if from the memory
+            bigmat_pinv = None
+            if(isfile(self.protocol._getExtraPath('bigmat_inverse.pkl'))):
+                print('bigmat_inverse.txt found')
+                # bigmat_pinv = np.loadtxt(self.protocol._getExtraPath('bigmat_inverse.txt'))
+                bigmat_pinv = load(self.protocol._getExtraPath('bigmat_inverse.pkl'))
+                # volumes were appended to the set after it was saved
+                if np.shape(bigmat_pinv)[1] != len(store):
+                    bigmat_pinv = None
+            if bigmat_pinv is None:
+                # all the optical flows as rows of a matrix (memory-mapped from the flow store when it has full volumes)
+                bigmat = np.reshape(store[:], [len(store), -1])
+                bigmat_pinv = np.linalg.pinv(bigmat)
+                bigmat = None  # removing it from the memory
+                # np.savetxt(self.protocol._getExtraPath('bigmat_inverse.txt'),bigmat_pinv)
+                dump(bigmat_pinv,self.protocol._getExtraPath('bigmat_inverse.pkl'))
+
+            line = np.matmul(bigmat_pinv, np.transpose(deformations))
+            bigmat_pinv = None # removing if from the memory
+        warp_by_flow = farneback_backend(heteroflow.getFlowBackend()).warp_by_flow
         fnref = self.protocol._getExtraPath('reference.spi')
         shape = np.shape(open_volume(fnref))
 
@@ -424,7 +419,7 @@ class FlexDimredHeteroFlowViewer(ProtocolViewer):
             flowi = np.reshape(flowi, [3, shape[0], shape[1], shape[2]])
             pathi = animationRoot + str(i).zfill(3) + 'deformed_by_opflow.vol'
             ref = open_volume(fnref)
-            ref = farneback3d.warp_by_flow(ref, np.float32(flowi))
+            ref = warp_by_flow(ref, np.float32(flowi))
             save_volume(ref, pathi)
             # command = '-i ' + pathi + ' --select below 0.6 --substitute value 0'
             # runJob(None,'xmipp_transform_threshold',command)
@@ -460,28 +455,11 @@ class FlexDimredHeteroFlowViewer(ProtocolViewer):
         errors = []
         return errors
 
-    def read_optical_flow(self, path_flowx, path_flowy, path_flowz):
-        # x = open_volume(path_flowx)
-        x = ImageHandler().read(path_flowx).getData()
-        # y = open_volume(path_flowy)
-        y = ImageHandler().read(path_flowy).getData()
-        # z = open_volume(path_flowz)
-        z = ImageHandler().read(path_flowz).getData()
-
-        l = np.shape(x)
-        flow = np.zeros([3, l[0], l[1], l[2]])
-        flow[0, :, :, :] = x
-        flow[1, :, :, :] = y
-        flow[2, :, :, :] = z
-        return flow
+    def get_flow_store(self):
+        return open_flow_store(self.protocol.inputOpFlow.get()._getExtraPath() + '/optical_flows/')
 
     def read_optical_flow_by_number(self, num):
-        op_path = self.protocol.inputOpFlow.get()._getExtraPath()+'/optical_flows/'
-        path_flowx = op_path + str(num).zfill(6) + '_opflowx.spi'
-        path_flowy = op_path + str(num).zfill(6) + '_opflowy.spi'
-        path_flowz = op_path + str(num).zfill(6) + '_opflowz.spi'
-        flow = self.read_optical_flow(path_flowx, path_flowy, path_flowz)
-        return flow
+        return self.get_flow_store()[num - 1]
 
     def viewPcaSinglularValues(self, paramName):
         pca = load(self.protocol._getExtraPath('pca_pickled.txt'))
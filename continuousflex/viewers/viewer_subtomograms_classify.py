@@ -243,8 +243,11 @@ class FlexProtSubtomoClassifyViewer(ProtocolViewer):
         pass
 
     def viewDendrogram(self, paramName):
-        data = load(self.protocol._getExtraPath('covar_mat.pkl'))
-        data = np.ones_like(data) - data
+        if self.protocol.correlationMode.get() == 1:
+            return [self.errorMessage('The dendrogram needs the correlations of all the pairs of subtomograms\n'
+                                      '(only the nearest neighbors were correlated)\n',
+                                      title='Dendrogram not available')]
+        data = 1 - self.protocol.getCorrelationMatrix()
         plt.figure('Dendrogram')
         p = self.protocol.numOfClasses.get()
         dend = sch.dendrogram(sch.linkage(data, method='ward'), truncate_mode='lastp', p=p)
@@ -257,8 +260,11 @@ class FlexProtSubtomoClassifyViewer(ProtocolViewer):
         pass
 
     def viewFullDendrogram(self, paramName):
-        data = load(self.protocol._getExtraPath('covar_mat.pkl'))
-        data = np.ones_like(data) - data
+        if self.protocol.correlationMode.get() == 1:
+            return [self.errorMessage('The dendrogram needs the correlations of all the pairs of subtomograms\n'
+                                      '(only the nearest neighbors were correlated)\n',
+                                      title='Dendrogram not available')]
+        data = 1 - self.protocol.getCorrelationMatrix()
         plt.figure('Dendrogram')
         # show the whole dendrogram:
         dend = sch.dendrogram(sch.linkage(data, method='ward'))